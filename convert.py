@@ -8,6 +8,14 @@ from stgan2_ls.model import Generator as LSGen
 from stgan_adain.model import Generator as AdaGen
 from stgan_adain.model import GeneratorSplit  as AdaGenSplit
 from stgan_adain.model import Generator2D as AdaGen2D
+from stgan_adain.model import GeneratorSlim as AdaGenSlim
+from stgan_adain.streaming import GeneratorStream as AdaGenStream, StreamingConverter
+from stgan_adain.chunked_inference import ChunkedGenerator
+from stgan_adain.batched_inference import MaskedGenerator, masked_speaker_encoder, pad_batch, split_batch
+from stgan_adain.conversion_pipeline import ConversionPipeline
+from stgan_adain.speaker_table import load_speaker_table
+from stgan_adain.sharding import ShardFilter, valid_wav, write_wav_atomic
+from stgan_adain.shared_workers import SharedModelPool, share_weights, worker_state
 from stgan_adain.model import SPEncoder as SPEncoder
 from stgan_adain.model import SPEncoderPool
 from stgan_adain.model import SPEncoderPool1D
@@ -26,9 +34,12 @@ import librosa
 from utils import *
 import glob
 import json
+from collections import OrderedDict
+from stgan_adain.onnx_backend import OnnxGenerator, OnnxSPEncoder, onnx_paths, verify_export, quantized_path
 
 from concurrent.futures import ProcessPoolExecutor
 import subprocess
+import traceback
 from tqdm import tqdm
 from functools import partial
 #[1006 new feature: add loud norm]
@@ -39,7 +50,7 @@ class TestDataset(object):
         This test dataloader is for one src spk to one trg spk. 
         Src and trg spk can be defined by config or positional parameters. If they are defined by config, it will ignore the positional parameters.
     """
-    def __init__(self, config, src_spk = None, trg_spk = None, speakers = None):
+    def __init__(self, config, src_spk = None, trg_spk = None, speakers = None, utterances = None):
         
         if config.src_spk is not None and config.trg_spk is not None:
             assert config.trg_spk in speakers, f"The trg_spk {config.trg_spk} does not exist in speakers {speakers}"
@@ -59,6 +70,13 @@ class TestDataset(object):
 
         # find source speakers all mc files
         self.mc_files = sorted(glob.glob(join(config.test_data_dir, f'{self.src_spk}*.npy')))
+        # [1019 new feature]: only the given utterance ids (p225_001, 001 or p225_001.wav) of a --job_file entry
+        self.utterances = utterances
+        if utterances is not None:
+            utt_ids = set(os.path.splitext(utt)[0].split('_')[-1] for utt in utterances)
+            self.mc_files = [mc_file for mc_file in self.mc_files if os.path.splitext(basename(mc_file))[0].split('_')[1] in utt_ids]
+            if len(self.mc_files) < len(utt_ids):
+                raise Exception(f'utterances {sorted(utt_ids)} of {self.src_spk} not all found in {config.test_data_dir}')
         self.trg_mc_files = sorted(glob.glob(join(config.test_data_dir, f'{self.trg_spk}*.npy')))
         self.src_spk_stats = np.load(join(config.train_data_dir, f'{self.src_spk}_stats.npz'))
         self.src_wav_dir = f'{config.wav_dir}/{self.src_spk}'
@@ -87,9 +105,10 @@ class TestDataset(object):
     def get_batch_test_data(self, batch_size=4):
         '''
             if batch_size is not defined through config, it will convert all mc_files for src_spk
+            (or all the given utterances)
         '''
         
-        if batch_size is None:
+        if batch_size is None or self.utterances is not None:
             batch_size = len(self.mc_files)
         batch_data = []
         trg_mcfile = self.trg_mc_files[1]
@@ -112,97 +131,412 @@ def load_wav(wavfile, sr=16000):
     # return wav
 
 
-def process_test_loader(test_loader, G, device, sampling_rate, num_mcep, frame_period, spk2emb, config, sp_enc):
+class MCDReport(object):
+    '''
+        [1019 new feature]: converts every utterance with reference models too (fp32 for int8 graphs,
+        whole-file for chunked inference) and reports the MCD (dB) against the reference conversion.
+        With seams (frame ranges of chunk overlaps), the MCD over the seam frames is reported as well.
+    '''
+    def __init__(self, G, sp_enc, name = 'int8 vs fp32'):
+        self.G = G
+        self.sp_enc = sp_enc
+        self.name = name
+        self.mcds = []
+        self.seam_mcds = []
+
+    def add(self, wav_name, coded_sp_converted, coded_sp_reference, seams = None):
+        mcd = mel_cepstral_distortion(coded_sp_converted, coded_sp_reference)
+        self.mcds.append(mcd)
+        log = f'{self.name} MCD {wav_name}: {mcd:.4f} dB'
+        if seams:
+            frames = np.concatenate([np.arange(start, min(end, len(coded_sp_converted))) for start, end in seams])
+            seam_mcd = mel_cepstral_distortion(coded_sp_converted[frames], coded_sp_reference[frames])
+            self.seam_mcds.append(seam_mcd)
+            log += f', seams {seam_mcd:.4f} dB, max abs diff {np.abs(coded_sp_converted - coded_sp_reference).max():.4f}'
+        print(log, flush=True)
+
+    def summary(self):
+        if len(self.mcds) > 0:
+            print(f'{self.name} MCD over {len(self.mcds)} utterances: mean {np.mean(self.mcds):.4f} dB, max {np.max(self.mcds):.4f} dB', flush=True)
+        if len(self.seam_mcds) > 0:
+            print(f'{self.name} seam MCD over {len(self.seam_mcds)} utterances: mean {np.mean(self.seam_mcds):.4f} dB, max {np.max(self.seam_mcds):.4f} dB', flush=True)
+
+
+def run_generator(G, sp_enc, coded_sp_norm_tensor, trg_mc, test_loader, spk2emb, config, device, src_spk_cond = None):
+    '''speaker conditions of the pair and the normalized converted mcep of one utterance, src_spk_cond: cached source embedding'''
+    trg_spk_cat = torch.FloatTensor(test_loader.spk_c_trg).to(device)
+    trg_spk_label = torch.LongTensor([test_loader.spk_idx]).to(device)           
+    org_spk_cat = torch.FloatTensor(test_loader.spk_c_org).to(device)
+    org_spk_label = torch.LongTensor([test_loader.org_idx]).to(device)           
+    
+    if sp_enc is not None:
+        if not config.use_spk_mean:
+            
+            #_, _, ref_sp, _ = world_decompose(wav = ref_wav, fs = sampling_rate, frame_period = frame_period)
+            #coded_ref_sp = world_encode_spectral_envelop(sp = ref_sp, fs = sampling_rate, dim = num_mcep)
+            #coded_ref_sp_norm = (coded_ref_sp - test_loader.mcep_mean_trg) / test_loader.mcep_std_trg
+            #coded_ref_sp_norm_tensor = torch.FloatTensor(coded_ref_sp_norm.T).unsqueeze_(0).unsqueeze_(1).to(device)
+            if test_loader.trg_spk in spk2emb:
+                # [1019 new feature]: target condition from the speaker embedding table
+                trg_spk_cond = torch.FloatTensor(spk2emb[test_loader.trg_spk]).unsqueeze_(0).to(device)
+            else:
+                coded_ref_sp_norm = np.load(trg_mc)
+                coded_ref_sp_norm_tensor = torch.FloatTensor(coded_ref_sp_norm.T).unsqueeze_(0).unsqueeze_(1).to(device)
+                trg_spk_cond = sp_enc(coded_ref_sp_norm_tensor, trg_spk_label)    
+            if src_spk_cond is None:
+                src_spk_cond = sp_enc(coded_sp_norm_tensor, org_spk_label )
+        else:
+            if test_loader.trg_spk in spk2emb:
+                trg_spk_cond = spk2emb[test_loader.trg_spk]
+                trg_spk_cond = torch.FloatTensor(trg_spk_cond).unsqueeze_(0).to(device)
+                
+                src_spk_cond = spk2emb[test_loader.src_spk]
+                src_spk_cond = torch.FloatTensor(src_spk_cond).unsqueeze_(0).to(device)
+            else:
+                raise Exception(f'trg spk {test_loader.trg_spk} not in spk2emb {spk2emb.keys()}')
+    
+    if sp_enc is not None and config.use_spk_mean and hasattr(G, 'convert'):
+        # [1019 new feature]: speaker mean conditions are fixed per pair, reuse the cached conditioning
+        coded_sp_converted_norm = G.convert(coded_sp_norm_tensor, src_spk_cond, trg_spk_cond,
+            key = (test_loader.src_spk, test_loader.trg_spk)).data.cpu().numpy()
+    elif sp_enc is not None and config.stream_chunk is not None and hasattr(G, 'stream_step'):
+        # [1019 new feature]: convert chunk by chunk as in real-time conversion
+        streaming = StreamingConverter(G, src_spk_cond, trg_spk_cond, chunk_size = config.stream_chunk)
+        chunks = [streaming.push(coded_sp_norm_tensor[..., i: i + config.stream_chunk])
+                  for i in range(0, coded_sp_norm_tensor.size(-1), config.stream_chunk)]
+        chunks.append(streaming.flush())
+        coded_sp_converted_norm = torch.cat(chunks, dim = -1).data.cpu().numpy()
+    elif sp_enc is not None:
+        coded_sp_converted_norm = G(coded_sp_norm_tensor, src_spk_cond, trg_spk_cond).data.cpu().numpy()
+    else:
+        coded_sp_converted_norm = G(coded_sp_norm_tensor, org_spk_cat, trg_spk_cat).data.cpu().numpy()
+    return coded_sp_converted_norm
+
+
+def batched_generator(G, sp_enc):
+    '''MaskedGenerator of G if both G and sp_enc support masked batches, else None'''
+    if not isinstance(G, (AdaGen, AdaGenSplit, AdaGenSlim)) or (sp_enc is not None and type(sp_enc) is not SPEncoder):
+        return None
+    return MaskedGenerator(G)
+
+
+def run_generator_batch(G_masked, sp_enc, coded_sp_norm_tensors, trg_mcs, test_loader, spk2emb, config, device, src_spk_conds = None):
+    '''run_generator on a batch of utterances of the same pair, zero padded and masked, src_spk_conds: cached source embeddings'''
+    x, lengths = pad_batch(coded_sp_norm_tensors)
+    batch_size = x.size(0)
+    trg_spk_label = torch.LongTensor([test_loader.spk_idx]).to(device)
+    org_spk_label = torch.LongTensor([test_loader.org_idx]).to(device)
+
+    if sp_enc is None:
+        src_spk_cond = torch.FloatTensor(test_loader.spk_c_org).to(device).view(1, -1)
+        trg_spk_cond = torch.FloatTensor(test_loader.spk_c_trg).to(device).view(1, -1)
+    elif not config.use_spk_mean:
+        if test_loader.trg_spk in spk2emb:
+            trg_spk_cond = torch.FloatTensor(spk2emb[test_loader.trg_spk]).unsqueeze_(0).to(device)
+        else:
+            refs = [torch.FloatTensor(np.load(trg_mc).T).unsqueeze_(0).unsqueeze_(1).to(device) for trg_mc in trg_mcs]
+            ref_x, _ = pad_batch(refs)
+            ref_lengths = torch.LongTensor([ref.size(-1) for ref in refs]).to(device)
+            trg_spk_cond = masked_speaker_encoder(sp_enc, ref_x, ref_lengths, trg_spk_label)
+        if src_spk_conds is not None:
+            src_spk_cond = torch.cat(src_spk_conds, dim = 0)
+        else:
+            src_lengths = torch.LongTensor([mc.size(-1) for mc in coded_sp_norm_tensors]).to(device)
+            src_spk_cond = masked_speaker_encoder(sp_enc, x, src_lengths, org_spk_label)
+    elif test_loader.trg_spk in spk2emb:
+        trg_spk_cond = torch.FloatTensor(spk2emb[test_loader.trg_spk]).unsqueeze_(0).to(device)
+        src_spk_cond = torch.FloatTensor(spk2emb[test_loader.src_spk]).unsqueeze_(0).to(device)
+    else:
+        raise Exception(f'trg spk {test_loader.trg_spk} not in spk2emb {spk2emb.keys()}')
+
+    out = G_masked(x, lengths, src_spk_cond.expand(batch_size, -1), trg_spk_cond.expand(batch_size, -1))
+    return [y.data.cpu().numpy() for y in split_batch(out, [mc.size(-1) for mc in coded_sp_norm_tensors])]
+
+
+class SourceCache(object):
+    '''
+        [1019 new feature]: WORLD analysis and speaker encoder embedding of the source utterances, computed once
+        and shared by every target speaker. Pairs are visited source speaker major, so only the utterances of
+        the current source speaker are kept; select() drops them when the source speaker changes.
+    '''
+
+    def __init__(self):
+        self.src_spk = None
+        self.analyses = {}
+        self.embeddings = {}
+        self.hits = 0
+        self.misses = 0
+
+    def select(self, src_spk):
+        if src_spk != self.src_spk:
+            self.src_spk = src_spk
+            self.analyses = {}
+            self.embeddings = {}
+
+    def _get(self, cache, key, compute):
+        if key in cache:
+            self.hits += 1
+        else:
+            self.misses += 1
+            cache[key] = compute()
+        return cache[key]
+
+    def analysis(self, wavfile, compute):
+        return self._get(self.analyses, wavfile, compute)
+
+    def embedding(self, wavfile, compute):
+        return self._get(self.embeddings, wavfile, compute)
+
+    def summary(self):
+        print(f'source cache: {self.misses} source analyses / embeddings computed, {self.hits} reused', flush=True)
+
+
+def analyze_source(wavfile, test_loader, sampling_rate, num_mcep, frame_period, loud_meter):
+    '''target independent features of a source utterance: loudness, WORLD analysis and normalized mcep'''
+    wav = load_wav(wavfile, sampling_rate)
+    print(f'len source wav {len(wav)}', flush=True)
+    #[1006 new feature: add loud norm]
+    src_loudness = loud_meter.integrated_loudness(wav)
+    # get source speech features
+    f0, timeaxis, sp, ap = world_decompose(wav=wav, fs=sampling_rate, frame_period=frame_period)
+    coded_sp = world_encode_spectral_envelop(sp=sp, fs=sampling_rate, dim=num_mcep)
+    coded_sp_norm = (coded_sp - test_loader.mcep_mean_src) / test_loader.mcep_std_src
+    return src_loudness, f0, ap, coded_sp, coded_sp_norm
+
+
+def source_embedding(sp_enc, source_cache, wavfile, coded_sp_norm_tensor, test_loader, config, device):
+    '''cached speaker encoder embedding of the source utterance, None if the conditions do not come from it'''
+    if sp_enc is None or config.use_spk_mean:
+        return None
+    org_spk_label = torch.LongTensor([test_loader.org_idx]).to(device)
+    return source_cache.embedding(wavfile, lambda: sp_enc(coded_sp_norm_tensor, org_spk_label))
+
+
+def run_generator_targets(G, sp_enc, coded_sp_norm_tensor, trg_mcs, test_loaders, spk2emb, config, device, src_spk_cond = None, target_cache = None):
+    '''
+        [1019 new feature]: one source utterance to the targets of test_loaders (same source speaker) in one forward,
+        target conditions from the reference mceps are cached in target_cache by (trg_mc, trg label)
+    '''
+    test_loader = test_loaders[0]
+    if target_cache is None:
+        target_cache = {}
+    if sp_enc is None:
+        src_spk_cond = torch.FloatTensor(test_loader.spk_c_org).to(device).view(1, -1)
+        trg_spk_conds = [torch.FloatTensor(loader.spk_c_trg).to(device).view(1, -1) for loader in test_loaders]
+    elif not config.use_spk_mean:
+        if src_spk_cond is None:
+            src_spk_cond = sp_enc(coded_sp_norm_tensor, torch.LongTensor([test_loader.org_idx]).to(device))
+        trg_spk_conds = []
+        for trg_mc, loader in zip(trg_mcs, test_loaders):
+            key = (trg_mc, loader.spk_idx)
+            if loader.trg_spk in spk2emb:
+                trg_spk_conds.append(torch.FloatTensor(spk2emb[loader.trg_spk]).unsqueeze_(0).to(device))
+                continue
+            if key not in target_cache:
+                coded_ref_sp_norm_tensor = torch.FloatTensor(np.load(trg_mc).T).unsqueeze_(0).unsqueeze_(1).to(device)
+                target_cache[key] = sp_enc(coded_ref_sp_norm_tensor, torch.LongTensor([loader.spk_idx]).to(device))
+            trg_spk_conds.append(target_cache[key])
+    else:
+        for loader in test_loaders:
+            if loader.trg_spk not in spk2emb:
+                raise Exception(f'trg spk {loader.trg_spk} not in spk2emb {spk2emb.keys()}')
+        src_spk_cond = torch.FloatTensor(spk2emb[test_loader.src_spk]).unsqueeze_(0).to(device)
+        trg_spk_conds = [torch.FloatTensor(spk2emb[loader.trg_spk]).unsqueeze_(0).to(device) for loader in test_loaders]
+
+    trg_spk_conds = torch.cat(trg_spk_conds, dim = 0)
+    if hasattr(G, 'convert_targets'):
+        out = G.convert_targets(coded_sp_norm_tensor, src_spk_cond, trg_spk_conds)
+    else:
+        out = torch.cat([G(coded_sp_norm_tensor, src_spk_cond, trg_spk_conds[k: k + 1]) for k in range(trg_spk_conds.size(0))], dim = 0)
+    return [out[k: k + 1].data.cpu().numpy() for k in range(out.size(0))]
+
+
+def converted_wav_path(config, test_loader, wav_name):
+    wav_id = wav_name.split('.')[0]
+    return join(config.convert_dir, str(config.resume_iters), f'{wav_id}-{test_loader.src_spk}-vcto-{test_loader.trg_spk}.wav')
+
+
+def process_test_loader(test_loader, G, device, sampling_rate, num_mcep, frame_period, spk2emb, config, sp_enc, mcd_report = None, source_cache = None, shard_filter = None):
     test_wavfiles = test_loader.get_batch_test_data(batch_size=config.num_converted_wavs)
-    test_wavs = [(load_wav(wavfile, sampling_rate), trg_mc_path ) for wavfile, trg_mc_path in test_wavfiles]
+    if shard_filter is not None:
+        # [1019 new feature]: only the utterances of this shard without a valid converted wav
+        test_wavfiles = [(wavfile, trg_mc) for wavfile, trg_mc in test_wavfiles
+                         if shard_filter.todo(test_loader.src_spk, basename(wavfile), converted_wav_path(config, test_loader, basename(wavfile)))]
     pair_list = []
     #[1006 new feature: add loud norm]
     loud_meter = pyloudnorm.Meter(sampling_rate)
+    if source_cache is None:
+        source_cache = SourceCache()
+    source_cache.select(test_loader.src_spk)
+
+    # [1019 new feature]: source analysis is shared by every target speaker of the source utterance
+    sources = []
+    for wavfile, trg_mc in test_wavfiles:
+        print(f'source wav {wavfile} trg mc path {trg_mc}', flush=True)
+        src_loudness, f0, ap, coded_sp, coded_sp_norm = source_cache.analysis(
+            wavfile, partial(analyze_source, wavfile, test_loader, sampling_rate, num_mcep, frame_period, loud_meter))
+        sources.append((wavfile, trg_mc, src_loudness, f0, ap, coded_sp, coded_sp_norm))
+
+    # [1019 new feature]: convert convert_batch utterances per generator call, similar lengths share a batch
+    G_masked = batched_generator(G, sp_enc) if config.convert_batch > 1 else None
+    batch_size = config.convert_batch if G_masked is not None else 1
+    if batch_size > 1:
+        sources.sort(key = lambda source: len(source[-1]))
+    convert_time = 0.
+
     with torch.no_grad():
-        for idx, (wav, trg_mc)  in enumerate(test_wavs):
-            print(f'len source wav {len(wav)} trg mc path {trg_mc}', flush=True)
+        for batch_start in range(0, len(sources), batch_size):
+            batch = []
+            for wavfile, trg_mc, src_loudness, f0, ap, coded_sp, coded_sp_norm in sources[batch_start: batch_start + batch_size]:
+                wav_name = basename(wavfile)
 
-            wav_name = basename(test_wavfiles[idx][0])
-            
-            # print(wav_name)
-            
-            #[1006 new feature: add loud norm]
-            src_loudness = loud_meter.integrated_loudness(wav)
-            # get source speech features
-            f0, timeaxis, sp, ap = world_decompose(wav=wav, fs=sampling_rate, frame_period=frame_period)
-            f0_converted = pitch_conversion(f0=f0, 
-                mean_log_src=test_loader.logf0s_mean_src, std_log_src=test_loader.logf0s_std_src, 
-                mean_log_target=test_loader.logf0s_mean_trg, std_log_target=test_loader.logf0s_std_trg)
-            coded_sp = world_encode_spectral_envelop(sp=sp, fs=sampling_rate, dim=num_mcep)
-            
-            print("Before being fed into G: ", coded_sp.shape, flush=True)
-            coded_sp_norm = (coded_sp - test_loader.mcep_mean_src) / test_loader.mcep_std_src
-            coded_sp_norm_tensor = torch.FloatTensor(coded_sp_norm.T).unsqueeze_(0).unsqueeze_(1).to(device)
-            
-            trg_spk_cat = torch.FloatTensor(test_loader.spk_c_trg).to(device)
-            trg_spk_label = torch.LongTensor([test_loader.spk_idx]).to(device)           
-            org_spk_cat = torch.FloatTensor(test_loader.spk_c_org).to(device)
-            org_spk_label = torch.LongTensor([test_loader.org_idx]).to(device)           
-            
-            if sp_enc is not None:
-                if not config.use_spk_mean:
-                    
-                    #_, _, ref_sp, _ = world_decompose(wav = ref_wav, fs = sampling_rate, frame_period = frame_period)
-                    #coded_ref_sp = world_encode_spectral_envelop(sp = ref_sp, fs = sampling_rate, dim = num_mcep)
-                    #coded_ref_sp_norm = (coded_ref_sp - test_loader.mcep_mean_trg) / test_loader.mcep_std_trg
-                    #coded_ref_sp_norm_tensor = torch.FloatTensor(coded_ref_sp_norm.T).unsqueeze_(0).unsqueeze_(1).to(device)
-                    coded_ref_sp_norm = np.load(trg_mc)
-                    coded_ref_sp_norm_tensor = torch.FloatTensor(coded_ref_sp_norm.T).unsqueeze_(0).unsqueeze_(1).to(device)
-                    trg_spk_cond = sp_enc(coded_ref_sp_norm_tensor, trg_spk_label)    
-                    src_spk_cond = sp_enc(coded_sp_norm_tensor, org_spk_label )
-                else:
-                    if test_loader.trg_spk in spk2emb:
-                        trg_spk_cond = spk2emb[test_loader.trg_spk]
-                        trg_spk_cond = torch.FloatTensor(trg_spk_cond).unsqueeze_(0).to(device)
-                        
-                        src_spk_cond = spk2emb[test_loader.src_spk]
-                        src_spk_cond = torch.FloatTensor(src_spk_cond).unsqueeze_(0).to(device)
-                    else:
-                        raise Exception(f'trg spk {test_loader.trg_spk} not in spk2emb {spk2emb.keys()}')
-            
-            if sp_enc is not None:
-                coded_sp_converted_norm = G(coded_sp_norm_tensor, src_spk_cond, trg_spk_cond).data.cpu().numpy()
+                # print(wav_name)
+
+                f0_converted = pitch_conversion(f0=f0,
+                    mean_log_src=test_loader.logf0s_mean_src, std_log_src=test_loader.logf0s_std_src,
+                    mean_log_target=test_loader.logf0s_mean_trg, std_log_target=test_loader.logf0s_std_trg)
+
+                print("Before being fed into G: ", coded_sp.shape, flush=True)
+                coded_sp_norm_tensor = torch.FloatTensor(coded_sp_norm.T).unsqueeze_(0).unsqueeze_(1).to(device)
+                src_spk_cond = source_embedding(sp_enc, source_cache, wavfile, coded_sp_norm_tensor, test_loader, config, device)
+                batch.append((wav_name, trg_mc, src_loudness, f0, f0_converted, ap, coded_sp, coded_sp_norm_tensor, src_spk_cond))
+
+            start = time.perf_counter()
+            src_spk_conds = [item[-1] for item in batch] if batch[0][-1] is not None else None
+            if batch_size > 1:
+                converted_norms = run_generator_batch(G_masked, sp_enc, [item[-2] for item in batch], [item[1] for item in batch],
+                                                      test_loader, spk2emb, config, device, src_spk_conds)
             else:
-                coded_sp_converted_norm = G(coded_sp_norm_tensor, org_spk_cat, trg_spk_cat).data.cpu().numpy()
+                converted_norms = [run_generator(G, sp_enc, batch[0][-2], batch[0][1], test_loader, spk2emb, config, device, batch[0][-1])]
+            convert_time += time.perf_counter() - start
 
+            for (wav_name, trg_mc, src_loudness, f0, f0_converted, ap, coded_sp, coded_sp_norm_tensor, _), coded_sp_converted_norm in zip(batch, converted_norms):
 
-            coded_sp_converted = np.squeeze(coded_sp_converted_norm).T * test_loader.mcep_std_trg + test_loader.mcep_mean_trg
-            coded_sp_converted = np.ascontiguousarray(coded_sp_converted)
-            
-            
-            print("After being fed into G: ", coded_sp_converted.shape, flush=True)
-            #synthesis to converted wav
-            wav_transformed = world_speech_synthesis(f0=f0_converted, coded_sp=coded_sp_converted, 
-                                                    ap=ap, fs=sampling_rate, frame_period=frame_period)
-            wav_id = wav_name.split('.')[0]
-            #[1006 new feature: add loud norm]
-            output_loudness = loud_meter.integrated_loudness(wav_transformed)
-            if config.use_loudnorm:
-                wav_transformed = pyloudnorm.normalize.loudness(wav_transformed, output_loudness, src_loudness)
+                coded_sp_converted = np.squeeze(coded_sp_converted_norm).T * test_loader.mcep_std_trg + test_loader.mcep_mean_trg
+                coded_sp_converted = np.ascontiguousarray(coded_sp_converted)
 
-            cvt_wav_path = f'{wav_id}-{test_loader.src_spk}-vcto-{test_loader.trg_spk}.wav'
-            librosa.output.write_wav(join(config.convert_dir, str(config.resume_iters),
-                cvt_wav_path), wav_transformed, sampling_rate)
-            
-            pair_list.append((join(config.convert_dir, str(config.resume_iters), cvt_wav_path), trg_mc))
+                if mcd_report is not None:
+                    # [1019 new feature]: MCD of the int8 conversion against the fp32 one
+                    coded_sp_reference_norm = run_generator(mcd_report.G, mcd_report.sp_enc, coded_sp_norm_tensor, trg_mc, test_loader, spk2emb, config, device)
+                    coded_sp_reference = np.squeeze(coded_sp_reference_norm).T * test_loader.mcep_std_trg + test_loader.mcep_mean_trg
+                    mcd_report.add(wav_name, coded_sp_converted, coded_sp_reference, seams = getattr(G, 'seams', None))
 
+                print("After being fed into G: ", coded_sp_converted.shape, flush=True)
+                #synthesis to converted wav
+                wav_transformed = world_speech_synthesis(f0=f0_converted, coded_sp=coded_sp_converted,
+                                                        ap=ap, fs=sampling_rate, frame_period=frame_period)
+                #[1006 new feature: add loud norm]
+                output_loudness = loud_meter.integrated_loudness(wav_transformed)
+                if config.use_loudnorm:
+                    wav_transformed = pyloudnorm.normalize.loudness(wav_transformed, output_loudness, src_loudness)
 
-            
-            if config.cpsyn:
-                wav_cpsyn = world_speech_synthesis(f0=f0, coded_sp=coded_sp, 
-                                                ap=ap, fs=sampling_rate, frame_period=frame_period)
-                librosa.output.write_wav(join(config.convert_dir, str(config.resume_iters), f'cpsyn-{wav_name}'), wav_cpsyn, sampling_rate)
+                # [1019 new feature]: write and rename, an interrupted write never leaves a valid looking wav
+                cvt_wav_path = converted_wav_path(config, test_loader, wav_name)
+                write_wav_atomic(cvt_wav_path, wav_transformed, sampling_rate)
+
+                pair_list.append((cvt_wav_path, trg_mc))
+
+
+
+                if config.cpsyn:
+                    wav_cpsyn = world_speech_synthesis(f0=f0, coded_sp=coded_sp,
+                                                    ap=ap, fs=sampling_rate, frame_period=frame_period)
+                    write_wav_atomic(join(config.convert_dir, str(config.resume_iters), f'cpsyn-{wav_name}'), wav_cpsyn, sampling_rate)
+
+    if len(sources) > 0:
+        print(f'{test_loader.src_spk} -> {test_loader.trg_spk}: converted {len(sources)} utterances in {convert_time:.2f} s, '
+              f'{len(sources) / max(convert_time, 1e-9):.1f} utterances/s (batch size {batch_size})', flush=True)
     return pair_list
 
 
-def _convert(test_loader, G, device, sampling_rate, num_mcep, frame_period, spk2emb, config, sp_enc):
+def pipeline_jobs(config, loader_groups, sampling_rate, num_mcep, frame_period, shard_filter = None):
+    '''(analysis job, [(pair key, meta), ...]) of every source utterance, loader_groups: test loaders of one source speaker'''
+    for test_loaders in loader_groups:
+        targets = OrderedDict()
+        for test_loader in test_loaders:
+            for wavfile, trg_mc in test_loader.get_batch_test_data(batch_size=config.num_converted_wavs):
+                if shard_filter is not None and not shard_filter.todo(test_loader.src_spk, basename(wavfile),
+                                                                      converted_wav_path(config, test_loader, basename(wavfile))):
+                    continue
+                targets.setdefault(wavfile, []).append(((test_loader.src_spk, test_loader.trg_spk), (test_loader, basename(wavfile), trg_mc, wavfile)))
+        src_loader = test_loaders[0]
+        for wavfile, wav_targets in targets.items():
+            job = {'wav_path': wavfile, 'sampling_rate': sampling_rate, 'frame_period': frame_period, 'num_mcep': num_mcep,
+                   'mcep_mean_src': src_loader.mcep_mean_src, 'mcep_std_src': src_loader.mcep_std_src,
+                   'cpsyn': config.cpsyn}
+            if config.fan_out_targets:
+                # [1019 new feature]: all targets of the utterance share a key, one generator batch per source utterance
+                wav_targets = [(wavfile, meta) for _, meta in wav_targets]
+            yield job, wav_targets
+
+
+def convert_pipeline(config, loader_groups, G, device, sampling_rate, num_mcep, frame_period, spk2emb, sp_enc, mcd_report = None, shard_filter = None):
+    '''[1019 new feature]: WORLD analysis and synthesis in process pools overlapped with inference'''
+    G_masked = batched_generator(G, sp_enc) if config.convert_batch > 1 else None
+    out_dir = join(config.convert_dir, str(config.resume_iters))
+    source_cache = SourceCache()
+    target_cache = {}
+    cpsyn_done = set()
+
+    def convert_fn(metas, coded_sp_norms):
+        test_loader = metas[0][0]
+        # pairs of consecutive source speakers can interleave here, keep every (small) source embedding
+        tensors = [torch.FloatTensor(coded_sp_norm.T).unsqueeze_(0).unsqueeze_(1).to(device) for coded_sp_norm in coded_sp_norms]
+        converted = []
+        with torch.no_grad():
+            src_spk_conds = [source_embedding(sp_enc, source_cache, wavfile, tensor, test_loader, config, device)
+                             for tensor, (_, _, _, wavfile) in zip(tensors, metas)]
+            if src_spk_conds[0] is None:
+                src_spk_conds = [None] * len(tensors)
+            if config.fan_out_targets:
+                # metas are the targets of one source utterance
+                converted_norms = run_generator_targets(G, sp_enc, tensors[0], [meta[2] for meta in metas], [meta[0] for meta in metas],
+                                                        spk2emb, config, device, src_spk_conds[0], target_cache)
+            elif G_masked is not None:
+                converted_norms = run_generator_batch(G_masked, sp_enc, tensors, [meta[2] for meta in metas], test_loader, spk2emb, config, device,
+                                                      None if src_spk_conds[0] is None else src_spk_conds)
+            else:
+                converted_norms = [run_generator(G, sp_enc, tensor, meta[2], test_loader, spk2emb, config, device, src_spk_cond)
+                                   for tensor, meta, src_spk_cond in zip(tensors, metas, src_spk_conds)]
+            for (test_loader, wav_name, trg_mc, _), tensor, coded_sp_converted_norm in zip(metas, tensors, converted_norms):
+                coded_sp_converted = np.squeeze(coded_sp_converted_norm).T * test_loader.mcep_std_trg + test_loader.mcep_mean_trg
+                coded_sp_converted = np.ascontiguousarray(coded_sp_converted)
+                if mcd_report is not None:
+                    coded_sp_reference_norm = run_generator(mcd_report.G, mcd_report.sp_enc, tensor, trg_mc, test_loader, spk2emb, config, device)
+                    coded_sp_reference = np.squeeze(coded_sp_reference_norm).T * test_loader.mcep_std_trg + test_loader.mcep_mean_trg
+                    mcd_report.add(wav_name, coded_sp_converted, coded_sp_reference, seams = getattr(G, 'seams', None))
+                converted.append(coded_sp_converted)
+        return converted
+
+    def finish_fn(meta, result, coded_sp_converted):
+        test_loader, wav_name, _, wavfile = meta
+        f0_converted = pitch_conversion(f0=result['f0'],
+            mean_log_src=test_loader.logf0s_mean_src, std_log_src=test_loader.logf0s_std_src,
+            mean_log_target=test_loader.logf0s_mean_trg, std_log_target=test_loader.logf0s_std_trg)
+        job = {'f0_converted': f0_converted, 'ap': result['ap'], 'coded_sp_converted': coded_sp_converted,
+               'src_loudness': result['src_loudness'], 'use_loudnorm': config.use_loudnorm,
+               'sampling_rate': sampling_rate, 'frame_period': frame_period,
+               'out_path': converted_wav_path(config, test_loader, wav_name)}
+        if config.cpsyn and wavfile not in cpsyn_done:
+            # copy synthesis does not depend on the target, once per source utterance
+            cpsyn_done.add(wavfile)
+            job.update({'f0': result['f0'], 'coded_sp': result['coded_sp'], 'cpsyn_path': join(out_dir, f'cpsyn-{wav_name}')})
+        return job
+
+    num_workers = max(1, (os.cpu_count() or 2) - 1)
+    pipeline = ConversionPipeline(convert_fn, finish_fn,
+                                  analysis_workers = config.analysis_workers or max(1, num_workers // 2),
+                                  synthesis_workers = config.synthesis_workers or max(1, num_workers - num_workers // 2),
+                                  batch_size = config.convert_batch,
+                                  queue_size = config.pipeline_queue)
+    out_paths = pipeline.run(pipeline_jobs(config, loader_groups, sampling_rate, num_mcep, frame_period, shard_filter))
+    source_cache.summary()
+    return out_paths
+
+
+def _convert(test_loader, G, device, sampling_rate, num_mcep, frame_period, spk2emb, config, sp_enc, mcd_report = None, source_cache = None, shard_filter = None):
                 
-    pair_list = process_test_loader(test_loader, G, device, sampling_rate, num_mcep, frame_period, spk2emb, config, sp_enc)
+    pair_list = process_test_loader(test_loader, G, device, sampling_rate, num_mcep, frame_period, spk2emb, config, sp_enc, mcd_report, source_cache, shard_filter)
     #all_pair_list.extend(pair_list)
     #return all_pair_list
     
@@ -214,9 +548,12 @@ def test(config):
     #load speakers
     with open(config.speaker_path) as f:
         speakers = json.load(f)
+
+    if config.merge_pairs:
+        return merge_pairs(config, speakers)
     
     spk2emb = {}
-    if config.use_spk_mean and config.generator == 'AdaGen':
+    if config.use_spk_mean and config.spk_mean_dir is not None and config.generator.startswith('AdaGen'):
         if not os.path.exists(join(config.spk_mean_dir, str(config.resume_iters))):
             raise Exception()
         for spk in speakers:
@@ -232,7 +569,55 @@ def test(config):
     sampling_rate, num_mcep, frame_period= config.sample_rate, 36, 5
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     
-    if config.generator.startswith('AdaGen'):
+    # [1019 new feature]: onnxruntime backend, the exported graphs replace the pytorch generator and speaker encoder
+    if config.backend == 'onnx':
+        if not config.generator.startswith('AdaGen'):
+            raise Exception(f'onnx backend supports the AdaGen generators, got {config.generator}')
+        G_onnx_path, sp_onnx_path = onnx_paths(config.onnx_dir, config.resume_iters, config.use_ema)
+        if config.precision == 'fp32' or config.report_mcd or config.onnx_check:
+            G_fp32 = OnnxGenerator(G_onnx_path, num_threads = config.onnx_threads)
+            sp_enc_fp32 = OnnxSPEncoder(sp_onnx_path, num_threads = config.onnx_threads)
+        # [1019 new feature]: int8 graphs of export_onnx.py --quantize, optionally reporting the MCD against fp32
+        mcd_report = None
+        if config.precision == 'int8':
+            G_onnx = OnnxGenerator(quantized_path(G_onnx_path), num_threads = config.onnx_threads)
+            sp_enc_onnx = OnnxSPEncoder(quantized_path(sp_onnx_path), num_threads = config.onnx_threads)
+            if config.report_mcd:
+                mcd_report = MCDReport(G_fp32, sp_enc_fp32)
+        else:
+            G_onnx, sp_enc_onnx = G_fp32, sp_enc_fp32
+        if not config.onnx_check:
+            # no pytorch model needed, skip building and loading it
+            spk2emb = speaker_table(config, speakers, spk2emb, sp_enc_onnx, sp_enc_onnx.path, device)
+            return convert_pairs(config, speakers, G_onnx, device, sampling_rate, num_mcep, frame_period, spk2emb, sp_enc_onnx, mcd_report)
+    elif config.precision == 'int8':
+        raise Exception('int8 precision needs the onnx backend')
+
+    G, sp_enc, sp_path = load_models(config, device, frame_period)
+
+    if config.backend == 'onnx':
+        G.eval()
+        # int8 graphs drift from pytorch by design, check the fp32 graphs they were quantized from
+        verify_export(G, sp_enc, G_fp32, sp_enc_fp32, config.num_speakers)
+        G, sp_enc = G_onnx, sp_enc_onnx
+        spk2emb = speaker_table(config, speakers, spk2emb, sp_enc, sp_enc.path, device)
+        return convert_pairs(config, speakers, G, device, sampling_rate, num_mcep, frame_period, spk2emb, sp_enc, mcd_report)
+
+    if sp_enc is not None:
+        spk2emb = speaker_table(config, speakers, spk2emb, sp_enc, sp_path, device)
+    convert_pairs(config, speakers, G, device, sampling_rate, num_mcep, frame_period, spk2emb, sp_enc)
+
+
+def load_models(config, device, frame_period = 5):
+    '''[1019 new feature]: generator and speaker encoder (None for the one-hot generators) of step config.resume_iters, returns G, sp_enc, sp_path'''
+    if config.generator == 'AdaGenStream':
+        G = AdaGenStream(num_speakers = config.num_speakers, aff = config.drop_affine, res_block_name = config.res_block, lookahead = config.stream_lookahead).to(device)
+        if config.stream_chunk is not None:
+            print(f'streaming algorithmic latency {G.algorithmic_latency(config.stream_chunk, frame_period)} ms', flush=True)
+    elif config.generator == 'AdaGenSlim':
+        G = AdaGenSlim(num_speakers = config.num_speakers, aff = config.drop_affine, res_block_name = config.res_block,
+                       num_blocks = config.student_blocks, res_dim = config.student_res_dim, conv_dim = config.student_conv_dim).to(device)
+    elif config.generator.startswith('AdaGen'):
         G = eval(config.generator)(num_speakers = config.num_speakers, aff = config.drop_affine, res_block_name = config.res_block).to(device)
     elif config.generator == 'LSGen' or config.generator == 'Gen':   
         G = eval(config.generator)(num_speakers = config.num_speakers).to(device)
@@ -258,26 +643,196 @@ def test(config):
         sp_enc.load_state_dict(torch.load(sp_path, map_location=lambda storage, loc: storage))
         sp_enc.eval()
     else:
-        sp_enc = None
-    
+        sp_enc, sp_path = None, None
+    return G, sp_enc, sp_path
+
+
+def speaker_table(config, speakers, spk2emb, sp_enc, sp_path, device):
+    '''
+        [1019 new feature]: per speaker embedding table of the speaker encoder checkpoint, built once and saved
+        by checkpoint hash. Used for the target conditions with --spk_table, and for both conditions with
+        --use_spk_mean when no speaker_embed.py means are given.
+    '''
+    if spk2emb or not (config.spk_table or config.use_spk_mean):
+        return spk2emb
+    num_refs = config.spk_table_refs if config.spk_table else 0
+    return load_speaker_table(sp_enc, sp_path, speakers, config.test_data_dir, config.spk_table_dir, num_refs, device)
+
+
+def merge_pairs(config, speakers):
+    '''
+        [1019 new feature]: after all --shard runs, write the pair list of the all-pairs conversion,
+        the converted wav and the target reference mcep per line
+    '''
+    pair_list, missing = [], 0
+    for src in speakers[:25]:
+        for trg in speakers:
+            if src != trg:
+                test_loader = TestDataset(config, src_spk = src, trg_spk = trg, speakers = speakers)
+                for wavfile, trg_mc in test_loader.get_batch_test_data(batch_size=config.num_converted_wavs):
+                    cvt_wav_path = converted_wav_path(config, test_loader, basename(wavfile))
+                    if valid_wav(cvt_wav_path):
+                        pair_list.append((cvt_wav_path, trg_mc))
+                    else:
+                        missing += 1
+    if missing:
+        print(f'{missing} conversions are missing or incomplete, rerun their shards', flush=True)
+    with open(config.pair_list_path,'w') as f:
+        for pair in pair_list:
+            f.write(f'{pair[0]} {pair[1]}\n')
+    print(f'write {len(pair_list)} pairs to {config.pair_list_path}', flush=True)
+    return pair_list
+
+
+def read_jobs(job_file):
+    '''
+        [1019 new feature]: conversion jobs of a job file, one "src trg [utterance ...]" per line,
+        all test utterances of src if none are given, # starts a comment
+    '''
+    jobs = []
+    with open(job_file) as f:
+        for line_no, line in enumerate(f, 1):
+            fields = line.split('#')[0].split()
+            if len(fields) == 0:
+                continue
+            if len(fields) < 2:
+                raise Exception(f'{job_file}:{line_no}: expected src trg [utterance ...], got {line.strip()}')
+            jobs.append((fields[0], fields[1], fields[2:] or None))
+    return jobs
+
+
+def run_jobs(jobs, num_jobs, config, speakers, G, device, sampling_rate, num_mcep, frame_period, spk2emb, sp_enc, mcd_report = None, shard_filter = None):
+    '''
+        [1019 new feature]: (job index, (src, trg, utterances)) jobs with per job progress, returns the failed
+        jobs, a failing job does not stop the others. Consecutive jobs of the same source speaker share the
+        source analysis.
+    '''
+    source_cache = SourceCache()
+    failed = []
+    for job_idx, (src, trg, utterances) in jobs:
+        job_start = time.perf_counter()
+        print(f'[job {job_idx}/{num_jobs}] {src} -> {trg}', flush=True)
+        try:
+            if src not in speakers or trg not in speakers:
+                raise Exception(f'speaker of job {src} -> {trg} not in speakers')
+            test_loader = TestDataset(config, src_spk = src, trg_spk = trg, speakers = speakers, utterances = utterances)
+            pair_list = process_test_loader(test_loader, G, device, sampling_rate, num_mcep, frame_period, spk2emb, config, sp_enc,
+                                            mcd_report, source_cache, shard_filter)
+        except Exception:
+            print(f'[job {job_idx}/{num_jobs}] {src} -> {trg} failed\n{traceback.format_exc()}', flush=True)
+            failed.append((src, trg, utterances))
+            continue
+        print(f'[job {job_idx}/{num_jobs}] {src} -> {trg} done, {len(pair_list)} utterances in {time.perf_counter() - job_start:.2f} s', flush=True)
+    source_cache.summary()
+    return failed
+
+
+def _convert_worker_task(jobs):
+    '''[1019 new feature]: jobs of one source speaker in a shared weight worker, returns the failed jobs and the skipped conversions'''
+    state = worker_state()
+    config = state['config']
+    shard_filter = ShardFilter(config.shard, skip_existing = not config.overwrite)
+    failed = run_jobs(jobs, state['num_jobs'], config, state['speakers'], state['G'], state['device'], state['sampling_rate'],
+                      state['num_mcep'], state['frame_period'], state['spk2emb'], state['sp_enc'], shard_filter = shard_filter)
+    return failed, shard_filter.skipped
+
+
+def convert_jobs(config, speakers, G, device, sampling_rate, num_mcep, frame_period, spk2emb, sp_enc, mcd_report = None, shard_filter = None):
+    '''
+        [1019 new feature]: every job of --job_file (all pairs if not given) with the models loaded once, in this
+        process or, with --num_workers, in worker processes sharing the model weights. Failed jobs are written
+        to a job file to rerun them.
+    '''
+    if config.job_file is not None:
+        jobs = read_jobs(config.job_file)
+        failed_path = f'{config.job_file}.failed'
+    else:
+        jobs = [(src, trg, None) for src in speakers[:25] for trg in speakers if trg != src]
+        failed_path = join(config.convert_dir, str(config.resume_iters), 'failed_jobs.txt')
+    jobs = list(enumerate(jobs, 1))
+    start = time.perf_counter()
+
+    if config.num_workers is None:
+        failed = run_jobs(jobs, len(jobs), config, speakers, G, device, sampling_rate, num_mcep, frame_period, spk2emb, sp_enc,
+                          mcd_report, shard_filter)
+    else:
+        if device.type != 'cpu' or config.backend != 'torch':
+            raise Exception('--num_workers shares the weights of the pytorch cpu models')
+        if mcd_report is not None:
+            raise Exception('--num_workers does not support the MCD reports')
+        # one task per source speaker, its jobs share the source analysis in the worker
+        tasks = OrderedDict()
+        for job in jobs:
+            tasks.setdefault(job[1][0], []).append(job)
+        share_weights(G)
+        if sp_enc is not None:
+            share_weights(sp_enc)
+        state = {'config': config, 'speakers': speakers, 'G': G, 'sp_enc': sp_enc, 'spk2emb': spk2emb, 'device': device,
+                 'sampling_rate': sampling_rate, 'num_mcep': num_mcep, 'frame_period': frame_period, 'num_jobs': len(jobs)}
+        pool = SharedModelPool(state, config.num_workers, config.worker_threads)
+        failed = []
+        for _, (task_failed, skipped) in pool.map(_convert_worker_task, tasks.values()):
+            failed.extend(task_failed)
+            shard_filter.skipped += skipped
+
+    print(f'{len(jobs) - len(failed)}/{len(jobs)} jobs done in {time.perf_counter() - start:.2f} s', flush=True)
+    if failed:
+        with open(failed_path, 'w') as f:
+            for src, trg, utterances in failed:
+                f.write(' '.join([src, trg] + (utterances or [])) + '\n')
+        raise Exception(f'{len(failed)} jobs failed, rerun them with --job_file {failed_path}')
+
+
+def convert_pairs(config, speakers, G, device, sampling_rate, num_mcep, frame_period, spk2emb, sp_enc, mcd_report = None):
     
+    # [1019 new feature]: this run converts the source utterances of its shard without a valid output yet
+    shard_filter = ShardFilter(config.shard, skip_existing = not config.overwrite)
+    # [1019 new feature]: chunked overlap-add inference, bounded memory for long utterances
+    if config.chunk_frames is not None:
+        if config.chunk_check and mcd_report is None:
+            mcd_report = MCDReport(G, sp_enc, name = 'chunked vs whole')
+        G = ChunkedGenerator(G, window = config.chunk_frames, overlap = config.chunk_overlap, batch_size = config.chunk_batch)
+
+    if config.fan_out_targets and not config.pipeline:
+        raise Exception('--fan_out_targets needs --pipeline')
+    if config.job_file is not None or config.num_workers is not None:
+        if config.pipeline or config.src_spk is not None or config.trg_spk is not None:
+            raise Exception('--job_file / --num_workers run the pairs of the job file or all pairs, without --pipeline / --src_spk / --trg_spk')
+        convert_jobs(config, speakers, G, device, sampling_rate, num_mcep, frame_period, spk2emb, sp_enc, mcd_report, shard_filter)
+        shard_filter.summary()
+        if mcd_report is not None:
+            mcd_report.summary()
+        return
+    if config.pipeline:
+        if config.src_spk is not None and config.trg_spk is not None:
+            loader_groups = [[TestDataset(config, speakers = speakers)]]
+        else:
+            # one analysis job per source utterance, fanned out to all target speakers
+            loader_groups = ([TestDataset(config, src_spk = src, trg_spk = trg, speakers = speakers) for trg in speakers if trg != src]
+                             for src in speakers[:25])
+        out_paths = convert_pipeline(config, loader_groups, G, device, sampling_rate, num_mcep, frame_period, spk2emb, sp_enc, mcd_report, shard_filter)
+        shard_filter.summary()
+        return out_paths
+
     all_pair_list = []
     if config.src_spk is not None and config.trg_spk is not None:
         
         test_loader = TestDataset(config, speakers = speakers)
-        pair_list = process_test_loader(test_loader, G, device, sampling_rate, num_mcep, frame_period, spk2emb,config, sp_enc)
+        pair_list = process_test_loader(test_loader, G, device, sampling_rate, num_mcep, frame_period, spk2emb,config, sp_enc, mcd_report, shard_filter = shard_filter)
         #all_pair_list.extend(pair_list)
     else:
         # convert all src_trg pairs len(speakers) * (len(speakers) -1) pairs
         #if config.num_workers is not None:
         #    futures = []
         #    executor = ProcessPoolExecutor(max_workers = config.num_workers)
+        # [1019 new feature]: source speaker major, each source utterance is analysed once for all targets
+        source_cache = SourceCache()
         for src in speakers[:25]:
             for trg in speakers:
                 if src != trg:
                     test_loader = TestDataset(config, src_spk = src, trg_spk = trg, speakers = speakers)
                     #if config.num_workers is None:
-                    _convert(test_loader, G, device, sampling_rate, num_mcep, frame_period, spk2emb, config, sp_enc)           
+                    _convert(test_loader, G, device, sampling_rate, num_mcep, frame_period, spk2emb, config, sp_enc, mcd_report, source_cache, shard_filter)
         
                     #else:
                     #    futures.append(
@@ -296,6 +851,12 @@ def test(config):
     #    for pair in all_pair_list:
     #        f.write(f'{pair[0]} {pair[1]}\n')
 
+        source_cache.summary()
+    shard_filter.summary()
+
+    if mcd_report is not None:
+        mcd_report.summary()
+
     """
     # Read a batch of testdata
     test_wavfiles = test_loader.get_batch_test_data(batch_size=config.num_converted_wavs)
@@ -350,11 +911,36 @@ if __name__ == '__main__':
     parser.add_argument('--trg_spk', type=str, default=None, help = 'target speaker.')
     parser.add_argument('--generator', type=str, default='Generator')
     parser.add_argument('--res_block', type=str, default='ResidualBlockSplit')
+    parser.add_argument('--stream_lookahead', type = int, default = 0, help = 'look-ahead frames of AdaGenStream')
+    parser.add_argument('--student_blocks', type = int, default = 3, help = 'residual blocks of a distilled AdaGenSlim')
+    parser.add_argument('--student_res_dim', type = int, default = 128, help = 'residual channels of a distilled AdaGenSlim')
+    parser.add_argument('--student_conv_dim', type = int, default = 64, help = 'down / up stack channels of a distilled AdaGenSlim')
+    parser.add_argument('--stream_chunk', type = int, default = None, help = 'convert in chunks of this many frames (multiple of 4) with AdaGenStream')
     parser.add_argument('--spenc', type = str, default = 'SPEncoder')
     parser.add_argument('--spk_cls', default = False, action = 'store_true')
     parser.add_argument('--drop_affine', default = True, action = 'store_false')
     parser.add_argument('--use_ema', default = False, action = 'store_true')
     parser.add_argument('--use_loudnorm', default = False, action = 'store_true')
+    parser.add_argument('--backend', type = str, default = 'torch', choices = ['torch', 'onnx'], help = 'run G and the speaker encoder with pytorch or onnxruntime (cpu)')
+    parser.add_argument('--onnx_dir', type = str, default = './onnx', help = 'exported graphs of export_onnx.py, if backend is onnx')
+    parser.add_argument('--onnx_threads', type = int, default = None, help = 'onnxruntime intra-op threads')
+    parser.add_argument('--onnx_check', default = False, action = 'store_true', help = 'also load the pytorch models and check the onnx outputs against them')
+    parser.add_argument('--convert_batch', type = int, default = 1, help = 'utterances per generator call, padded and masked (AdaGen / AdaGenSplit / AdaGenSlim with SPEncoder)')
+    parser.add_argument('--pipeline', default = False, action = 'store_true', help = 'overlap WORLD analysis / synthesis process pools with inference')
+    parser.add_argument('--analysis_workers', type = int, default = None, help = 'WORLD analysis processes of --pipeline, default half of the free cores')
+    parser.add_argument('--synthesis_workers', type = int, default = None, help = 'WORLD synthesis processes of --pipeline, default the other half')
+    parser.add_argument('--fan_out_targets', default = False, action = 'store_true', help = 'with --pipeline, convert each source utterance to up to --convert_batch targets per generator call')
+    parser.add_argument('--pipeline_queue', type = int, default = 16, help = 'utterances buffered between pipeline stages')
+    parser.add_argument('--job_file', type = str, default = None, help = 'convert the "src trg [utterance ...]" lines of this file in one process instead of all pairs')
+    parser.add_argument('--shard', type = str, default = None, help = 'i/N, convert the source utterances of shard i of N only')
+    parser.add_argument('--overwrite', default = False, action = 'store_true', help = 'convert again utterances that already have a complete converted wav')
+    parser.add_argument('--merge_pairs', default = False, action = 'store_true', help = 'no conversion, write the pair list of the finished all-pairs conversion to pair_list_path')
+    parser.add_argument('--chunk_frames', type = int, default = None, help = 'convert in overlapping windows of this many frames (multiple of 4), whole utterance if not set')
+    parser.add_argument('--chunk_overlap', type = int, default = 32, help = 'overlap of the chunk windows in frames (multiple of 4), crossfaded')
+    parser.add_argument('--chunk_batch', type = int, default = 8, help = 'chunk windows converted per batch')
+    parser.add_argument('--chunk_check', default = False, action = 'store_true', help = 'also convert whole utterances and report the MCD of the chunked output and at its seams')
+    parser.add_argument('--precision', type = str, default = 'fp32', choices = ['fp32', 'int8'], help = 'int8 runs the quantized graphs of export_onnx.py --quantize, onnx backend only')
+    parser.add_argument('--report_mcd', default = False, action = 'store_true', help = 'with int8 precision, also convert with the fp32 graphs and report the MCD between both')
     # Directories.
     parser.add_argument('--train_data_dir', type=str, default='./data/mc/train')
     parser.add_argument('--test_data_dir', type=str, default='./data/mc/test')
@@ -368,9 +954,13 @@ if __name__ == '__main__':
     #options
     parser.add_argument('--cpsyn', default = False, action = 'store_true')
     parser.add_argument('--use_spk_mean', default = False, action = 'store_true', help = 'compute mean of speaker embedding as use it as the input of Generator')
-    parser.add_argument('--spk_mean_dir', type = str, help = 'speaker embedding mean vector dir, if use_spk_mean is true')
+    parser.add_argument('--spk_mean_dir', type = str, default = None, help = 'speaker embedding mean vector dir, if use_spk_mean is true, built from the test mceps if not set')
+    parser.add_argument('--spk_table', default = False, action = 'store_true', help = 'target conditions from a per speaker embedding table, built once per speaker encoder checkpoint')
+    parser.add_argument('--spk_table_refs', type = int, default = 1, help = 'reference mceps averaged per speaker in the table, 0 for all')
+    parser.add_argument('--spk_table_dir', type = str, default = './spk_tables', help = 'dir of the saved speaker embedding tables')
     
-    parser.add_argument('--num_workers', type = int, default = None, help = 'multi-process')
+    parser.add_argument('--num_workers', type = int, default = None, help = 'convert the pairs in this many cpu worker processes sharing the model weights')
+    parser.add_argument('--worker_threads', type = int, default = None, help = 'torch threads (pinned cores) per worker, default the physical cores split between the workers')
     config = parser.parse_args()
     
     print(config, flush=True)
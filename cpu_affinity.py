@@ -0,0 +1,102 @@
+'''
+    Core partitioning for cpu-only nodes.
+    Torch intra-op threads, DataLoader / conversion worker processes and pyworld all compete for the same
+    cores. The helpers here split the cores available to this process between compute threads and
+    workers, pin every process to its share and set the torch thread pools accordingly.
+'''
+import os
+
+import torch
+
+
+def available_cores():
+    '''logical cpus this process is allowed to run on'''
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def physical_cores(cores):
+    '''keep one logical cpu per physical core, hyper-threading siblings share the same fpu'''
+    seen = set()
+    physical = []
+    for core in cores:
+        siblings_path = f'/sys/devices/system/cpu/cpu{core}/topology/thread_siblings_list'
+        try:
+            with open(siblings_path) as f:
+                siblings = f.read().strip()
+        except OSError:
+            siblings = str(core)
+        if siblings not in seen:
+            seen.add(siblings)
+            physical.append(core)
+    return physical
+
+
+class CorePlan(object):
+    '''cores assigned to torch compute threads and to worker processes'''
+
+    def __init__(self, compute_cores, worker_cores, num_workers, interop_threads = 1):
+        self.compute_cores = compute_cores
+        self.worker_cores = worker_cores
+        self.num_workers = num_workers
+        self.interop_threads = interop_threads
+
+    def __repr__(self):
+        return (f'CorePlan(compute_cores={self.compute_cores}, worker_cores={self.worker_cores}, '
+                f'num_workers={self.num_workers}, interop_threads={self.interop_threads})')
+
+
+def plan_cores(num_workers = None, compute_threads = None, interop_threads = 1):
+    '''
+        Split the available physical cores between compute threads and workers.
+        By default one worker per 8 physical cores (at least 1, at most 4) is used, data loading
+        is a np.load and a crop per sample so it needs far less than the model.
+    '''
+    cores = physical_cores(available_cores())
+    if num_workers is None:
+        num_workers = max(1, min(4, len(cores) // 8))
+    if len(cores) <= 1:
+        return CorePlan(cores, cores, num_workers, interop_threads)
+
+    num_worker_cores = min(num_workers, len(cores) - 1) if num_workers > 0 else 0
+    if compute_threads is None:
+        compute_threads = len(cores) - num_worker_cores
+    compute_threads = min(compute_threads, len(cores))
+
+    compute_cores = cores[:compute_threads]
+    worker_cores = cores[compute_threads:compute_threads + num_worker_cores]
+    if len(worker_cores) == 0:
+        # not enough cores left, share the last one
+        worker_cores = cores[-1:]
+    return CorePlan(compute_cores, worker_cores, num_workers, interop_threads)
+
+
+def pin_process(cores):
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+
+def setup_compute_process(plan):
+    '''pin the current (main) process to the compute cores and size the torch thread pools'''
+    pin_process(plan.compute_cores)
+    torch.set_num_threads(len(plan.compute_cores))
+    try:
+        torch.set_num_interop_threads(plan.interop_threads)
+    except RuntimeError:
+        # inter-op pool can only be sized before the first parallel region
+        print('inter-op threads already started, keep the default pool', flush=True)
+    print(f'cpu mode: {len(plan.compute_cores)} compute threads on cores {plan.compute_cores}, '
+          f'{plan.num_workers} workers on cores {plan.worker_cores}', flush=True)
+
+
+class WorkerAffinity(object):
+    '''worker_init_fn pinning each worker to one of the worker cores with a single torch thread'''
+
+    def __init__(self, worker_cores):
+        self.worker_cores = worker_cores
+
+    def __call__(self, worker_id):
+        core = self.worker_cores[worker_id % len(self.worker_cores)]
+        pin_process([core])
+        torch.set_num_threads(1)
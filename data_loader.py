@@ -57,6 +57,8 @@ class PairDataset(data.Dataset):
         super().__init__()
 
         self.min_length = min_length
+        # [1019 new feature]: crop length can be shorter than min_length for the crop curriculum
+        self.crop_length = min_length
         self.mc_files = []
         self.spk2files = {}
         self.speakers = speakers[:]
@@ -103,9 +105,14 @@ class PairDataset(data.Dataset):
                 break
         return new_mc_files
 
+    def set_crop_length(self, crop_length):
+        '''set the number of frames sampled from each utterance, all files are longer than min_length'''
+        assert crop_length <= self.min_length, f'crop length {crop_length} larger than min_length {self.min_length}'
+        self.crop_length = crop_length
+
     def sample_seg(self, feat, sample_len=None):
         if sample_len is None:
-            sample_len = self.min_length
+            sample_len = self.crop_length
         assert feat.shape[0] - sample_len >= 0
         s = np.random.randint(0, feat.shape[0] - sample_len + 1)
         return feat[s:s+sample_len, :]
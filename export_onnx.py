@@ -0,0 +1,83 @@
+'''
+    Export a trained generator and speaker encoder to ONNX for the onnxruntime backend of convert.py.
+    The exported graphs are checked against the pytorch models on random inputs before the script exits.
+'''
+import argparse
+import json
+import os
+from os.path import join
+
+import torch
+
+from stgan_adain.model import Generator as AdaGen
+from stgan_adain.model import GeneratorSplit as AdaGenSplit
+from stgan_adain.model import SPEncoder
+from stgan_adain.model import SPEncoderPool
+from stgan_adain.model import SPEncoderPool1D
+from stgan_adain.onnx_backend import export_generator, export_speaker_encoder, onnx_paths, verify_export
+from stgan_adain.onnx_backend import OnnxGenerator, OnnxSPEncoder
+from stgan_adain.onnx_backend import load_calibration_mcs, calibration_feeds, quantize_graph
+
+
+def load_models(config):
+    G = eval(config.generator)(num_speakers = config.num_speakers, aff = config.drop_affine, res_block_name = config.res_block)
+    sp_enc = eval(config.spenc)(num_speakers = config.num_speakers, spk_cls = config.spk_cls)
+
+    suffix = '.ema' if config.use_ema else ''
+    G_path = join(config.model_save_dir, f'{config.resume_iters}-G.ckpt{suffix}')
+    sp_path = join(config.model_save_dir, f'{config.resume_iters}-sp.ckpt{suffix}')
+    print(f'Loading the trained models from {G_path} and {sp_path}...', flush=True)
+    G.load_state_dict(torch.load(G_path, map_location=lambda storage, loc: storage))
+    sp_enc.load_state_dict(torch.load(sp_path, map_location=lambda storage, loc: storage))
+    return G.eval(), sp_enc.eval()
+
+
+def main(config):
+    os.makedirs(config.onnx_dir, exist_ok = True)
+    G, sp_enc = load_models(config)
+    G_path, sp_path = onnx_paths(config.onnx_dir, config.resume_iters, config.use_ema)
+
+    export_generator(G, G_path, opset = config.opset)
+    export_speaker_encoder(sp_enc, sp_path, opset = config.opset)
+
+    if config.check:
+        verify_export(G, sp_enc, OnnxGenerator(G_path), OnnxSPEncoder(sp_path), config.num_speakers, atol = config.check_atol)
+
+    # [1019 new feature]: int8 post training quantization, static mode calibrates on the test mceps
+    if config.quantize == 'static':
+        with open(config.speaker_path) as f:
+            speakers = json.load(f)
+        mcs = load_calibration_mcs(config.calib_dir, speakers, num_utts = config.calib_utts)
+        sp_feeds, G_feeds = calibration_feeds(sp_path, mcs)
+        quantize_graph(sp_path, 'static', sp_feeds)
+        quantize_graph(G_path, 'static', G_feeds)
+    elif config.quantize == 'dynamic':
+        quantize_graph(sp_path, 'dynamic')
+        quantize_graph(G_path, 'dynamic')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--num_speakers', type=int, default=10, help='dimension of speaker labels')
+    parser.add_argument('--resume_iters', type=int, required=True, help='step of the checkpoint to export')
+    parser.add_argument('--generator', type=str, default='AdaGen', choices=['AdaGen', 'AdaGenSplit'])
+    parser.add_argument('--res_block', type=str, default='ResidualBlockSplit')
+    parser.add_argument('--spenc', type = str, default = 'SPEncoder')
+    parser.add_argument('--spk_cls', default = False, action = 'store_true')
+    parser.add_argument('--drop_affine', default = True, action = 'store_false')
+    parser.add_argument('--use_ema', default = False, action = 'store_true')
+    parser.add_argument('--opset', type = int, default = 13)
+    parser.add_argument('--no_check', dest = 'check', default = True, action = 'store_false', help = 'skip the onnxruntime vs pytorch check')
+    parser.add_argument('--check_atol', type = float, default = 1e-3)
+    parser.add_argument('--quantize', type = str, default = 'none', choices = ['none', 'dynamic', 'static'], help = 'also write int8 graphs (*.int8.onnx)')
+    parser.add_argument('--calib_dir', type = str, default = './data/mc/test', help = 'mcep dir used to calibrate static quantization')
+    parser.add_argument('--calib_utts', type = int, default = 32, help = 'number of calibration utterances')
+    parser.add_argument('--speaker_path', type = str, default = None, help = 'speaker list, speaker labels of the calibration mceps')
+
+    parser.add_argument('--model_save_dir', type=str, default='./models')
+    parser.add_argument('--onnx_dir', type=str, default='./onnx')
+
+    config = parser.parse_args()
+    print(config, flush=True)
+    main(config)
@@ -5,6 +5,9 @@ from data_loader import PairDataset, PairTestDataset
 from torch.backends import cudnn
 import json
 from torch.utils import data
+from cpu_affinity import plan_cores, setup_compute_process, WorkerAffinity
+from stgan_adain.stylegan2_module import set_modconv_impl
+from stgan_adain.fused_ops import set_fused_ops
 
 def str2bool(v):
     return v.lower() in ('true')
@@ -27,14 +30,26 @@ def main(config):
         speakers = json.load(f)
     print(f"load speakers {speakers}", flush=True)
     
+    # [1019 new feature]: modulated conv implementation of the Style2 blocks, auto picks the fastest per shape
+    set_modconv_impl(config.modconv_impl)
+    set_fused_ops(config.fused_ops)
+
     # Data loader.
     #train_loader = get_loader(config.train_data_dir, config.batch_size, config.min_length, 'train', speakers, num_workers=config.num_workers,)
     
+    # [1019 new feature]: cpu training mode, split cores between torch threads and loader workers
+    num_workers, worker_init_fn = config.num_workers, None
+    if config.cpu_mode:
+        plan = plan_cores(num_workers = config.cpu_workers, compute_threads = config.cpu_threads, interop_threads = config.cpu_interop_threads)
+        setup_compute_process(plan)
+        num_workers, worker_init_fn = plan.num_workers, WorkerAffinity(plan.worker_cores)
+
     train_dataset = PairDataset(config.train_data_dir, speakers, config.min_length, config.few_shot)
     train_loader = data.DataLoader(dataset=train_dataset,
                                   batch_size=config.batch_size,
                                   shuffle=(config.mode=='train'),
-                                  num_workers=config.num_workers,
+                                  num_workers=num_workers,
+                                  worker_init_fn=worker_init_fn,
                                   drop_last=True)
     
     test_loader = PairTestDataset(config.test_data_dir, config.wav_dir, speakers, src_spk=config.test_src_spk, trg_spk=config.test_trg_spk)
@@ -44,6 +59,8 @@ def main(config):
 
     if config.mode == 'train':    
         solver.train()
+    elif config.mode == 'distill':
+        solver.distill()
 
     # elif config.mode == 'test':
     #     solver.test()
@@ -68,9 +85,23 @@ if __name__ == '__main__':
     parser.add_argument('--drop_affine', default = True, action = 'store_false', help = 'use affine in Generator IN layers')   
     parser.add_argument('--generator', type = str, default = 'Generator')
     parser.add_argument('--res_block', type = str, default = 'ResidualBlockSplit')
+    parser.add_argument('--stream_lookahead', type = int, default = 0, help = 'look-ahead frames of GeneratorStream (use with --res_block StreamResidualBlock), at most 8')
+    # [1019 new feature]: distillation of a slim student (--generator GeneratorSlim --mode distill) from a trained teacher
+    parser.add_argument('--student_blocks', type = int, default = 3, help = 'residual blocks of GeneratorSlim')
+    parser.add_argument('--student_res_dim', type = int, default = 128, help = 'channels of the GeneratorSlim residual blocks')
+    parser.add_argument('--student_conv_dim', type = int, default = 64, help = 'channels of the GeneratorSlim down / up stacks')
+    parser.add_argument('--teacher_dir', type = str, default = None, help = 'model dir of the teacher checkpoints')
+    parser.add_argument('--teacher_iters', type = int, default = None, help = 'step of the teacher checkpoints')
+    parser.add_argument('--teacher_generator', type = str, default = 'Generator')
+    parser.add_argument('--teacher_res_block', type = str, default = 'ResidualBlockSplit')
+    parser.add_argument('--teacher_ema', default = False, action = 'store_true', help = 'distill from the ema teacher')
+    parser.add_argument('--lambda_distill_spk', type = float, default = 1, help = 'weight for the speaker embedding distillation loss')
     # Training configuration.
     parser.add_argument('--batch_size', type=int, default=8, help='mini-batch size')
     parser.add_argument('--min_length', type=int, default=256 )
+    parser.add_argument('--crop_schedule', type=str, default=None, help='crop curriculum crop:until_step,... e.g. 64:10000,128:30000, min_length afterwards')
+    parser.add_argument('--grad_checkpoint', type=str, default=None, help='checkpoint activations of generator segments down,res,up (any subset), trades G step time for memory')
+    parser.add_argument('--crop_max_batch', type=int, default=None, help='upper bound of the batch size grown by the crop curriculum')
     parser.add_argument('--num_iters', type=int, default=500000, help='number of total iterations for training D')
     parser.add_argument('--drop_id_step', type = int, default = 10000, help = 'steps drop id mapping loss')
     parser.add_argument('--num_iters_decay', type=int, default=100000, help='number of iterations for decaying lr')
@@ -91,8 +122,15 @@ if __name__ == '__main__':
 
     # Miscellaneous.
     parser.add_argument('--num_workers', type=int, default=1)
-    parser.add_argument('--mode', type=str, default='train', choices=['train', 'test'])
+    parser.add_argument('--cpu_mode', default=False, action='store_true', help='train on cpu, pin compute threads and loader workers to separate cores')
+    parser.add_argument('--cpu_threads', type=int, default=None, help='torch intra-op threads in cpu mode, default all cores not used by workers')
+    parser.add_argument('--cpu_workers', type=int, default=None, help='loader workers in cpu mode, default picked from the core count')
+    parser.add_argument('--cpu_interop_threads', type=int, default=1, help='torch inter-op threads in cpu mode')
+    parser.add_argument('--no_fused_ops', dest='fused_ops', default=True, action='store_false', help='unfused AdaIN and GLU in the residual blocks')
+    parser.add_argument('--modconv_impl', type=str, default='auto', choices=['auto', 'grouped', 'fused', 'bmm'], help='modulated conv implementation of the Style2 blocks')
+    parser.add_argument('--mode', type=str, default='train', choices=['train', 'test', 'distill'])
     parser.add_argument('--use_tensorboard', type=str2bool, default=True)
+    parser.add_argument('--metric_sink', type=str, default='tensorboard', choices=['tensorboard', 'jsonl'], help='where the metric sink writes losses if use_tensorboard')
 
     # Directories.
     parser.add_argument('--train_data_dir', type=str, default='./data/mc/train')
@@ -107,6 +145,14 @@ if __name__ == '__main__':
     parser.add_argument('--sample_step', type=int, default=1000)
     parser.add_argument('--model_save_step', type=int, default=1000)
     parser.add_argument('--lr_update_step', type=int, default=1000)
+
+    # Profiling.
+    parser.add_argument('--profile', default = False, action = 'store_true', help = 'time every phase of Solver.train and dump json lines')
+    parser.add_argument('--profile_path', type = str, default = None, help = 'profile json lines file, default log_dir/profile.jsonl')
+    parser.add_argument('--profile_window', type = int, default = 100, help = 'number of steps for rolling averages')
+    parser.add_argument('--profile_sync', type = str2bool, default = True, help = 'synchronize cuda at phase boundaries')
+    parser.add_argument('--profile_trace_start', type = int, default = None, help = 'step to start a torch.profiler trace')
+    parser.add_argument('--profile_trace_steps', type = int, default = 5, help = 'number of steps to trace')
     
     config = parser.parse_args()
     print(config)
@@ -59,32 +59,36 @@ then
                         #--use_ema
 
 else
-    for src in p232 p229 p262 p272 p293 p251 p360 p361 p292 p248
+    # one process for all pairs, the models are loaded once
+    job_file=$exp/convert_jobs.txt
+    spks="p232 p229 p262 p272 p293 p251 p360 p361 p292 p248"
+    > $job_file
+    for src in $spks
     do
-        for trg in p232 p229 p262 p272 p293 p251 p360 p361 p292 p248
+        for trg in $spks
         do
             if [ $src != $trg ]
             then
-                $PYTHON $root/vc_gan/convert.py \
-                                    --wav_dir $root/resmp_wav22050 \
-                                    --model_save_dir ${exp}/ckpt/ \
-                                    --resume_iters $iters \
-                                    --train_data_dir $mc_dir/train/ \
-                                    --test_data_dir $mc_dir/test/ \
-                                    --convert_dir $exp/converted_samples_loudnorm1/ \
-                                    --num_speakers $num_spks \
-                                    --generator $generator_model\
-                                    --res_block $res_block \
-                                    --spenc $speaker_encoder_model\
-                                    --sample_rate 22050 \
-                                    --speaker_path $mc_dir/speaker_used.json \
-                                    --pair_list_path $exp/pair_list.txt\
-                                    --num_converted_wavs 10 \
-                                    --src_spk $src \
-                                    --trg_spk $trg \
-                                    --use_loudnorm \
-                                    --use_ema 
+                echo "$src $trg" >> $job_file
             fi
         done
     done
+    $PYTHON $root/vc_gan/convert.py \
+                        --wav_dir $root/resmp_wav22050 \
+                        --model_save_dir ${exp}/ckpt/ \
+                        --resume_iters $iters \
+                        --train_data_dir $mc_dir/train/ \
+                        --test_data_dir $mc_dir/test/ \
+                        --convert_dir $exp/converted_samples_loudnorm1/ \
+                        --num_speakers $num_spks \
+                        --generator $generator_model\
+                        --res_block $res_block \
+                        --spenc $speaker_encoder_model\
+                        --sample_rate 22050 \
+                        --speaker_path $mc_dir/speaker_used.json \
+                        --pair_list_path $exp/pair_list.txt\
+                        --num_converted_wavs 10 \
+                        --job_file $job_file \
+                        --use_loudnorm \
+                        --use_ema 
 fi
@@ -0,0 +1,86 @@
+'''
+    [1019 new feature]: local conversion server on the convert.py inference path
+
+    The models, speaker statistics and target embedding table are loaded once, concurrent requests are converted
+    in micro-batches (see stgan_adain/conversion_server.py for the HTTP API).
+
+    python serve_convert.py --model_save_dir exp/ckpt --resume_iters 200000 --speaker_path speaker_used.json \
+        --train_data_dir mc/train --test_data_dir mc/test --generator AdaGenSplit --sample_rate 22050
+    curl --data-binary @p225_001.wav 'http://127.0.0.1:8000/convert?src=p225&trg=p226' -o converted.wav
+'''
+import argparse
+import json
+
+import torch
+
+from convert import batched_generator, load_models
+from stgan_adain.conversion_server import ConversionService, ServedModels, serve
+from stgan_adain.speaker_table import load_speaker_table
+
+
+def model_loader(config, speakers, device, frame_period):
+    '''iters -> ServedModels of that checkpoint step'''
+    def load(iters):
+        step_config = argparse.Namespace(**vars(config))
+        step_config.resume_iters = iters
+        print(f'Loading the trained models from step {iters}...', flush=True)
+        G, sp_enc, sp_path = load_models(step_config, device, frame_period)
+        if sp_enc is None or batched_generator(G, sp_enc) is None:
+            raise Exception(f'the server converts masked batches, AdaGen / AdaGenSplit / AdaGenSlim with SPEncoder only, got {config.generator} {config.spenc}')
+        # target (and with use_spk_mean source) conditions of every speaker, built once per speaker encoder checkpoint
+        num_refs = 0 if config.use_spk_mean else config.spk_table_refs
+        spk2emb = load_speaker_table(sp_enc, sp_path, speakers, config.test_data_dir, config.spk_table_dir, num_refs, device)
+        return ServedModels(iters, G, sp_enc, spk2emb)
+    return load
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    # Model configuration.
+    parser.add_argument('--num_speakers', type=int, default=10, help='dimension of speaker labels')
+    parser.add_argument('--sample_rate', type=int, default=16000, help='sample rate')
+    parser.add_argument('--resume_iters', type=int, default=None, help='step to serve at startup')
+    parser.add_argument('--generator', type=str, default='AdaGenSplit')
+    parser.add_argument('--res_block', type=str, default='ResidualBlockSplit')
+    parser.add_argument('--student_blocks', type = int, default = 3, help = 'residual blocks of a distilled AdaGenSlim')
+    parser.add_argument('--student_res_dim', type = int, default = 128, help = 'residual channels of a distilled AdaGenSlim')
+    parser.add_argument('--student_conv_dim', type = int, default = 64, help = 'down / up stack channels of a distilled AdaGenSlim')
+    parser.add_argument('--stream_lookahead', type = int, default = 0)
+    parser.add_argument('--stream_chunk', type = int, default = None)
+    parser.add_argument('--spenc', type = str, default = 'SPEncoder')
+    parser.add_argument('--spk_cls', default = False, action = 'store_true')
+    parser.add_argument('--drop_affine', default = True, action = 'store_false')
+    parser.add_argument('--use_ema', default = False, action = 'store_true')
+    parser.add_argument('--use_loudnorm', default = False, action = 'store_true')
+    parser.add_argument('--use_spk_mean', default = False, action = 'store_true', help = 'source conditions from the speaker table instead of the source utterance')
+    # Directories.
+    parser.add_argument('--train_data_dir', type=str, default='./data/mc/train', help = 'speaker statistics')
+    parser.add_argument('--test_data_dir', type=str, default='./data/mc/test', help = 'reference mceps of the speaker table')
+    parser.add_argument('--model_save_dir', type=str, default='./models')
+    parser.add_argument('--speaker_path', type = str, required = True)
+    parser.add_argument('--spk_table_refs', type = int, default = 1, help = 'reference mceps averaged per speaker in the table, 0 for all')
+    parser.add_argument('--spk_table_dir', type = str, default = './spk_tables', help = 'dir of the saved speaker embedding tables')
+    # Server.
+    parser.add_argument('--host', type = str, default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8000)
+    parser.add_argument('--unix_socket', type = str, default = None, help = 'serve on this unix socket instead of host:port')
+    parser.add_argument('--max_batch', type = int, default = 8, help = 'requests per generator call')
+    parser.add_argument('--max_wait_ms', type = float, default = 10., help = 'longest wait for a batch to fill after its first request')
+    parser.add_argument('--threads', type = int, default = None, help = 'torch intra-op threads')
+    config = parser.parse_args()
+
+    print(config, flush=True)
+    if config.resume_iters is None:
+        raise RuntimeError("Please specify the step number to serve.")
+    if config.threads is not None:
+        torch.set_num_threads(config.threads)
+
+    with open(config.speaker_path) as f:
+        speakers = json.load(f)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    frame_period = 5
+    service = ConversionService(model_loader(config, speakers, device, frame_period), config.resume_iters, speakers, config.train_data_dir,
+                                config.sample_rate, frame_period = frame_period, max_batch = config.max_batch, max_wait = config.max_wait_ms / 1000,
+                                use_loudnorm = config.use_loudnorm, use_spk_mean = config.use_spk_mean, device = device)
+    serve(service, config.host, config.port, config.unix_socket)
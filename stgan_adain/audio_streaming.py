@@ -0,0 +1,338 @@
+'''
+    [1019 new feature]: end-to-end streaming conversion of audio chunks
+
+    StreamingVoiceConverter.push(samples) takes PCM chunks of any size and returns the converted samples that
+    are ready, flush() returns the rest at the end of the stream. Three incremental stages:
+
+    StreamingAnalyzer      frame-synchronous WORLD analysis (harvest / cheaptrick / d4c as utils.world_decompose).
+                           A frame is analysed once lookahead_ms of audio after it has arrived, step_frames frames
+                           at a time, on a block that also holds context_ms of audio before the first new frame,
+                           the frames of the block before it are dropped.
+    WindowedConverter      non-causal generators (AdaGen, AdaGenSplit, ...) on overlapping frame windows: each step
+                           converts context + overlap + chunk + lookahead frames, emits chunk frames and crossfades
+                           the overlap frames with the held back output of the previous window.
+                           AdaGenStream runs on its own causal chunks with streaming.StreamingConverter instead.
+    IncrementalSynthesizer WORLD synthesis of each block of converted frames, started overlap frames early and
+                           crossfaded (overlap-add) with the held back end of the previous block. The pulse train
+                           of a block starts with its own phase, the crossfade hides the phase jump.
+
+    Every stage holds back a fixed number of frames, the converted audio lags the input by at most
+    latency_bound_ms() (plus the size of the input chunks and the compute time of a push).
+    Loudness normalization needs the whole utterance and is not applied.
+'''
+import time
+from fractions import Fraction
+
+import numpy as np
+import torch
+
+from utils import pitch_conversion, world_decompose, world_encode_spectral_envelop, world_speech_synthesis
+from stgan_adain.streaming import StreamingConverter
+
+
+class FrameGrid(object):
+    '''
+        WORLD frame k is at sample k * hop, hop = fs * frame_period / 1000 can be fractional (22050 Hz, 5 ms).
+        Analysis / synthesis blocks start on frames that are multiples of align, where the frame time is a whole sample.
+    '''
+
+    def __init__(self, fs, frame_period):
+        self.fs = fs
+        self.frame_period = frame_period
+        self.hop = Fraction(fs) * Fraction(frame_period).limit_denominator(1000) / 1000
+        self.align = self.hop.denominator
+
+    def sample(self, frame):
+        return int(frame * self.hop)
+
+    def frames_until(self, num_samples):
+        '''frames whose time is within the first num_samples samples'''
+        return int(num_samples / self.hop) + 1 if num_samples > 0 else 0
+
+    def align_down(self, frame):
+        return max(0, frame - frame % self.align)
+
+
+class StreamingAnalyzer(object):
+    '''PCM samples in, (f0, coded_sp, ap) of the frames that are ready out'''
+
+    def __init__(self, fs, frame_period = 5, num_mcep = 36, context_ms = 200, lookahead_ms = 40, step_frames = 16):
+        self.grid = FrameGrid(fs, frame_period)
+        self.num_mcep = num_mcep
+        self.step_frames = step_frames
+        self.context_frames = int(np.ceil(context_ms / frame_period))
+        self.lookahead_samples = int(np.ceil(lookahead_ms * fs / 1000))
+        self.buffer = np.zeros(0, dtype = np.float64)
+        self.buffer_start = 0
+        self.num_samples = 0
+        self.next_frame = 0
+
+    def _analyse(self, end_frame):
+        '''analyse frames [next_frame, end_frame) on a block with the context before them'''
+        grid = self.grid
+        block_frame = grid.align_down(self.next_frame - self.context_frames)
+        block = self.buffer[grid.sample(block_frame) - self.buffer_start:]
+        f0, _, sp, ap = world_decompose(wav = block, fs = grid.fs, frame_period = grid.frame_period)
+        first, last = self.next_frame - block_frame, end_frame - block_frame
+        coded_sp = world_encode_spectral_envelop(sp = np.ascontiguousarray(sp[first: last]), fs = grid.fs, dim = self.num_mcep)
+        out = f0[first: last], coded_sp, ap[first: last]
+        self.next_frame = end_frame
+
+        # drop the audio no later block needs
+        keep_from = grid.sample(grid.align_down(self.next_frame - self.context_frames))
+        self.buffer = self.buffer[keep_from - self.buffer_start:]
+        self.buffer_start = keep_from
+        return out
+
+    def push(self, samples):
+        self.buffer = np.concatenate([self.buffer, np.asarray(samples, dtype = np.float64)])
+        self.num_samples += len(samples)
+        end_frame = self.grid.frames_until(self.num_samples - self.lookahead_samples)
+        # a harvest call has a large fixed cost, analyse step_frames or more at a time
+        if end_frame < self.next_frame + self.step_frames:
+            return None
+        return self._analyse(end_frame)
+
+    def flush(self):
+        '''the last frames, analysed up to the end of the stream (as many frames as a whole file analysis)'''
+        end_frame = self.grid.frames_until(self.num_samples)
+        if end_frame <= self.next_frame:
+            return None
+        return self._analyse(end_frame)
+
+    def latency_frames(self):
+        return int(np.ceil(self.lookahead_samples / self.grid.hop)) + self.step_frames - 1
+
+
+class WindowedConverter(object):
+    '''
+        StreamingConverter interface (push / flush of 1 1 36 n normalized mcep frames) for the non-causal
+        generators, G(x, c_src, c_trg) on windows of context + overlap + chunk + lookahead frames
+    '''
+
+    def __init__(self, G, c_src, c_trg, chunk_size = 16, context = 64, overlap = 8, lookahead = 8):
+        if any(n % 4 != 0 for n in (chunk_size, context, overlap, lookahead)):
+            raise Exception(f'stream chunk {chunk_size}, context {context}, overlap {overlap} and lookahead {lookahead} must be multiples of 4')
+        if overlap > chunk_size:
+            raise Exception(f'stream overlap {overlap} larger than the chunk {chunk_size}')
+        self.G = G
+        self.c_src = c_src
+        self.c_trg = c_trg
+        self.chunk_size = chunk_size
+        self.context = context
+        self.overlap = overlap
+        self.lookahead = lookahead
+        self.buffer = None
+        self.buffer_start = 0
+        self.num_in = 0
+        self.emitted = 0
+        self.tail = None
+
+    def _window(self, end):
+        '''converted frames [emitted, end) of the window ending at end'''
+        start = max(self.buffer_start, end - self.context - self.overlap - self.chunk_size - self.lookahead)
+        x = self.buffer[..., start - self.buffer_start: end - self.buffer_start]
+        pad = (-x.size(-1)) % 4
+        if pad:
+            x = torch.cat([x, x.new_zeros(*x.size()[:-1], pad)], dim = -1)
+        with torch.no_grad():
+            y = self.G(x, self.c_src, self.c_trg)
+        return y[..., self.emitted - start: end - start]
+
+    def _crossfade(self, y):
+        if self.tail is None:
+            return y
+        fade = (torch.arange(self.tail.size(-1), dtype = y.dtype, device = y.device) + 0.5) / self.tail.size(-1)
+        n = min(self.tail.size(-1), y.size(-1))
+        return torch.cat([self.tail[..., :n] * (1 - fade[:n]) + y[..., :n] * fade[:n], y[..., n:]], dim = -1)
+
+    def _drop(self):
+        # the next window starts context frames before the next chunk
+        keep_from = max(0, self.emitted - self.context)
+        self.buffer = self.buffer[..., keep_from - self.buffer_start:]
+        self.buffer_start = keep_from
+
+    def push(self, mc):
+        self.buffer = mc if self.buffer is None else torch.cat([self.buffer, mc], dim = -1)
+        self.num_in += mc.size(-1)
+        outs = []
+        while self.num_in >= self.emitted + self.chunk_size + self.overlap + self.lookahead:
+            y = self._crossfade(self._window(self.emitted + self.chunk_size + self.overlap + self.lookahead))
+            outs.append(y[..., :self.chunk_size])
+            self.tail = y[..., self.chunk_size: self.chunk_size + self.overlap] if self.overlap else None
+            self.emitted += self.chunk_size
+            self._drop()
+        if len(outs) == 0:
+            return mc.new_zeros(*mc.size()[:-1], 0)
+        return torch.cat(outs, dim = -1)
+
+    def flush(self):
+        if self.buffer is None or self.emitted >= self.num_in:
+            return None
+        y = self._crossfade(self._window(self.num_in))
+        self.emitted = self.num_in
+        self.tail = None
+        return y
+
+    def latency_frames(self):
+        return self.chunk_size + self.overlap + self.lookahead
+
+
+class IncrementalSynthesizer(object):
+    '''
+        (f0, coded_sp, ap) frames in, PCM samples out. Audio up to overlap frames before the last frame is emitted,
+        the rest is held back. The next block is synthesized from the first held back frame on and crossfaded
+        with the held back audio.
+    '''
+
+    def __init__(self, fs, frame_period = 5, overlap = 8):
+        self.grid = FrameGrid(fs, frame_period)
+        self.overlap = overlap
+        self.frames = None
+        self.frames_start = 0
+        self.num_frames = 0
+        # audio is emitted up to sample emitted, the frame of that sample is emitted_frame
+        self.emitted = 0
+        self.emitted_frame = 0
+        self.tail = np.zeros(0, dtype = np.float32)
+
+    def _synthesize(self, final = False):
+        grid = self.grid
+        block_frame = grid.align_down(self.emitted_frame)
+        f0, coded_sp, ap = (np.ascontiguousarray(param[block_frame - self.frames_start:]) for param in self.frames)
+        wav = world_speech_synthesis(f0 = f0, coded_sp = coded_sp, ap = ap, fs = grid.fs, frame_period = grid.frame_period)
+        head = wav[self.emitted - grid.sample(block_frame):]
+
+        # overlap-add with the held back end of the previous block
+        n = min(len(self.tail), len(head))
+        fade = (np.arange(len(self.tail), dtype = np.float32) + 0.5) / max(len(self.tail), 1)
+        head = np.concatenate([self.tail[:n] * (1 - fade[:n]) + head[:n] * fade[:n], head[n:]])
+
+        end_frame = self.num_frames if final else self.num_frames - self.overlap
+        emit = len(head) if final else min(max(0, grid.sample(end_frame) - self.emitted), len(head))
+        out, self.tail = head[:emit], head[emit:]
+        self.emitted += emit
+        self.emitted_frame = end_frame
+
+        keep_from = grid.align_down(self.emitted_frame)
+        self.frames = tuple(param[keep_from - self.frames_start:] for param in self.frames)
+        self.frames_start = keep_from
+        return out
+
+    def push(self, f0, coded_sp, ap):
+        new = (f0, coded_sp, ap)
+        self.frames = new if self.frames is None else tuple(np.concatenate([old, param]) for old, param in zip(self.frames, new))
+        self.num_frames += len(f0)
+        # at least overlap new frames per block, so the held back audio is crossfaded once
+        if self.num_frames < self.emitted_frame + 2 * self.overlap + 1:
+            return np.zeros(0, dtype = np.float32)
+        return self._synthesize()
+
+    def flush(self):
+        if self.frames is None:
+            return np.zeros(0, dtype = np.float32)
+        return self._synthesize(final = True)
+
+    def latency_frames(self):
+        # a block waits for 2 * overlap + 1 frames past the emitted audio, overlap of them stay held back
+        return 2 * self.overlap + 1
+
+
+class StreamingVoiceConverter(object):
+    '''
+        PCM chunks of the src speaker in, PCM of the trg speaker out.
+        converter: StreamingConverter or WindowedConverter on normalized mcep frames of G.
+        src_stats / trg_stats: the {spk}_stats.npz arrays of the speakers.
+    '''
+
+    def __init__(self, converter, src_stats, trg_stats, fs, frame_period = 5, num_mcep = 36,
+                 analysis_context_ms = 200, analysis_lookahead_ms = 40, analysis_step = 16, synthesis_overlap = 8, device = torch.device('cpu')):
+        self.converter = converter
+        self.src_stats = src_stats
+        self.trg_stats = trg_stats
+        self.fs = fs
+        self.frame_period = frame_period
+        self.device = device
+        self.analyzer = StreamingAnalyzer(fs, frame_period, num_mcep, analysis_context_ms, analysis_lookahead_ms, analysis_step)
+        self.synthesizer = IncrementalSynthesizer(fs, frame_period, synthesis_overlap)
+        # source frames waiting for their converted mceps
+        self.pending = None
+        self.num_in = 0
+        self.num_out = 0
+        self.latencies = []
+        self.compute_time = 0.
+
+    def latency_bound_ms(self):
+        '''algorithmic latency, input audio that can be waiting for its converted audio'''
+        frames = self.analyzer.latency_frames() + self.converter.latency_frames() + self.synthesizer.latency_frames()
+        # frames are emitted whole, plus up to align frames of block alignment and a frame of hop rounding
+        return (frames + self.synthesizer.grid.align + 1) * self.frame_period
+
+    def _convert(self, analysed, flush):
+        if analysed is not None:
+            f0, coded_sp, ap = analysed
+            coded_sp_norm = (coded_sp - self.src_stats['coded_sps_mean']) / self.src_stats['coded_sps_std']
+            mc = torch.FloatTensor(coded_sp_norm.T).unsqueeze_(0).unsqueeze_(1).to(self.device)
+            converted = self.converter.push(mc)
+            f0_converted = np.asarray(pitch_conversion(f0 = f0, mean_log_src = self.src_stats['log_f0s_mean'], std_log_src = self.src_stats['log_f0s_std'],
+                                                       mean_log_target = self.trg_stats['log_f0s_mean'], std_log_target = self.trg_stats['log_f0s_std']))
+            pending = (f0_converted, ap)
+            self.pending = pending if self.pending is None else tuple(np.concatenate([old, new]) for old, new in zip(self.pending, pending))
+        else:
+            converted = None
+        if flush:
+            rest = self.converter.flush()
+            if rest is not None:
+                converted = rest if converted is None else torch.cat([converted, rest], dim = -1)
+        if converted is None or converted.size(-1) == 0:
+            return np.zeros(0, dtype = np.float32)
+
+        # the converted frames come out in order, pair them with the oldest pending source frames
+        n = converted.size(-1)
+        coded_sp_converted = np.squeeze(converted.data.cpu().numpy(), axis = (0, 1)).T * self.trg_stats['coded_sps_std'] + self.trg_stats['coded_sps_mean']
+        f0_converted, ap = (param[:n] for param in self.pending)
+        self.pending = tuple(param[n:] for param in self.pending)
+        return self.synthesizer.push(np.ascontiguousarray(f0_converted), np.ascontiguousarray(coded_sp_converted), np.ascontiguousarray(ap))
+
+    def push(self, samples):
+        start = time.perf_counter()
+        self.num_in += len(samples)
+        out = self._convert(self.analyzer.push(samples), flush = False)
+        self.num_out += len(out)
+        self.compute_time += time.perf_counter() - start
+        self.latencies.append(((self.num_in - self.num_out) * 1000 / self.fs, (time.perf_counter() - start) * 1000))
+        return out
+
+    def flush(self):
+        start = time.perf_counter()
+        out = self._convert(self.analyzer.flush(), flush = True)
+        # WORLD synthesis ends on the last frame, trim it to the length of the input
+        out = np.concatenate([out, self.synthesizer.flush()])[:max(0, self.num_in - self.num_out)]
+        self.num_out += len(out)
+        self.compute_time += time.perf_counter() - start
+        return out
+
+    def report(self):
+        '''latency statistics of the pushes so far, buffered: input audio not converted yet when a push returns'''
+        buffered = np.array([latency for latency, _ in self.latencies])
+        compute = np.array([latency for _, latency in self.latencies])
+        total = buffered + compute
+        duration = self.num_in / self.fs
+        return {
+            'latency_bound_ms': self.latency_bound_ms(),
+            'buffered_ms_max': float(buffered.max()) if len(buffered) else 0.,
+            'buffered_ms_mean': float(buffered.mean()) if len(buffered) else 0.,
+            'latency_ms_p50': float(np.percentile(total, 50)) if len(total) else 0.,
+            'latency_ms_max': float(total.max()) if len(total) else 0.,
+            'push_compute_ms_mean': float(compute.mean()) if len(compute) else 0.,
+            'real_time_factor': self.compute_time / max(duration, 1e-9),
+            'input_s': duration,
+            'output_s': self.num_out / self.fs,
+        }
+
+
+def frame_converter(G, c_src, c_trg, chunk_size = 16, context = 64, overlap = 8, lookahead = 8):
+    '''StreamingConverter for the causal AdaGenStream, WindowedConverter for the other generators'''
+    if hasattr(G, 'stream_step'):
+        return StreamingConverter(G, c_src, c_trg, chunk_size = chunk_size)
+    return WindowedConverter(G, c_src, c_trg, chunk_size, context, overlap, lookahead)
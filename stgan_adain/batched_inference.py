@@ -0,0 +1,140 @@
+'''
+    [1019 new feature]: batched multi-utterance conversion
+
+    Utterances of different lengths are zero padded at the end to a shared length (a multiple of 4) and
+    converted in one generator / speaker encoder call. Padding must not change the result of an utterance:
+      - every conv input is multiplied by the length mask of its resolution, so a conv sees zeros past
+        the end of an utterance, exactly as the zero padding of the unbatched conv
+      - instance norm / AdaIN statistics and the speaker encoder mean / std pooling only use valid frames
+    Each utterance is first padded to a multiple of 4 on its own, then a batch is converted to the same
+    frames as G(utterance) on that padded utterance.
+
+    MaskedGenerator supports Generator, GeneratorSplit and GeneratorSlim with ResidualBlock(Split) and
+    Style2 residual blocks, masked_speaker_encoder supports SPEncoder.
+'''
+import torch
+import torch.nn as nn
+
+from stgan_adain.model import AdaptiveInstanceNormalisation
+
+
+def length_mask(lengths, num_frames):
+    '''b 1 T float mask of the valid frames'''
+    steps = torch.arange(num_frames, device = lengths.device)
+    return (steps.unsqueeze(0) < lengths.unsqueeze(1)).unsqueeze(1).float()
+
+
+def _expand_mask(mask, x):
+    '''b 1 T mask broadcast to b c T or b c h T'''
+    return mask.view(mask.size(0), 1, *([1] * (x.dim() - 3)), mask.size(-1))
+
+
+def masked_stats(x, mask, unbiased = False):
+    '''mean and variance over the non channel dims of the valid frames, b c 1 (1)'''
+    mask = _expand_mask(mask, x)
+    dims = tuple(range(2, x.dim()))
+    count = mask.sum(dim = dims, keepdim = True) * (x[0, 0].numel() // x.size(-1))
+    mean = (x * mask).sum(dim = dims, keepdim = True) / count
+    var = (((x - mean) * mask) ** 2).sum(dim = dims, keepdim = True) / (count - 1 if unbiased else count)
+    return mean, var
+
+
+def masked_instance_norm(x, mask, norm):
+    '''nn.InstanceNorm1d / 2d (no running stats) over the valid frames'''
+    mean, var = masked_stats(x, mask)
+    x = (x - mean) * torch.rsqrt(var + norm.eps)
+    if norm.affine:
+        shape = (1, -1) + (1,) * (x.dim() - 2)
+        x = x * norm.weight.view(shape) + norm.bias.view(shape)
+    return x
+
+
+def pad_batch(mcs):
+    '''list of 1 1 36 T_i tensors to b 1 36 T, lengths are T_i rounded up to a multiple of 4'''
+    lengths = [mc.size(-1) + (-mc.size(-1)) % 4 for mc in mcs]
+    x = mcs[0].new_zeros(len(mcs), 1, mcs[0].size(2), max(lengths))
+    for i, mc in enumerate(mcs):
+        x[i, :, :, :mc.size(-1)] = mc[0]
+    return x, torch.LongTensor(lengths).to(x.device)
+
+
+def split_batch(out, num_frames):
+    '''b 1 36 T batch output back to 1 1 36 T_i tensors'''
+    return [out[i: i + 1, ..., :n] for i, n in enumerate(num_frames)]
+
+
+def apply_mask(x, lengths):
+    '''zero the frames past the end of each utterance, no-op if all of them fill the batch'''
+    if int(lengths.min()) >= x.size(-1):
+        return x
+    return x * _expand_mask(length_mask(lengths, x.size(-1)), x)
+
+
+class MaskedGenerator(object):
+    '''G(x, lengths, c_src, c_trg) on a zero padded batch, c_src / c_trg: b 128 or 1 128'''
+
+    def __init__(self, G):
+        self.G = G
+
+    def eval(self):
+        self.G.eval()
+        return self
+
+    def _layers(self, layers, x, lengths):
+        for layer in layers:
+            if isinstance(layer, nn.Sequential):
+                x, lengths = self._layers(layer, x, lengths)
+                continue
+            if isinstance(layer, (nn.InstanceNorm1d, nn.InstanceNorm2d)):
+                x = masked_instance_norm(x, length_mask(lengths, x.size(-1)), layer)
+            elif isinstance(layer, (nn.Conv1d, nn.Conv2d, nn.ConvTranspose2d)):
+                # only conv inputs need zeros past the end, activations act per frame
+                x = layer(apply_mask(x, lengths))
+                if isinstance(layer, nn.ConvTranspose2d):
+                    lengths = lengths * layer.stride[-1]
+                else:
+                    lengths = lengths // layer.stride[-1]
+            else:
+                x = layer(x)
+        return x, lengths
+
+    def _residual(self, block, x, lengths, c_src, c_trg):
+        x = apply_mask(x, lengths)
+        if isinstance(getattr(block, 'cin_1', None), AdaptiveInstanceNormalisation):
+            gamma, beta = block.cin_1.condition(c_src, c_trg)
+            x_ = block.conv_1(x)
+            mean, var = masked_stats(x_, length_mask(lengths, x_.size(-1)))
+            return block.glu_1((x_ - mean) / torch.sqrt(var + 1e-8) * gamma + beta)
+        # Style2 blocks have no activation statistics, zeros past the end are enough
+        return block(x, c_src, c_trg)
+
+    def __call__(self, x, lengths, c_src, c_trg):
+        G = self.G
+        width_size = x.size(3)
+        x, lengths = self._layers([G.down_sample_1, G.down_sample_2, G.down_sample_3], x, lengths)
+        x = x.contiguous().view(x.size(0), -1, width_size // 4)
+        x, lengths = self._layers([G.down_conversion], x, lengths)
+
+        for block in G.residual_blocks():
+            x = self._residual(block, x, lengths, c_src, c_trg)
+
+        x, lengths = self._layers([G.up_conversion], x, lengths)
+        x = x.view(x.size(0), G.up_sample_1.in_channels, 9, width_size // 4)
+        x, lengths = self._layers([G.up_sample_1, G.up_in_1, G.up_relu_1, G.up_sample_2, G.up_in_2, G.up_relu_2, G.out], x, lengths)
+        return x
+
+
+def masked_speaker_encoder(sp_enc, x, lengths, label):
+    '''SPEncoder on a zero padded batch, mean / std pooling over the valid frames'''
+    out = x.squeeze(1)
+    for stage in [sp_enc.down_sample_1, sp_enc.down_sample_2, sp_enc.down_sample_3, sp_enc.down_sample_4, sp_enc.down_sample_5]:
+        conv = stage[0]
+        out = stage(out)
+        stride, = conv.stride
+        kernel, = conv.kernel_size
+        padding, = conv.padding
+        lengths = (lengths + 2 * padding - kernel) // stride + 1
+        out = out * length_mask(lengths, out.size(-1))
+    mean, var = masked_stats(out, length_mask(lengths, out.size(-1)), unbiased = True)
+    out = torch.cat([mean.squeeze(2), var.squeeze(2).sqrt()], dim = 1)
+    return sp_enc.unshared(out, label)
@@ -0,0 +1,83 @@
+'''
+    [1019 new feature]: chunked overlap-add inference for long utterances
+
+    The 2D down / up sampling stacks of Generator and GeneratorSplit keep activations of the whole utterance,
+    so memory grows linearly with its length. ChunkedGenerator wraps a trained generator (torch or onnx backend):
+    the normalized mcep is split into overlapping windows of `window` frames (multiples of 4), the windows are
+    converted `batch_size` at a time and the outputs are crossfaded linearly over the overlaps. Peak activation
+    memory only depends on window and batch_size.
+
+    InstanceNorm / AdaIN statistics are computed per window, so the output is not identical to the whole-file
+    one; `seams` holds the overlap regions of the last call so that the error around them can be measured.
+'''
+import torch
+
+
+def window_starts(num_frames, window, hop):
+    '''start frames of the windows, the last window ends at num_frames'''
+    if num_frames <= window:
+        return [0]
+    starts = list(range(0, num_frames - window, hop))
+    starts.append(num_frames - window)
+    return starts
+
+
+def crossfade_weight(start, end, prev_end, next_start, device):
+    '''linear fade in over the overlap with the previous window and fade out over the one with the next window'''
+    weight = torch.ones(end - start, device = device)
+    if prev_end is not None and prev_end > start:
+        fade = prev_end - start
+        weight[:fade] = (torch.arange(fade, device = device, dtype = torch.float) + 0.5) / fade
+    if next_start is not None and next_start < end:
+        fade = end - next_start
+        weight[-fade:] = torch.min(weight[-fade:], (torch.arange(fade, 0, -1, device = device, dtype = torch.float) - 0.5) / fade)
+    return weight
+
+
+class ChunkedGenerator(object):
+    '''called like the generator it wraps, G(x, c_src, c_trg) with x: 1 1 36 T'''
+
+    def __init__(self, G, window = 256, overlap = 32, batch_size = 8):
+
+        if window % 4 != 0 or overlap % 4 != 0:
+            raise Exception(f'chunk window {window} and overlap {overlap} must be multiples of 4')
+        if not 0 <= overlap < window:
+            raise Exception(f'chunk overlap {overlap} must be smaller than the window {window}')
+        self.G = G
+        self.window = window
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.seams = []
+
+    def eval(self):
+        self.G.eval()
+        return self
+
+    def __call__(self, x, c_src, c_trg):
+
+        num_frames = x.size(3)
+        # windows are multiples of 4, pad the end of the utterance with its last frame
+        pad = (-num_frames) % 4
+        if pad > 0:
+            x = torch.cat([x, x[..., -1:].expand(*x.size()[:-1], pad)], dim = -1)
+        total = x.size(3)
+        window = min(self.window, total)
+        starts = window_starts(total, window, window - self.overlap)
+
+        out = x.new_zeros(x.size(0), 1, x.size(2), total)
+        norm = x.new_zeros(total)
+        self.seams = [(starts[i + 1], starts[i] + window) for i in range(len(starts) - 1)]
+
+        for b in range(0, len(starts), self.batch_size):
+            batch_starts = starts[b: b + self.batch_size]
+            windows = torch.cat([x[..., s: s + window] for s in batch_starts], dim = 0)
+            n = len(batch_starts)
+            y = self.G(windows, c_src.expand(n, -1), c_trg.expand(n, -1))
+            for j, s in enumerate(batch_starts):
+                k = b + j
+                weight = crossfade_weight(s, s + window,
+                                          starts[k - 1] + window if k > 0 else None,
+                                          starts[k + 1] if k + 1 < len(starts) else None, x.device)
+                out[..., s: s + window] += y[j: j + 1] * weight
+                norm[s: s + window] += weight
+        return (out / norm)[..., :num_frames]
@@ -0,0 +1,145 @@
+'''
+    [1019 new feature]: three stage analysis -> inference -> synthesis pipeline for convert.py
+
+    analysis   process pool, load wav + loudness + WORLD analysis + normalized mcep of a source utterance,
+               which fans out to every target speaker it is converted to
+    inference  the calling process, converts whatever analysed utterances are ready, up to batch_size of
+               the same speaker pair per generator call
+    synthesis  process pool, WORLD synthesis + loudness normalization + write_wav_atomic
+
+    At most queue_size source utterances are analysed ahead of inference (an analysis is held until all of
+    its targets are converted) and at most queue_size utterances are waiting for synthesis, so memory stays
+    bounded and a slow stage holds back the others.
+    Worker processes are spawned, they do not inherit the torch threads of the inference process.
+'''
+import multiprocessing
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import librosa
+import numpy as np
+import pyloudnorm
+
+from utils import wav_padding, world_decompose, world_encode_spectral_envelop, world_speech_synthesis
+from stgan_adain.sharding import write_wav_atomic
+
+
+def analyze(job):
+    '''analysis stage of one source utterance, job holds the wav path, the frame settings and the source statistics'''
+    wav, _ = librosa.load(job['wav_path'], sr = job['sampling_rate'], mono = True)
+    wav = wav_padding(wav, sr = job['sampling_rate'], frame_period = job['frame_period'], multiple = 4)
+    src_loudness = pyloudnorm.Meter(job['sampling_rate']).integrated_loudness(wav)
+
+    f0, timeaxis, sp, ap = world_decompose(wav = wav, fs = job['sampling_rate'], frame_period = job['frame_period'])
+    coded_sp = world_encode_spectral_envelop(sp = sp, fs = job['sampling_rate'], dim = job['num_mcep'])
+    coded_sp_norm = (coded_sp - job['mcep_mean_src']) / job['mcep_std_src']
+
+    result = {'f0': f0, 'ap': ap, 'coded_sp_norm': coded_sp_norm, 'src_loudness': src_loudness}
+    if job['cpsyn']:
+        result['coded_sp'] = coded_sp
+    return result
+
+
+def synthesize(job):
+    '''synthesis stage of one utterance, returns the path of the converted wav'''
+    fs, frame_period = job['sampling_rate'], job['frame_period']
+    wav_transformed = world_speech_synthesis(f0 = job['f0_converted'], coded_sp = job['coded_sp_converted'],
+                                             ap = job['ap'], fs = fs, frame_period = frame_period)
+    if job['use_loudnorm']:
+        output_loudness = pyloudnorm.Meter(fs).integrated_loudness(wav_transformed)
+        wav_transformed = pyloudnorm.normalize.loudness(wav_transformed, output_loudness, job['src_loudness'])
+    write_wav_atomic(job['out_path'], wav_transformed, fs)
+
+    if job.get('cpsyn_path') is not None:
+        wav_cpsyn = world_speech_synthesis(f0 = job['f0'], coded_sp = job['coded_sp'], ap = job['ap'], fs = fs, frame_period = frame_period)
+        write_wav_atomic(job['cpsyn_path'], wav_cpsyn, fs)
+    return job['out_path']
+
+
+class ConversionPipeline(object):
+    '''
+        convert_fn(meta_list, coded_sp_norm_list) -> list of converted (de-normalized) T 36 mceps, called with
+        utterances of the same pair key only. finish_fn(meta, result, coded_sp_converted) -> synthesis job.
+    '''
+
+    def __init__(self, convert_fn, finish_fn, analysis_workers = 2, synthesis_workers = 2, batch_size = 1, queue_size = 16):
+
+        self.convert_fn = convert_fn
+        self.finish_fn = finish_fn
+        self.analysis_workers = analysis_workers
+        self.synthesis_workers = synthesis_workers
+        self.batch_size = batch_size
+        self.queue_size = max(queue_size, batch_size)
+
+    def run(self, jobs):
+        '''jobs: iterable of (analysis job, [(pair_key, meta), ...] targets of the utterance), returns the converted wav paths'''
+        context = multiprocessing.get_context('spawn')
+        jobs = iter(jobs)
+        exhausted = False
+        analysing = {}
+        ready = OrderedDict()
+        num_ready = 0
+        # targets of each analysed source utterance not converted yet
+        holding = {}
+        synthesizing = set()
+        out_paths = []
+        convert_time = 0.
+        start = time.perf_counter()
+
+        with ProcessPoolExecutor(self.analysis_workers, mp_context = context) as analysis_pool, \
+             ProcessPoolExecutor(self.synthesis_workers, mp_context = context) as synthesis_pool:
+            while not exhausted or analysing or num_ready:
+                # keep at most queue_size source utterances between the analysis and the inference stage
+                while not exhausted and len(analysing) + len(holding) < self.queue_size:
+                    try:
+                        job, targets = next(jobs)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    analysing[analysis_pool.submit(analyze, job)] = targets
+
+                if num_ready == 0:
+                    wait(list(analysing), return_when = FIRST_COMPLETED)
+                for future in [future for future in analysing if future.done()]:
+                    result = future.result()
+                    targets = analysing.pop(future)
+                    holding[id(result)] = len(targets)
+                    for key, meta in targets:
+                        ready.setdefault(key, []).append((meta, result))
+                        num_ready += 1
+
+                if not ready:
+                    # the jobs ran out only after the last batch emptied the queue, nothing is left to convert
+                    if exhausted and not analysing:
+                        break
+                    continue
+
+                # convert whatever is ready of the pair with the most ready utterances, the oldest one on ties
+                key = max(ready, key = lambda key: len(ready[key]))
+                batch = ready[key][:self.batch_size]
+                ready[key] = ready[key][self.batch_size:]
+                if not ready[key]:
+                    del ready[key]
+                num_ready -= len(batch)
+                for _, result in batch:
+                    holding[id(result)] -= 1
+                    if holding[id(result)] == 0:
+                        del holding[id(result)]
+
+                batch_start = time.perf_counter()
+                converted = self.convert_fn([meta for meta, _ in batch], [result['coded_sp_norm'] for _, result in batch])
+                convert_time += time.perf_counter() - batch_start
+
+                for (meta, result), coded_sp_converted in zip(batch, converted):
+                    if len(synthesizing) >= self.queue_size:
+                        done, synthesizing = wait(synthesizing, return_when = FIRST_COMPLETED)
+                        out_paths.extend(future.result() for future in done)
+                    synthesizing.add(synthesis_pool.submit(synthesize, self.finish_fn(meta, result, coded_sp_converted)))
+
+            out_paths.extend(future.result() for future in wait(synthesizing)[0])
+
+        total_time = time.perf_counter() - start
+        print(f'pipeline converted {len(out_paths)} utterances in {total_time:.2f} s, {len(out_paths) / max(total_time, 1e-9):.1f} utterances/s '
+              f'(inference {convert_time:.2f} s, {self.analysis_workers} analysis / {self.synthesis_workers} synthesis workers)', flush=True)
+        return out_paths
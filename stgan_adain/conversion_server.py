@@ -0,0 +1,264 @@
+'''
+    [1019 new feature]: long-running local conversion service
+
+    G, the speaker encoder, the speaker statistics and the target embedding table stay resident. Each request
+    (source wav + source / target speaker) is analysed and synthesized in its own HTTP thread, the generator
+    runs in the micro-batcher thread on masked batches of concurrent requests (any mix of speaker pairs).
+    A reload loads another checkpoint next to the served one and swaps it in between two batches, requests
+    are served by the old models until then.
+
+    HTTP API (localhost or a unix socket):
+        POST /convert?src=p225&trg=p226   body: wav, returns the converted wav
+        POST /reload?iters=200000         load and swap in another checkpoint step
+        GET  /metrics                     latency / throughput / batching statistics (json)
+        GET  /health
+'''
+import io
+import json
+import os
+import socketserver
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import join
+from urllib.parse import urlparse, parse_qs
+
+import librosa
+import numpy as np
+import pyloudnorm
+import torch
+
+from utils import pitch_conversion, wav_padding, world_decompose, world_encode_spectral_envelop, world_speech_synthesis
+from stgan_adain.batched_inference import MaskedGenerator, masked_speaker_encoder, pad_batch, split_batch
+from stgan_adain.micro_batcher import MicroBatcher
+
+
+class ServedModels(object):
+    '''models of one checkpoint step, spk2emb: speaker -> target embedding (128,)'''
+
+    def __init__(self, iters, G, sp_enc, spk2emb):
+        self.iters = iters
+        self.G = MaskedGenerator(G).eval()
+        self.sp_enc = sp_enc.eval()
+        self.spk2emb = spk2emb
+
+
+class ServerMetrics(object):
+    '''request latencies and batch statistics, percentiles over the last window requests'''
+
+    def __init__(self, window = 1000):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.latencies = deque(maxlen = window)
+        self.done_times = deque(maxlen = window)
+        self.waits = deque(maxlen = window)
+        self.batches = 0
+        self.batch_items = 0
+        self.batch_time = 0.
+        self.batch_sizes = {}
+
+    def record_request(self, latency):
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(latency)
+            self.done_times.append(time.time())
+
+    def record_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def record_batch(self, size, waits, seconds):
+        with self.lock:
+            self.batches += 1
+            self.batch_items += size
+            self.batch_time += seconds
+            self.batch_sizes[size] = self.batch_sizes.get(size, 0) + 1
+            self.waits.extend(waits)
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            latencies = np.array(self.latencies) * 1000
+            waits = np.array(self.waits) * 1000
+            recent = [t for t in self.done_times if t > now - 60]
+            percentiles = lambda x: {f'p{q}': float(np.percentile(x, q)) if len(x) else None for q in (50, 95, 99)}
+            return {
+                'uptime_s': now - self.start,
+                'requests': self.requests,
+                'errors': self.errors,
+                'throughput_rps': self.requests / max(now - self.start, 1e-9),
+                'throughput_last_60s_rps': len(recent) / min(60., max(now - self.start, 1e-9)),
+                'latency_ms': percentiles(latencies),
+                'queue_wait_ms': percentiles(waits),
+                'batches': self.batches,
+                'mean_batch_size': self.batch_items / max(self.batches, 1),
+                'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                'inference_ms_per_batch': self.batch_time * 1000 / max(self.batches, 1),
+            }
+
+
+class ConversionService(object):
+    '''
+        load_models(iters) -> ServedModels. Speaker statistics of stats_dir ({spk}_stats.npz of the training data)
+        are loaded once for all speakers.
+    '''
+
+    def __init__(self, load_models, iters, speakers, stats_dir, sampling_rate, frame_period = 5, num_mcep = 36,
+                 max_batch = 8, max_wait = 0.01, use_loudnorm = False, use_spk_mean = False, device = torch.device('cpu')):
+
+        self.load_models = load_models
+        self.speakers = speakers
+        self.sampling_rate = sampling_rate
+        self.frame_period = frame_period
+        self.num_mcep = num_mcep
+        self.use_loudnorm = use_loudnorm
+        self.use_spk_mean = use_spk_mean
+        self.device = device
+        self.stats = {}
+        for spk in speakers:
+            stats = np.load(join(stats_dir, f'{spk}_stats.npz'))
+            self.stats[spk] = {key: stats[key] for key in ['log_f0s_mean', 'log_f0s_std', 'coded_sps_mean', 'coded_sps_std']}
+        self.models = load_models(iters)
+        self.reload_lock = threading.Lock()
+        self.metrics = ServerMetrics()
+        self.batcher = MicroBatcher(self._convert_batch, max_batch, max_wait, on_batch = self.metrics.record_batch).start()
+
+    def reload(self, iters):
+        '''load step iters while the current models keep serving, then swap them in'''
+        with self.reload_lock:
+            start = time.perf_counter()
+            models = self.load_models(iters)
+            # the batcher reads self.models once per batch, the swap takes effect from the next batch
+            self.models = models
+            print(f'serving step {iters}, loaded in {time.perf_counter() - start:.2f} s', flush=True)
+
+    def _convert_batch(self, items):
+        '''items: (T 36 normalized source mcep, src, trg), returns the T 36 normalized converted mceps'''
+        models = self.models
+        with torch.no_grad():
+            tensors = [torch.FloatTensor(coded_sp_norm.T).unsqueeze_(0).unsqueeze_(1).to(self.device) for coded_sp_norm, _, _ in items]
+            x, lengths = pad_batch(tensors)
+            trg_spk_cond = torch.FloatTensor(np.stack([models.spk2emb[trg] for _, _, trg in items])).to(self.device)
+            if self.use_spk_mean:
+                src_spk_cond = torch.FloatTensor(np.stack([models.spk2emb[src] for _, src, _ in items])).to(self.device)
+            else:
+                src_lengths = torch.LongTensor([tensor.size(-1) for tensor in tensors]).to(self.device)
+                src_labels = torch.LongTensor([self.speakers.index(src) for _, src, _ in items]).to(self.device)
+                src_spk_cond = masked_speaker_encoder(models.sp_enc, x, src_lengths, src_labels)
+            out = models.G(x, lengths, src_spk_cond, trg_spk_cond)
+        return [np.squeeze(y.cpu().numpy()).T for y in split_batch(out, [tensor.size(-1) for tensor in tensors])]
+
+    def convert(self, wav_bytes, src_spk, trg_spk):
+        '''source wav file content -> converted wav file content'''
+        for spk in (src_spk, trg_spk):
+            if spk not in self.stats:
+                raise ValueError(f'unknown speaker {spk}')
+        start = time.perf_counter()
+        src_stats, trg_stats = self.stats[src_spk], self.stats[trg_spk]
+        fs, frame_period = self.sampling_rate, self.frame_period
+
+        wav, _ = librosa.load(io.BytesIO(wav_bytes), sr = fs, mono = True)
+        wav = wav_padding(wav, sr = fs, frame_period = frame_period, multiple = 4)
+        loud_meter = pyloudnorm.Meter(fs)
+        src_loudness = loud_meter.integrated_loudness(wav)
+        f0, _, sp, ap = world_decompose(wav = wav, fs = fs, frame_period = frame_period)
+        coded_sp = world_encode_spectral_envelop(sp = sp, fs = fs, dim = self.num_mcep)
+        coded_sp_norm = (coded_sp - src_stats['coded_sps_mean']) / src_stats['coded_sps_std']
+
+        coded_sp_converted_norm = self.batcher.submit((coded_sp_norm, src_spk, trg_spk)).result()
+
+        coded_sp_converted = np.ascontiguousarray(coded_sp_converted_norm * trg_stats['coded_sps_std'] + trg_stats['coded_sps_mean'])
+        f0_converted = pitch_conversion(f0 = f0, mean_log_src = src_stats['log_f0s_mean'], std_log_src = src_stats['log_f0s_std'],
+                                        mean_log_target = trg_stats['log_f0s_mean'], std_log_target = trg_stats['log_f0s_std'])
+        wav_transformed = world_speech_synthesis(f0 = f0_converted, coded_sp = coded_sp_converted, ap = ap, fs = fs, frame_period = frame_period)
+        if self.use_loudnorm:
+            output_loudness = loud_meter.integrated_loudness(wav_transformed)
+            wav_transformed = pyloudnorm.normalize.loudness(wav_transformed, output_loudness, src_loudness)
+
+        out = io.BytesIO()
+        librosa.output.write_wav(out, wav_transformed, fs)
+        self.metrics.record_request(time.perf_counter() - start)
+        return out.getvalue()
+
+
+def make_handler(service):
+
+    class ConversionHandler(BaseHTTPRequestHandler):
+
+        def _send(self, code, body, content_type = 'application/json'):
+            if not isinstance(body, bytes):
+                body = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path == '/metrics':
+                metrics = service.metrics.snapshot()
+                metrics['iters'] = service.models.iters
+                self._send(200, metrics)
+            elif path == '/health':
+                self._send(200, {'status': 'ok', 'iters': service.models.iters})
+            else:
+                self._send(404, {'error': f'unknown path {path}'})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                if url.path == '/convert':
+                    if 'src' not in query or 'trg' not in query:
+                        raise ValueError('src and trg speakers are required')
+                    self._send(200, service.convert(body, query['src'], query['trg']), content_type = 'audio/wav')
+                elif url.path == '/reload':
+                    if 'iters' not in query:
+                        raise ValueError('iters is required')
+                    service.reload(int(query['iters']))
+                    self._send(200, {'iters': service.models.iters})
+                else:
+                    self._send(404, {'error': f'unknown path {url.path}'})
+            except ValueError as e:
+                service.metrics.record_error()
+                self._send(400, {'error': str(e)})
+            except Exception as e:
+                service.metrics.record_error()
+                self._send(500, {'error': repr(e)})
+
+        def address_string(self):
+            # unix socket clients have no address
+            return self.client_address[0] if self.client_address else 'unix'
+
+        def log_message(self, format, *args):
+            pass
+
+    return ConversionHandler
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(service, host = '127.0.0.1', port = 8000, unix_socket = None):
+    handler = make_handler(service)
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, handler)
+        print(f'serving step {service.models.iters} on {unix_socket}', flush=True)
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+        print(f'serving step {service.models.iters} on http://{host}:{port}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.batcher.stop()
@@ -0,0 +1,100 @@
+'''
+    [1019 new feature]: fused instance norm + AdaIN modulation + GLU
+
+    The unfused residual block keeps x - u, (x - u)^2, h, h * gamma + beta and the GLU output alive for
+    backward. adain_glu computes mean / variance in one var_mean pass, folds gamma, beta, mean and std into a
+    per channel scale / shift and applies them with a single addcmul. In backward only the block input x and
+    the per channel statistics are saved, the normalized activations are recomputed.
+
+    glu: 'split' (nn.GLU over channels, ResidualBlockSplit / ResidualBlock2D), 'swish' (x * sigmoid(x), GLU of
+    ResidualBlock) or None. Without grad (eval, onnx export) the same math runs without the autograd function.
+'''
+import torch
+
+FUSED_OPS = True
+
+
+def set_fused_ops(enabled):
+    global FUSED_OPS
+    FUSED_OPS = bool(enabled)
+
+
+def fused_ops_enabled():
+    return FUSED_OPS
+
+
+def _glu(y, glu):
+    if glu == 'split':
+        a, b = y.chunk(2, dim = 1)
+        return a * torch.sigmoid(b)
+    if glu == 'swish':
+        return y * torch.sigmoid(y)
+    return y
+
+
+def _glu_backward(y, grad_out, glu):
+    if glu == 'split':
+        a, b = y.chunk(2, dim = 1)
+        sig = torch.sigmoid(b)
+        grad_a = grad_out * sig
+        grad_b = grad_out * a * sig * (1 - sig)
+        return torch.cat([grad_a, grad_b], dim = 1)
+    if glu == 'swish':
+        sig = torch.sigmoid(y)
+        return grad_out * sig * (1 + y * (1 - sig))
+    return grad_out
+
+
+def _scale_shift(x, gamma, beta, eps):
+    '''per (batch, channel) statistics folded with gamma / beta, y = x * scale + shift'''
+    dims = tuple(range(2, x.dim()))
+    var, mean = torch.var_mean(x, dim = dims, unbiased = False, keepdim = True)
+    rstd = torch.rsqrt(var + eps)
+    scale = gamma * rstd
+    shift = beta - mean * scale
+    return mean, rstd, scale, shift
+
+
+class AdaINGLUFunction(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, x, gamma, beta, eps, glu):
+        mean, rstd, scale, shift = _scale_shift(x, gamma, beta, eps)
+        ctx.save_for_backward(x, gamma, beta, mean, rstd)
+        ctx.glu = glu
+        return _glu(torch.addcmul(shift, x, scale), glu)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        x, gamma, beta, mean, rstd = ctx.saved_tensors
+        dims = tuple(range(2, x.dim()))
+        # recompute the normalized and modulated activations
+        h = (x - mean) * rstd
+        grad_y = grad_out
+        if ctx.glu is not None:
+            grad_y = _glu_backward(torch.addcmul(beta, h, gamma), grad_out, ctx.glu)
+
+        grad_beta = grad_y.sum(dim = dims, keepdim = True)
+        grad_gamma = (grad_y * h).sum(dim = dims, keepdim = True)
+        # instance norm backward, dx = rstd * (dh - mean(dh) - h * mean(dh * h)) with dh = grad_y * gamma
+        num = h[0, 0].numel()
+        grad_x = rstd * (grad_y * gamma - (grad_beta * gamma + h * grad_gamma * gamma) / num)
+        return grad_x, _reduce_to(grad_gamma, gamma), _reduce_to(grad_beta, beta), None, None
+
+
+def _reduce_to(grad, param):
+    '''sum grads of broadcast gamma / beta (batch 1 conditioning) back to their shape'''
+    if grad.size(0) != param.size(0):
+        grad = grad.sum(dim = 0, keepdim = True)
+    return grad
+
+
+def adain_glu(x, gamma, beta, glu = 'split', eps = 1e-8):
+    '''
+        x: b c t (or b c h w), gamma / beta: b c 1 (or b c 1 1)
+        returns glu(gamma * (x - mean) / sqrt(var + eps) + beta), statistics over the non channel dims
+    '''
+    if torch.is_grad_enabled() and (x.requires_grad or gamma.requires_grad or beta.requires_grad):
+        return AdaINGLUFunction.apply(x, gamma, beta, eps, glu)
+    _, _, scale, shift = _scale_shift(x, gamma, beta, eps)
+    return _glu(torch.addcmul(shift, x, scale), glu)
@@ -0,0 +1,84 @@
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+
+
+class MetricSink(object):
+    """Asynchronous metric sink for Solver.train.
+
+        Losses are handed over as one stacked (possibly cuda) tensor per log step. A background thread
+        copies it to host, prints the log line and writes the scalars to tensorboard event files or a
+        json lines file, so the optimizer loop never waits on a device sync or on disk io.
+    """
+
+    def __init__(self, log_dir, backend = 'tensorboard', max_queue = 100):
+
+        self.log_dir = log_dir
+        self.backend = backend
+        os.makedirs(log_dir, exist_ok = True)
+
+        if backend == 'tensorboard':
+            from torch.utils.tensorboard import SummaryWriter
+            self.writer = SummaryWriter(log_dir)
+        elif backend == 'jsonl':
+            self.writer = open(os.path.join(log_dir, 'metrics.jsonl'), 'a')
+        elif backend == 'none':
+            self.writer = None
+        else:
+            raise Exception(f'unknown metric sink backend {backend}')
+
+        self.queue = queue.Queue(maxsize = max_queue)
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def put(self, step, tags, values, prefix = ''):
+        """Queue one log record.
+
+            tags:   list of scalar names
+            values: tensor of shape (len(tags),), reduced on host in the background
+            prefix: head of the console log line
+        """
+        self.queue.put((step, tags, values, prefix))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            try:
+                self._write(*item)
+            except Exception:
+                # a dead sink thread would block put() once the queue is full and hang training,
+                # report the failed record and keep serving the queue
+                print(f'metric sink failed to write step {item[0]}:', flush=True)
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+    def _write(self, step, tags, values, prefix):
+        values = values.detach().cpu().tolist()
+        log = prefix
+        for tag, value in zip(tags, values):
+            log += ", {}: {:.4f}".format(tag, value)
+        print(log, flush=True)
+
+        if self.backend == 'tensorboard':
+            for tag, value in zip(tags, values):
+                self.writer.add_scalar(tag, value, step)
+            self.writer.flush()
+        elif self.backend == 'jsonl':
+            record = {'step': step, 'time': time.time()}
+            record.update(zip(tags, values))
+            self.writer.write(json.dumps(record) + '\n')
+            self.writer.flush()
+
+    def close(self):
+        """Drain the queue and close the writer."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.writer is not None:
+            self.writer.close()
@@ -0,0 +1,91 @@
+'''
+    [1019 new feature]: dynamic micro-batching of concurrent inference requests
+
+    Any thread submits an item and waits on the returned future. A single inference thread takes the first
+    waiting item, then keeps collecting items until max_batch are gathered or max_wait seconds have passed
+    since that first item, and converts them with one batch_fn call. Under light load a request waits at
+    most max_wait, under heavy load the batches fill up and the generator calls are amortized.
+'''
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher(object):
+    '''
+        batch_fn(items) -> results of the same length, runs in the batcher thread only.
+        on_batch(batch size, queue waits of the items, batch_fn seconds) is called after every batch.
+    '''
+
+    def __init__(self, batch_fn, max_batch = 8, max_wait = 0.01, on_batch = None):
+
+        self.batch_fn = batch_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.on_batch = on_batch
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target = self._loop, name = 'micro-batcher', daemon = True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def submit(self, item):
+        future = Future()
+        self.queue.put((item, future, time.perf_counter()))
+        return future
+
+    def _collect(self):
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first[2] + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                entry = self.queue.get(timeout = timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is None:
+                # stop after this batch
+                self.queue.put(None)
+                break
+            batch.append(entry)
+        return batch
+
+    def _run(self, batch):
+        try:
+            return self.batch_fn([item for item, _, _ in batch]), None
+        except Exception as e:
+            return None, e
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            start = time.perf_counter()
+            waits = [start - submitted for _, _, submitted in batch]
+            results, error = self._run(batch)
+            if error is not None and len(batch) > 1:
+                # convert one by one, only the failing items get the error
+                for entry in batch:
+                    entry_results, entry_error = self._run([entry])
+                    if entry_error is not None:
+                        entry[1].set_exception(entry_error)
+                    else:
+                        entry[1].set_result(entry_results[0])
+            elif error is not None:
+                batch[0][1].set_exception(error)
+            else:
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+            if self.on_batch is not None:
+                self.on_batch(len(batch), waits, time.perf_counter() - start)
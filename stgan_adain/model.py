@@ -1,9 +1,13 @@
+import math
+from collections import OrderedDict
 import torch
 import torch.nn as nn
 import numpy as np
 import argparse
 from data_loader import get_loader, to_categorical
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+from stgan_adain.fused_ops import adain_glu, fused_ops_enabled
 from stgan_adain.stylegan2_module import Style2ResidualBlock, Style2ResidualBlock1D, Style2ResidualBlock1DSrc, Style2ResidualBlock1DBeta
 class GLU(nn.Module):
     ''' GLU block, do not split channels dimension'''
@@ -51,15 +55,19 @@ class AdaptiveInstanceNormalisation2D(nn.Module):
         
         #c = torch.cat([c_src, c_trg - c_src], dim = -1)
         #c = torch.cat([c_src, c_trg], dim = -1)
+        gamma, beta = self.condition(c_src, c_trg)
+        #return (1 + gamma) * self.norm(x) + beta
+        return gamma * self.norm(x) + beta
+
+    def condition(self, c_src, c_trg):
+        '''gamma and beta of the target conditioning, b dim_in 1 1'''
         c = c_trg
         gamma = self.fc_g(c)  #* torch.sigmoid(self.gate_g(c))
         beta = self.fc_b(c)  #* torch.sigmoid(self.gate_b(c))
 
         gamma = gamma.view(gamma.size(0), gamma.size(1), 1, 1)
         beta = beta.view(beta.size(0), beta.size(1), 1, 1)
-        
-        #return (1 + gamma) * self.norm(x) + beta
-        return gamma * self.norm(x) + beta
+        return gamma, beta
 
 
 class AdaptiveInstanceNormalisation(nn.Module):
@@ -82,9 +90,11 @@ class AdaptiveInstanceNormalisation(nn.Module):
         #self.lat_linear = nn.Linear(2*dim_in, dim_c)
 
     def forward(self, x, c_src, c_trg):
-        u = torch.mean(x, dim=2, keepdim=True)
-        var = torch.mean((x - u) * (x - u), dim=2, keepdim=True)
-        std = torch.sqrt(var + 1e-8)
+
+        return self.forward_conditioned(x, self.condition(c_src, c_trg))
+
+    def condition(self, c_src, c_trg):
+        '''gamma and beta of the (src, trg) conditioning, b dim_in 1'''
 
         # width = x.shape[2]
         #x_flat = x.view(x.size(0), x.size(1), -1)
@@ -102,6 +112,13 @@ class AdaptiveInstanceNormalisation(nn.Module):
         #beta = self.beta_t(c_trg) + torch.sigmoid(self.bet_gate_s(c)) * self.beta_s(c_src)
         beta = self.beta_t(c) #* torch.sigmoid(self.gate_beta_t(c))
         beta = beta.view(-1, self.dim_in, 1)
+        return gamma, beta
+
+    def forward_conditioned(self, x, cond):
+        gamma, beta = cond
+        u = torch.mean(x, dim=2, keepdim=True)
+        var = torch.mean((x - u) * (x - u), dim=2, keepdim=True)
+        std = torch.sqrt(var + 1e-8)
 
         h = (x - u) / std
         h = h * gamma + beta
@@ -150,6 +167,10 @@ class ResidualBlock2D(nn.Module):
 
     def forward(self, x, c_src, c_trg):
         x_ = self.conv_1(x)
+        if fused_ops_enabled():
+            # [1019 new feature]: fused instance norm + modulation + GLU
+            gamma, beta = self.adain_1.condition(c_src, c_trg)
+            return adain_glu(x_, gamma, beta, glu = 'split', eps = self.adain_1.norm.eps)
         x_ = self.adain_1(x_, c_src, c_trg)
         #x_ = torch.sigmoid(x_) * x_
         x_ = self.glu_1(x_)
@@ -164,8 +185,17 @@ class ResidualBlockSplit(nn.Module):
         self.glu_1 = nn.GLU(dim = 1)
 
     def forward(self, x, c_src, c_trg):
+        return self.forward_conditioned(x, self.condition(c_src, c_trg))
+
+    def condition(self, c_src, c_trg):
+        return self.cin_1.condition(c_src, c_trg)
+
+    def forward_conditioned(self, x, cond):
         x_ = self.conv_1(x)
-        x_ = self.cin_1(x_, c_src, c_trg)
+        if fused_ops_enabled():
+            # [1019 new feature]: fused instance norm + modulation + GLU
+            return adain_glu(x_, *cond, glu = 'split')
+        x_ = self.cin_1.forward_conditioned(x_, cond)
         x_ = self.glu_1(x_)
         return x_
 class ResidualBlock(nn.Module):
@@ -178,11 +208,19 @@ class ResidualBlock(nn.Module):
         #self.relu = nn.LeakyReLU(0.2)
 
     def forward(self, x, c_src, c_trg):
+        return self.forward_conditioned(x, self.condition(c_src, c_trg))
+
+    def condition(self, c_src, c_trg):
+        return self.cin_1.condition(c_src, c_trg)
+
+    def forward_conditioned(self, x, cond):
         x_ = self.conv_1(x)
-        x_ = self.cin_1(x_, c_src, c_trg)
+        if fused_ops_enabled():
+            # [1019 new feature]: fused instance norm + modulation + x * sigmoid(x)
+            return adain_glu(x_, *cond, glu = 'swish')
+        x_ = self.cin_1.forward_conditioned(x_, cond)
         #x_ = torch.sigmoid(x_) * x_
         x_ = self.glu_1(x_)
-        #x_ = self.relu(x_)
         return x_
 
 class SEBlock(nn.Module):
@@ -218,6 +256,62 @@ class SEBlock(nn.Module):
 
         return out
 
+class SpeakerHeads(nn.Module):
+    '''per speaker linear output heads of the speaker encoders.
+
+        The num_speakers nn.Linear(dim_in, dim_out) heads are stored as one (num_speakers, dim_out, dim_in) weight,
+        and only the head of the selected speaker is evaluated for each sample with a batched gather + bmm.
+        The state dict keeps the layout of the original nn.ModuleList ({i}.weight, {i}.bias), old checkpoints load as is.
+    '''
+
+    def __init__(self, num_speakers, dim_in, dim_out):
+
+        super().__init__()
+        self.num_speakers = num_speakers
+        self.weight = nn.Parameter(torch.Tensor(num_speakers, dim_out, dim_in))
+        self.bias = nn.Parameter(torch.Tensor(num_speakers, dim_out))
+
+        # same init as nn.Linear
+        bound = 1 / math.sqrt(dim_in)
+        nn.init.uniform_(self.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x, spk):
+        '''
+            x: [b, dim_in], spk: speaker index [b] or a single index
+        '''
+        spk = spk.long().view(-1)
+        if spk.size(0) == 1:
+            spk = spk.expand(x.size(0))
+        weight = self.weight.index_select(0, spk) # b out in
+        bias = self.bias.index_select(0, spk) # b out
+        return torch.baddbmm(bias.unsqueeze(2), weight, x.unsqueeze(2)).squeeze(2)
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        for i in range(self.num_speakers):
+            weight, bias = self.weight[i], self.bias[i]
+            destination[prefix + f'{i}.weight'] = weight if keep_vars else weight.detach().clone()
+            destination[prefix + f'{i}.bias'] = bias if keep_vars else bias.detach().clone()
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        weight_keys = [prefix + f'{i}.weight' for i in range(self.num_speakers)]
+        bias_keys = [prefix + f'{i}.bias' for i in range(self.num_speakers)]
+        missing = [key for key in weight_keys + bias_keys if key not in state_dict]
+        if len(missing) > 0:
+            missing_keys.extend(missing)
+            return
+        try:
+            with torch.no_grad():
+                self.weight.copy_(torch.stack([state_dict[key] for key in weight_keys]))
+                self.bias.copy_(torch.stack([state_dict[key] for key in bias_keys]))
+        except RuntimeError as e:
+            error_msgs.append(f'While copying the speaker heads {prefix}: {e}')
+        if strict:
+            expected = set(weight_keys + bias_keys)
+            for key in state_dict.keys():
+                if key.startswith(prefix) and key not in expected:
+                    unexpected_keys.append(key)
+
 class SPEncoderPool1D(nn.Module):
     '''speaker encoder for adaptive instance normalization, add statistic pooling layer'''
     
@@ -272,10 +366,7 @@ class SPEncoderPool1D(nn.Module):
         )
         #self.linear1 = nn.Linear(256, 128)
         
-        self.unshared = nn.ModuleList()
-
-        for _ in range(num_speakers):
-            self.unshared += [nn.Linear(512, 128)]
+        self.unshared = SpeakerHeads(num_speakers, 512, 128)
         
         if self.cls:
             self.cls_layer = nn.Linear(128, num_speakers)
@@ -304,15 +395,7 @@ class SPEncoderPool1D(nn.Module):
         out = torch.cat([out_mean, out_std], dim = 1) 
         
         #out = self.linear1(out)
-        res = []
-        for layer in self.unshared:
-            
-            res += [layer(out)]
-
-        res = torch.stack(res, dim = 1)
-        
-        idx = torch.LongTensor(range(x.size(0))).to(x.device)
-        s = res[idx, trg_c.long()]
+        s = self.unshared(out, trg_c)
         
         if self.cls and cls_out:
             cls_out = self.cls_layer(s)
@@ -547,11 +630,7 @@ class SPEncoder(nn.Module):
         #self.linear1 = nn.Linear(512, 128)
         #if spk_cls:
         #    self.cls_layer = nn.Linear(128, num_speakers)
-        self.unshared = nn.ModuleList()
-
-        for _ in range(num_speakers):
-            #self.unshared += [nn.Linear(256, 128)]
-            self.unshared += [nn.Linear(512, 128)]
+        self.unshared = SpeakerHeads(num_speakers, 512, 128)
 
     def forward(self,x, trg_c, cls_out = False):
         
@@ -576,15 +655,7 @@ class SPEncoder(nn.Module):
         out = torch.cat([out_mean, out_std], dim = 1) 
         
         #out = self.linear1(out)
-        res = []
-        for layer in self.unshared:
-            
-            res += [layer(out)]
-
-        res = torch.stack(res, dim = 1)
-        
-        idx = torch.LongTensor(range(x.size(0))).to(x.device)
-        s = res[idx, trg_c.long()]
+        s = self.unshared(out, trg_c)
 
         return s
         #if self.spk_cls and cls_out:
@@ -594,6 +665,105 @@ class SPEncoder(nn.Module):
         #    return out
 
 
+class ConditioningCache(object):
+    '''
+        [1019 new feature]: per (src_cond, trg_cond) conditioning cache for inference
+        At conversion time the speaker pair is fixed for many utterances, so the conditioning dependent
+        tensors of the residual blocks (AdaIN gamma / beta, Style2 modulated weights) are computed once
+        per pair and kept in a LRU cache of `cond_cache_size` pairs. The cache is dropped on
+        load_state_dict and train / eval switches; call clear_conditioning_cache after updating weights otherwise.
+    '''
+    cond_cache_size = 8
+    num_blocks = 9
+
+    def residual_blocks(self):
+        return [getattr(self, f'residual_{i}') for i in range(1, self.num_blocks + 1)]
+
+    def clear_conditioning_cache(self):
+        self._cond_cache = OrderedDict()
+
+    def precompute_conditioning(self, c_src, c_trg):
+        if c_src.size(0) != 1 or c_trg.size(0) != 1:
+            raise Exception(f'conditioning is cached per speaker pair, got batches of {c_src.size(0)} and {c_trg.size(0)}')
+        with torch.no_grad():
+            return [block.condition(c_src, c_trg) for block in self.residual_blocks()]
+
+    def conditioning(self, c_src, c_trg, key = None):
+        '''cached conditioning of a (c_src, c_trg) pair, key defaults to the content of the condition tensors'''
+        if key is None:
+            key = (c_src.detach().cpu().numpy().tobytes(), c_trg.detach().cpu().numpy().tobytes())
+        key = (key, str(c_trg.device), c_trg.dtype)
+
+        cache = getattr(self, '_cond_cache', None)
+        if cache is None:
+            self.clear_conditioning_cache()
+            cache = self._cond_cache
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        cond = self.precompute_conditioning(c_src, c_trg)
+        cache[key] = cond
+        while len(cache) > self.cond_cache_size:
+            cache.popitem(last = False)
+        return cond
+
+    def convert(self, x, c_src, c_trg, key = None):
+        '''inference forward, x is a batch of utterances converted with the same (c_src, c_trg) pair'''
+        width_size = x.size(3)
+        cond = self.conditioning(c_src, c_trg, key)
+        with torch.no_grad():
+            x = self.encode(x)
+            for block, block_cond in zip(self.residual_blocks(), cond):
+                x = block.forward_conditioned(x, block_cond)
+            return self.decode(x, width_size)
+
+    def convert_targets(self, x, c_src, c_trgs):
+        '''
+            [1019 new feature]: one source utterance x: 1 1 36 T to the K targets of c_trgs: K 128 in one forward,
+            the conditioning independent down-sampling stack runs once and is expanded at the first residual block
+        '''
+        width_size = x.size(3)
+        num_targets = c_trgs.size(0)
+        with torch.no_grad():
+            x = self.encode(x)
+            x = x.expand(num_targets, *x.size()[1:])
+            c_src = c_src.expand(num_targets, -1)
+            for block in self.residual_blocks():
+                x = block(x, c_src, c_trgs)
+            return self.decode(x, width_size)
+
+    def train(self, mode = True):
+        self.clear_conditioning_cache()
+        return super().train(mode)
+
+    def load_state_dict(self, *args, **kwargs):
+        self.clear_conditioning_cache()
+        return super().load_state_dict(*args, **kwargs)
+
+class ActivationCheckpointing(object):
+    '''
+        [1019 new feature]: opt-in activation checkpointing of the generator segments
+        'down' (2D down-sampling stack and down conversion), 'res' (each residual block) and
+        'up' (up conversion and 2D up-sampling stack). Activations inside a checkpointed segment are
+        recomputed in backward instead of being kept, only while training with grad enabled.
+    '''
+    checkpoint_segments = frozenset()
+
+    def set_checkpointing(self, segments):
+        segments = frozenset(segments)
+        unknown = segments - CHECKPOINT_SEGMENTS
+        if unknown:
+            raise Exception(f'unknown checkpoint segments {sorted(unknown)}, choose from {sorted(CHECKPOINT_SEGMENTS)}')
+        self.checkpoint_segments = segments
+        return self
+
+    def run_segment(self, segment, fn, *args):
+        if segment in self.checkpoint_segments and self.training and torch.is_grad_enabled():
+            return checkpoint(fn, *args, use_reentrant = False)
+        return fn(*args)
+
+CHECKPOINT_SEGMENTS = frozenset(['down', 'res', 'up'])
+
 class Generator2D(nn.Module):
     """Generator network."""
     def __init__(self, num_speakers=4, aff = True, res_block_name = ''):
@@ -726,7 +896,7 @@ class Generator2D(nn.Module):
 
         return x
 
-class GeneratorSplit(nn.Module):
+class GeneratorSplit(ConditioningCache, ActivationCheckpointing, nn.Module):
     """Generator network."""
     def __init__(self, num_speakers=4, aff = True, res_block_name = 'ResidualBlockSplit'):
         super(GeneratorSplit, self).__init__()
@@ -817,23 +987,23 @@ class GeneratorSplit(nn.Module):
     def forward(self, x, c_src, c_trg):
         width_size = x.size(3)
 
+        x = self.run_segment('down', self.encode, x)
+        for block in self.residual_blocks():
+            x = self.run_segment('res', block, x, c_src, c_trg)
+        return self.run_segment('up', self.decode, x, width_size)
+
+    def encode(self, x):
+        width_size = x.size(3)
+
         x = self.down_sample_1(x)
         x = self.down_sample_2(x)
         x = self.down_sample_3(x)
 
         x = x.contiguous().view(-1, 2304, width_size // 4)
         x = self.down_conversion(x)
+        return x
 
-        x = self.residual_1(x, c_src, c_trg)
-        x = self.residual_2(x, c_src, c_trg)
-        x = self.residual_3(x, c_src, c_trg)
-        x = self.residual_4(x, c_src, c_trg)
-        x = self.residual_5(x, c_src, c_trg)
-        x = self.residual_6(x, c_src, c_trg)
-        x = self.residual_7(x, c_src, c_trg)
-        x = self.residual_8(x, c_src, c_trg)
-        x = self.residual_9(x, c_src, c_trg)
-
+    def decode(self, x, width_size):
         x = self.up_conversion(x)
         x = x.view(-1, 256, 9, width_size // 4)
 
@@ -848,54 +1018,50 @@ class GeneratorSplit(nn.Module):
         x = self.out(x)
 
         return x
-class Generator(nn.Module):
+class Generator(ConditioningCache, ActivationCheckpointing, nn.Module):
     """Generator network."""
-    def __init__(self, num_speakers=4, aff = True, res_block_name = ''):
+    def __init__(self, num_speakers=4, aff = True, res_block_name = '', num_blocks = 9, res_dim = 256, conv_dim = 128):
         super(Generator, self).__init__()
         self.res_block_name = res_block_name
+        # [1019 new feature]: num_blocks residual blocks at res_dim channels, conv_dim / 2*conv_dim channels in the 2D stacks
+        self.num_blocks = num_blocks
+        self.conv_dim = conv_dim
         # Down-sampling layers
         self.down_sample_1 = nn.Sequential(
-            nn.Conv2d(in_channels=1, out_channels=128, kernel_size=(3, 9), padding=(1, 4), bias=False),
+            nn.Conv2d(in_channels=1, out_channels=conv_dim, kernel_size=(3, 9), padding=(1, 4), bias=False),
             nn.LeakyReLU(0.2),
             #GLU()
         )
         self.down_sample_2 = nn.Sequential(
-            nn.Conv2d(in_channels=128, out_channels=256, kernel_size=(4, 8), stride=(2, 2), padding=(1, 3), bias=False),
-            nn.InstanceNorm2d(num_features=256, affine=aff),
+            nn.Conv2d(in_channels=conv_dim, out_channels=2*conv_dim, kernel_size=(4, 8), stride=(2, 2), padding=(1, 3), bias=False),
+            nn.InstanceNorm2d(num_features=2*conv_dim, affine=aff),
             nn.LeakyReLU(0.2),
             #GLU()
         )
         self.down_sample_3 = nn.Sequential(
-            nn.Conv2d(in_channels=256, out_channels=256, kernel_size=(4, 8), stride=(2, 2), padding=(1, 3), bias=False),
-            nn.InstanceNorm2d(num_features=256, affine=aff),
+            nn.Conv2d(in_channels=2*conv_dim, out_channels=2*conv_dim, kernel_size=(4, 8), stride=(2, 2), padding=(1, 3), bias=False),
+            nn.InstanceNorm2d(num_features=2*conv_dim, affine=aff),
             nn.LeakyReLU(0.2),
             #GLU()
         )
-        # Down-conversion layers.
+        # Down-conversion layers, 36 mcep bins are down sampled to 9
         self.down_conversion = nn.Sequential(
-            nn.Conv1d(in_channels=2304,
-                      out_channels=256,
+            nn.Conv1d(in_channels=2*conv_dim*9,
+                      out_channels=res_dim,
                       kernel_size=1,
                       stride=1,
                       padding=0,
                       bias=False),
-            nn.InstanceNorm1d(num_features=256, affine=aff)
+            nn.InstanceNorm1d(num_features=res_dim, affine=aff)
         )
 
         # Bottleneck layers.
-        self.residual_1 = eval(self.res_block_name)(dim_in=256, dim_out=256)
-        self.residual_2 = eval(self.res_block_name)(dim_in=256, dim_out=256)
-        self.residual_3 = eval(self.res_block_name)(dim_in=256, dim_out=256)
-        self.residual_4 = eval(self.res_block_name)(dim_in=256, dim_out=256)
-        self.residual_5 = eval(self.res_block_name)(dim_in=256, dim_out=256)
-        self.residual_6 = eval(self.res_block_name)(dim_in=256, dim_out=256)
-        self.residual_7 = eval(self.res_block_name)(dim_in=256, dim_out=256)
-        self.residual_8 = eval(self.res_block_name)(dim_in=256, dim_out=256)
-        self.residual_9 = eval(self.res_block_name)(dim_in=256, dim_out=256)
+        for i in range(1, num_blocks + 1):
+            self.add_module(f'residual_{i}', eval(self.res_block_name)(dim_in=res_dim, dim_out=res_dim))
 
         # Up-conversion layers.
-        self.up_conversion = nn.Conv1d(in_channels=256,
-                                       out_channels=2304,
+        self.up_conversion = nn.Conv1d(in_channels=res_dim,
+                                       out_channels=2*conv_dim*9,
                                        kernel_size=1,
                                        stride=1,
                                        padding=0,
@@ -903,41 +1069,41 @@ class Generator(nn.Module):
 
         # Up-sampling layers.
 
-        self.up_sample_1 = nn.ConvTranspose2d(256, 256, kernel_size = 4, stride = 2, padding = 1)
-        self.up_in_1 = nn.InstanceNorm2d(256, affine = True)
+        self.up_sample_1 = nn.ConvTranspose2d(2*conv_dim, 2*conv_dim, kernel_size = 4, stride = 2, padding = 1)
+        self.up_in_1 = nn.InstanceNorm2d(2*conv_dim, affine = True)
         #self.up_relu_1 = GLU()
         self.up_relu_1 = nn.LeakyReLU(0.2)
 
-        self.up_sample_2 = nn.ConvTranspose2d(256, 128, kernel_size = 4, stride = 2, padding = 1 )
-        self.up_in_2 = nn.InstanceNorm2d(128, affine = True)
+        self.up_sample_2 = nn.ConvTranspose2d(2*conv_dim, conv_dim, kernel_size = 4, stride = 2, padding = 1 )
+        self.up_in_2 = nn.InstanceNorm2d(conv_dim, affine = True)
         #self.up_relu_2 = GLU()
         self.up_relu_2 = nn.LeakyReLU(0.2)
         
         # Out.
-        self.out = nn.Conv2d(in_channels=128, out_channels=1, kernel_size=7, stride=1, padding=3, bias=False)
+        self.out = nn.Conv2d(in_channels=conv_dim, out_channels=1, kernel_size=7, stride=1, padding=3, bias=False)
 
     def forward(self, x, c_src, c_trg):
         width_size = x.size(3)
 
+        x = self.run_segment('down', self.encode, x)
+        for block in self.residual_blocks():
+            x = self.run_segment('res', block, x, c_src, c_trg)
+        return self.run_segment('up', self.decode, x, width_size)
+
+    def encode(self, x):
+        width_size = x.size(3)
+
         x = self.down_sample_1(x)
         x = self.down_sample_2(x)
         x = self.down_sample_3(x)
 
-        x = x.contiguous().view(-1, 2304, width_size // 4)
+        x = x.contiguous().view(-1, 2*self.conv_dim*9, width_size // 4)
         x = self.down_conversion(x)
+        return x
 
-        x = self.residual_1(x, c_src, c_trg)
-        x = self.residual_2(x, c_src, c_trg)
-        x = self.residual_3(x, c_src, c_trg)
-        x = self.residual_4(x, c_src, c_trg)
-        x = self.residual_5(x, c_src, c_trg)
-        x = self.residual_6(x, c_src, c_trg)
-        x = self.residual_7(x, c_src, c_trg)
-        x = self.residual_8(x, c_src, c_trg)
-        x = self.residual_9(x, c_src, c_trg)
-
+    def decode(self, x, width_size):
         x = self.up_conversion(x)
-        x = x.view(-1, 256, 9, width_size // 4)
+        x = x.view(-1, 2*self.conv_dim, 9, width_size // 4)
 
         x = self.up_sample_1(x)
         x = self.up_in_1(x)
@@ -952,6 +1118,16 @@ class Generator(nn.Module):
         return x
 
 
+class GeneratorSlim(Generator):
+    """
+        [1019 new feature]: slim student generator for distillation, Generator with
+        3 residual blocks at 128 channels and 64 / 128 channels in the 2D stacks by default
+    """
+    def __init__(self, num_speakers=4, aff = True, res_block_name = '', num_blocks = 3, res_dim = 128, conv_dim = 64):
+        super(GeneratorSlim, self).__init__(num_speakers = num_speakers, aff = aff, res_block_name = res_block_name,
+                                            num_blocks = num_blocks, res_dim = res_dim, conv_dim = conv_dim)
+
+
 class Discriminator(nn.Module):
     """Discriminator network."""
     def __init__(self, num_speakers=10):
@@ -1024,12 +1200,12 @@ class Discriminator(nn.Module):
         b, c, h, w = x.size()
         x = x.view(b,c, h*w)
         x = torch.mean(x, dim = 2)
-        x = self.fully_connected(x)
-        #x = torch.sigmoid(x)
 
-        idx = torch.LongTensor(range(x.size(0))).to(x.device)
-
-        x = x[idx, c_.long()]
+        # [1019 new feature]: only project onto the fully_connected row of the selected speaker
+        c_ = c_.long().view(-1)
+        weight = self.fully_connected.weight.index_select(0, c_) # b 512
+        bias = self.fully_connected.bias.index_select(0, c_) # b
+        x = torch.sum(x * weight, dim = 1) + bias
 
         return x
 '''
@@ -1160,17 +1336,11 @@ class PatchDiscriminator(nn.Module):
         x = self.down_sample_3(x)
         
         x = self.down_sample_4(x)
-        
-        x = self.dis_conv(x)
-        
-
-        b, c, h, w = x.size()
-        x = x.view(b,c)
-        #x = x.view(b,c, h * w)
-        #x = torch.mean(x, dim = 2)
 
-        idx = torch.LongTensor(range(x.size(0))).to(x.device)
-
-        x = x[idx, c_.long()]
+        # [1019 new feature]: only apply the dis_conv filter of the selected speaker,
+        # the (1,8) kernel covers the whole 1 x 8 map so the conv is a dot product per sample
+        assert x.size()[2:] == self.dis_conv.weight.size()[2:], f'PatchDiscriminator expects 256 frame inputs, got feature map {x.size()}'
+        weight = self.dis_conv.weight.index_select(0, c_.long().view(-1)) # b 512 1 8
+        x = torch.sum(x * weight, dim = [1, 2, 3])
 
         return x
@@ -0,0 +1,197 @@
+'''
+    ONNX export of the generator / speaker encoder and an ONNX Runtime backend for convert.py.
+
+    Graphs are exported with a dynamic batch and time axis. The generator down / up samples the time axis
+    by 4, OnnxGenerator pads the input to a multiple of 4 and crops the output back, like coded_sp_padding.
+    The speaker encoder keeps all speaker heads as constants and selects one with the int64 speaker label input.
+'''
+import os
+
+import numpy as np
+import torch
+
+from stgan_adain.stylegan2_module import get_modconv_impl, set_modconv_impl
+
+
+def export_generator(G, path, opset = 13, num_frames = 128):
+
+    G.eval()
+    # grouped modulated convs use groups = batch_size, which can not be a dynamic axis, export the fused path
+    impl = get_modconv_impl()
+    set_modconv_impl('fused')
+    try:
+        device = next(G.parameters()).device
+        mc = torch.randn(1, 1, 36, num_frames, device = device)
+        c_src = torch.randn(1, 128, device = device)
+        c_trg = torch.randn(1, 128, device = device)
+        with torch.no_grad():
+            torch.onnx.export(G, (mc, c_src, c_trg), path,
+                              input_names = ['mc', 'c_src', 'c_trg'],
+                              output_names = ['mc_converted'],
+                              dynamic_axes = {'mc': {0: 'batch', 3: 'time'},
+                                              'c_src': {0: 'batch'},
+                                              'c_trg': {0: 'batch'},
+                                              'mc_converted': {0: 'batch', 3: 'time'}},
+                              opset_version = opset)
+    finally:
+        # the dispatch is process wide, later conversion / training keeps its configured implementation
+        set_modconv_impl(impl)
+    print(f'export generator to {path}', flush=True)
+
+
+def export_speaker_encoder(sp_enc, path, opset = 13, num_frames = 128):
+
+    sp_enc.eval()
+    device = next(sp_enc.parameters()).device
+    mc = torch.randn(1, 1, 36, num_frames, device = device)
+    label = torch.zeros(1, dtype = torch.long, device = device)
+    with torch.no_grad():
+        torch.onnx.export(sp_enc, (mc, label), path,
+                          input_names = ['mc', 'label'],
+                          output_names = ['spk_cond'],
+                          dynamic_axes = {'mc': {0: 'batch', 3: 'time'},
+                                          'label': {0: 'batch'},
+                                          'spk_cond': {0: 'batch'}},
+                          opset_version = opset)
+    print(f'export speaker encoder to {path}', flush=True)
+
+
+class OnnxModule(object):
+    '''ONNX Runtime session called like the torch module it was exported from, torch tensors in and out'''
+
+    def __init__(self, path, num_threads = None):
+
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.path = path
+        self.session = ort.InferenceSession(path, options, providers = ['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        print(f'load onnx model {path}', flush=True)
+
+    def run(self, *inputs):
+        feed = {name: x.detach().cpu().numpy() for name, x in zip(self.input_names, inputs)}
+        return self.session.run(None, feed)[0]
+
+    def __call__(self, *inputs):
+        device = inputs[0].device
+        return torch.from_numpy(self.run(*inputs)).to(device)
+
+    def eval(self):
+        return self
+
+
+class OnnxGenerator(OnnxModule):
+
+    def __call__(self, x, c_src, c_trg):
+        num_frames = x.size(3)
+        pad = (-num_frames) % 4
+        if pad > 0:
+            x = torch.nn.functional.pad(x, (pad // 2, pad - pad // 2))
+        out = super().__call__(x, c_src, c_trg)
+        return out[..., pad // 2: pad // 2 + num_frames]
+
+
+class OnnxSPEncoder(OnnxModule):
+
+    def __call__(self, x, trg_c):
+        return super().__call__(x, trg_c.long().view(-1))
+
+
+def check_outputs(name, torch_out, onnx_out, atol = 1e-3):
+    '''compare onnx runtime and pytorch outputs, raise if they drift apart'''
+    diff = (torch_out.detach().cpu() - onnx_out.detach().cpu()).abs().max().item()
+    print(f'onnx check {name}: max abs diff {diff:.2e}', flush=True)
+    if not diff <= atol:
+        raise Exception(f'onnx {name} output differs from pytorch by {diff} > {atol}')
+    return diff
+
+
+def onnx_paths(onnx_dir, resume_iters, use_ema = False):
+    suffix = '.ema' if use_ema else ''
+    return (os.path.join(onnx_dir, f'{resume_iters}-G{suffix}.onnx'),
+            os.path.join(onnx_dir, f'{resume_iters}-sp{suffix}.onnx'))
+
+
+def verify_export(G, sp_enc, G_onnx, sp_onnx, num_speakers, lengths = (64, 257), atol = 1e-3):
+    '''run pytorch and onnx runtime on random inputs of a few lengths, including one that is not a multiple of 4'''
+    device = next(G.parameters()).device
+    for num_frames in lengths:
+        mc = torch.randn(2, 1, 36, num_frames, device = device)
+        label = torch.LongTensor(np.random.randint(0, num_speakers, size = 2)).to(device)
+        with torch.no_grad():
+            cond = sp_enc(mc, label)
+            check_outputs(f'speaker encoder T={num_frames}', cond, sp_onnx(mc, label), atol)
+            pad = (-num_frames) % 4
+            mc_padded = torch.nn.functional.pad(mc, (pad // 2, pad - pad // 2))
+            ref = G(mc_padded, cond, cond.flip(0))[..., pad // 2: pad // 2 + num_frames]
+            out = G_onnx(mc, cond, cond.flip(0))
+            check_outputs(f'generator T={num_frames}', ref, out, atol)
+
+
+# [1019 new feature]: int8 post training quantization of the exported graphs with onnxruntime
+#   dynamic: weights in int8, activation ranges computed per batch at run time
+#   static:  activation ranges calibrated on test mceps, QDQ graph
+def quantized_path(path):
+    return path.replace('.onnx', '.int8.onnx')
+
+
+def load_calibration_mcs(mc_dir, speakers, num_utts = 32, max_frames = 512):
+    '''(mc, label) pairs from the {spk}_*.npy files of mc_dir, cropped to a multiple of 4 frames'''
+    from glob import glob
+    mcs = []
+    per_spk = max(1, num_utts // len(speakers))
+    for label, spk in enumerate(speakers):
+        for mc_path in sorted(glob(os.path.join(mc_dir, f'{spk}_*.npy')))[:per_spk]:
+            mc = np.load(mc_path).T # 36 T
+            num_frames = min(mc.shape[1], max_frames) // 4 * 4
+            if num_frames == 0:
+                continue
+            mcs.append((mc[np.newaxis, np.newaxis, :, :num_frames].astype(np.float32), np.array([label], dtype = np.int64)))
+    if len(mcs) == 0:
+        raise Exception(f'no calibration mcep found in {mc_dir}')
+    print(f'load {len(mcs)} calibration utterances from {mc_dir}', flush=True)
+    return mcs
+
+
+class _FeedReader(object):
+    '''onnxruntime CalibrationDataReader over a list of input dicts'''
+
+    def __init__(self, feeds):
+        self.feeds = iter(feeds)
+
+    def get_next(self):
+        return next(self.feeds, None)
+
+
+def calibration_feeds(sp_path, mcs):
+    '''input dicts of the speaker encoder and of the generator, conditions come from the fp32 speaker encoder'''
+    sp_enc = OnnxSPEncoder(sp_path)
+    sp_feeds, G_feeds = [], []
+    for i, (mc, label) in enumerate(mcs):
+        sp_feeds.append({'mc': mc, 'label': label})
+        c_src = sp_enc.session.run(None, {'mc': mc, 'label': label})[0]
+        trg_mc, trg_label = mcs[(i + 1) % len(mcs)]
+        c_trg = sp_enc.session.run(None, {'mc': trg_mc, 'label': trg_label})[0]
+        G_feeds.append({'mc': mc, 'c_src': c_src, 'c_trg': c_trg})
+    return sp_feeds, G_feeds
+
+
+def quantize_graph(path, mode = 'dynamic', feeds = None):
+
+    from onnxruntime import quantization as ortq
+    out_path = quantized_path(path)
+    if mode == 'dynamic':
+        ortq.quantize_dynamic(path, out_path, weight_type = ortq.QuantType.QInt8)
+    elif mode == 'static':
+        ortq.quantize_static(path, out_path, _FeedReader(feeds),
+                             quant_format = ortq.QuantFormat.QDQ,
+                             activation_type = ortq.QuantType.QUInt8,
+                             weight_type = ortq.QuantType.QInt8,
+                             per_channel = True)
+    else:
+        raise Exception(f'unknown quantization mode {mode}')
+    print(f'{mode} int8 quantize {path} to {out_path}', flush=True)
+    return out_path
@@ -0,0 +1,165 @@
+import json
+import os
+import resource
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import torch
+
+
+class StepProfiler(object):
+    """Per-phase wall clock profiler for Solver.train.
+
+        Every training step is split into named phases (data wait, h2d copy, sp_enc forward,
+        D/G forward/backward/step, ema, logging, checkpoint and sample io). Phase timings are
+        kept in rolling windows of per-step seconds and emitted as one json line per call of `emit`.
+        When `sync` is set, cuda is synchronized at phase boundaries so that asynchronous kernels
+        are charged to the phase that launched them.
+        A torch.profiler trace can be captured for a window of steps [trace_start, trace_start + trace_steps).
+    """
+
+    def __init__(self, path, device, window = 100, sync = True, trace_start = None, trace_steps = 0, trace_dir = None):
+
+        self.path = path
+        self.device = device
+        self.window = window
+        self.sync = sync and device.type == 'cuda'
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.trace_dir = trace_dir
+        self._trace = None
+
+        self.phases = OrderedDict()
+        self.totals = OrderedDict()
+        self.step_times = deque(maxlen = window)
+        self._current = OrderedDict()
+        self._step_start = None
+        self._last_emit_time = time.time()
+        self._last_emit_step = None
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+        self._fp = open(path, 'a')
+        print(f'profiling Solver.train into {path}', flush=True)
+
+    def _synchronize(self):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+
+    @contextmanager
+    def phase(self, name):
+        self._synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._synchronize()
+            elapsed = time.perf_counter() - start
+            # a phase can be entered several times per step (e.g. sp_enc), sum them up
+            self._current[name] = self._current.get(name, 0.) + elapsed
+
+    def step_begin(self, step):
+        self._current = OrderedDict()
+        self._step_start = time.perf_counter()
+        if self.trace_start is not None and step == self.trace_start:
+            self._start_trace()
+
+    def step_end(self, step):
+        self.step_times.append(time.perf_counter() - self._step_start)
+        for name in self._current:
+            if name not in self.phases:
+                self.phases[name] = deque(maxlen = self.window)
+                self.totals[name] = 0.
+        # phases that did not run in this step (e.g. checkpoint) count as zero, so averages are per step
+        for name, times in self.phases.items():
+            elapsed = self._current.get(name, 0.)
+            times.append(elapsed)
+            self.totals[name] += elapsed
+        if self._trace is not None:
+            self._trace.step()
+            if step + 1 >= self.trace_start + self.trace_steps:
+                self._stop_trace()
+
+    def _start_trace(self):
+        # torch.profiler only exists in newer pytorch, import it lazily
+        from torch import profiler
+        activities = [profiler.ProfilerActivity.CPU]
+        if self.device.type == 'cuda':
+            activities.append(profiler.ProfilerActivity.CUDA)
+        trace_dir = self.trace_dir if self.trace_dir is not None else os.path.dirname(self.path)
+        self._trace = profiler.profile(activities = activities,
+                                       record_shapes = True,
+                                       profile_memory = True,
+                                       on_trace_ready = profiler.tensorboard_trace_handler(trace_dir))
+        self._trace.__enter__()
+        print(f'start torch.profiler trace for {self.trace_steps} steps into {trace_dir}', flush=True)
+
+    def _stop_trace(self):
+        self._trace.__exit__(None, None, None)
+        self._trace = None
+        print('stop torch.profiler trace', flush=True)
+
+    def peak_memory(self):
+        """Peak memory in MB, device memory on cuda and max rss on cpu."""
+        if self.device.type == 'cuda':
+            return torch.cuda.max_memory_allocated(self.device) / 2**20
+        # ru_maxrss is in KB on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+    def summary(self, step):
+        step_avg = sum(self.step_times) / max(len(self.step_times), 1)
+        phases = OrderedDict()
+        for name, times in self.phases.items():
+            avg = sum(times) / max(len(times), 1)
+            phases[name] = {
+                'last': times[-1] if len(times) > 0 else 0.,
+                'avg': avg,
+                'frac': avg / step_avg if step_avg > 0 else 0.,
+                'total': self.totals[name],
+            }
+        now = time.time()
+        steps = step - self._last_emit_step if self._last_emit_step is not None else None
+        record = OrderedDict([
+            ('step', step),
+            ('time', now),
+            ('step_time_avg', step_avg),
+            ('steps_per_sec', steps / (now - self._last_emit_time) if steps else None),
+            ('peak_mem_mb', self.peak_memory()),
+            ('phases', phases),
+        ])
+        self._last_emit_time = now
+        self._last_emit_step = step
+        return record
+
+    def emit(self, step, **extra):
+        record = self.summary(step)
+        record.update(extra)
+        self._fp.write(json.dumps(record) + '\n')
+        self._fp.flush()
+        return record
+
+    def close(self):
+        if self._trace is not None:
+            self._stop_trace()
+        self._fp.close()
+
+
+class NullProfiler(object):
+    """Drop-in StepProfiler used when profiling is off, every call is a no-op."""
+
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    def step_begin(self, step):
+        pass
+
+    def step_end(self, step):
+        pass
+
+    def emit(self, step, **extra):
+        return None
+
+    def close(self):
+        pass
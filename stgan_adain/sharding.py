@@ -0,0 +1,72 @@
+'''
+    [1019 new feature]: sharded, resumable all-pairs conversion
+
+    Jobs are the source utterances of the all-pairs sweep, each converted to all of its target speakers, so the
+    shared source analysis stays on one host. A source utterance belongs to shard md5(src/utterance) % N, which
+    does not depend on the speaker list order or on num_converted_wavs. Converted wavs are written to a temporary
+    file and renamed, so a wav that exists with a consistent RIFF header is complete and is skipped on restart.
+'''
+import os
+import hashlib
+import struct
+
+import librosa
+
+
+def parse_shard(shard):
+    '''"i/N" -> (i, N), None -> (0, 1)'''
+    if shard is None:
+        return 0, 1
+    try:
+        index, num_shards = (int(x) for x in shard.split('/'))
+    except ValueError:
+        raise Exception(f'shard should be i/N, got {shard}')
+    if not 0 <= index < num_shards:
+        raise Exception(f'shard index {index} out of range for {num_shards} shards')
+    return index, num_shards
+
+
+def shard_of(src_spk, wav_name, num_shards):
+    return int(hashlib.md5(f'{src_spk}/{wav_name}'.encode('utf-8')).hexdigest(), 16) % num_shards
+
+
+def valid_wav(path):
+    '''the wav exists and its RIFF size matches the file size, i.e. it was completely written'''
+    try:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            header = f.read(12)
+    except OSError:
+        return False
+    if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        return False
+    return struct.unpack('<I', header[4:8])[0] + 8 == size and size > 44
+
+
+def write_wav_atomic(path, wav, sampling_rate):
+    tmp_path = f'{path}.part'
+    librosa.output.write_wav(tmp_path, wav, sampling_rate)
+    os.replace(tmp_path, path)
+
+
+class ShardFilter(object):
+    '''which (source utterance, target) conversions this run still has to do'''
+
+    def __init__(self, shard = None, skip_existing = True):
+        self.index, self.num_shards = parse_shard(shard)
+        self.skip_existing = skip_existing
+        self.skipped = 0
+
+    def owns(self, src_spk, wav_name):
+        return shard_of(src_spk, wav_name, self.num_shards) == self.index
+
+    def todo(self, src_spk, wav_name, out_path):
+        if not self.owns(src_spk, wav_name):
+            return False
+        if self.skip_existing and valid_wav(out_path):
+            self.skipped += 1
+            return False
+        return True
+
+    def summary(self):
+        print(f'shard {self.index}/{self.num_shards}: skipped {self.skipped} conversions with a valid output', flush=True)
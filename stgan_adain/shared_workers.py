@@ -0,0 +1,75 @@
+'''
+    [1019 new feature]: multi-process cpu conversion with the model weights shared between processes
+
+    The parent process loads G / sp_enc once and moves their parameters and buffers to shared memory. Workers
+    are forked and inherit the models (and the rest of the worker state) without pickling, every worker runs
+    on the same weight storages instead of its own copy. The available physical cores are split between the
+    workers, each worker is pinned to its slice and runs that many torch intra-op threads, so the workers do
+    not oversubscribe the cores.
+'''
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import torch
+import torch.nn as nn
+
+from cpu_affinity import available_cores, physical_cores, pin_process
+
+# state of the current worker process, inherited from the parent at fork
+_WORKER = {}
+
+
+def share_weights(model):
+    '''move the weights of model, or of the modules wrapped by it (ChunkedGenerator, ...), to shared memory'''
+    if isinstance(model, nn.Module):
+        return model.share_memory()
+    for value in vars(model).values():
+        if isinstance(value, nn.Module):
+            value.share_memory()
+    return model
+
+
+def partition_cores(num_workers, worker_threads = None):
+    '''one list of physical cores per worker, worker_threads cores each (all cores split evenly by default)'''
+    cores = physical_cores(available_cores())
+    if worker_threads is None:
+        worker_threads = max(1, len(cores) // num_workers)
+    return [[cores[(i * worker_threads + j) % len(cores)] for j in range(worker_threads)] for i in range(num_workers)]
+
+
+def _init_worker(state, core_queue):
+    cores = core_queue.get()
+    pin_process(cores)
+    torch.set_num_threads(len(cores))
+    _WORKER.update(state)
+    _WORKER['cores'] = cores
+
+
+def worker_state():
+    '''the state dict given to SharedModelPool, in a worker process'''
+    return _WORKER
+
+
+class SharedModelPool(object):
+    '''
+        fork context process pool, state (models after share_weights, settings) is handed to the workers once
+        at fork, not per task
+    '''
+
+    def __init__(self, state, num_workers, worker_threads = None):
+        self.state = state
+        self.num_workers = num_workers
+        self.core_slices = partition_cores(num_workers, worker_threads)
+
+    def map(self, fn, tasks):
+        '''yields (task, fn(task)) in completion order, fn runs in a worker and reads worker_state()'''
+        context = multiprocessing.get_context('fork')
+        core_queue = context.Queue()
+        for cores in self.core_slices:
+            core_queue.put(cores)
+        print(f'{self.num_workers} conversion workers sharing the model weights, cores {self.core_slices}', flush=True)
+        with ProcessPoolExecutor(self.num_workers, mp_context = context, initializer = _init_worker,
+                                 initargs = (self.state, core_queue)) as pool:
+            futures = {pool.submit(fn, task): task for task in tasks}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
@@ -1,6 +1,8 @@
 from stgan_adain.model import Generator
 from stgan_adain.model import GeneratorSplit
 from stgan_adain.model import Generator2D
+from stgan_adain.model import GeneratorSlim
+from stgan_adain.streaming import GeneratorStream
 from stgan_adain.model import PatchDiscriminator 
 from stgan_adain.model import Discriminator
 from stgan_adain.model import SPEncoder
@@ -8,8 +10,11 @@ from stgan_adain.model import SPEncoderPool
 from stgan_adain.model import SPEncoderPool1D
 from stgan_adain.model import SPEncoderTDNNPool
 from stgan_adain.resnet_speaker_encoder import ResSPEncoder
+from stgan_adain.profiler import StepProfiler, NullProfiler
+from stgan_adain.metric_sink import MetricSink
 import torch
 import torch.nn.functional as F
+from torch.utils import data
 from os.path import join, basename, exists
 import time
 import datetime
@@ -18,6 +23,7 @@ from utils import *
 from tqdm import tqdm
 import numpy as np
 import copy
+import json
 class Solver(object):
     """Solver for training and testing StarGAN."""
 
@@ -34,6 +40,18 @@ class Solver(object):
         self.SPE_name = config.spenc
         self.G_name = config.generator
         self.res_block_name = config.res_block
+        self.stream_lookahead = config.stream_lookahead
+        self.grad_checkpoint = [seg for seg in config.grad_checkpoint.split(',') if seg] if config.grad_checkpoint else []
+        # [1019 new feature]: slim student generator and its frozen teacher for distillation
+        self.student_blocks = config.student_blocks
+        self.student_res_dim = config.student_res_dim
+        self.student_conv_dim = config.student_conv_dim
+        self.teacher_dir = config.teacher_dir
+        self.teacher_iters = config.teacher_iters
+        self.teacher_generator = config.teacher_generator
+        self.teacher_res_block = config.teacher_res_block
+        self.teacher_ema = config.teacher_ema
+        self.lambda_distill_spk = config.lambda_distill_spk
         # Model configurations.
         self.num_speakers = config.num_speakers
         self.lambda_rec = config.lambda_rec
@@ -47,6 +65,10 @@ class Solver(object):
         self.drop_affine = config.drop_affine
         # Training configurations.
         self.batch_size = config.batch_size
+        self.min_length = config.min_length
+        # [1019 new feature]: progressive crop length curriculum
+        self.crop_schedule = self.parse_crop_schedule(config.crop_schedule)
+        self.crop_max_batch = config.crop_max_batch
         self.num_iters = config.num_iters
         self.num_iters_decay = config.num_iters_decay
         self.g_lr = config.g_lr
@@ -60,7 +82,9 @@ class Solver(object):
         self.test_iters = config.test_iters
         # Miscellaneous.
         self.use_tensorboard = config.use_tensorboard
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.metric_sink = config.metric_sink
+        self.cpu_mode = config.cpu_mode
+        self.device = torch.device('cuda' if torch.cuda.is_available() and not self.cpu_mode else 'cpu')
 
         # Directories.
         self.log_dir = config.log_dir
@@ -73,14 +97,34 @@ class Solver(object):
         self.model_save_step = config.model_save_step
         self.lr_update_step = config.lr_update_step
 
+        # [1019 new feature]: per-phase step profiler
+        self.profile = config.profile
+        self.profile_path = config.profile_path
+        self.profile_window = config.profile_window
+        self.profile_sync = config.profile_sync
+        self.profile_trace_start = config.profile_trace_start
+        self.profile_trace_steps = config.profile_trace_steps
+
+        if self.crop_schedule is not None and self.D_name == 'PatchDiscriminator':
+            # dis_conv of PatchDiscriminator covers exactly the 8 columns left from a 256 frame crop
+            raise Exception(f'crop_schedule needs a length agnostic discriminator, {self.D_name} only takes {self.min_length} frames')
+
         # Build the model and tensorboard.
         self.build_model()
-        if self.use_tensorboard:
-            self.build_tensorboard()
+        self.build_tensorboard()
+        self.build_profiler()
 
     def build_model(self):
         """Create a generator and a discriminator."""
-        self.generator = eval(self.G_name)(num_speakers=self.num_speakers, aff = self.drop_affine, res_block_name = self.res_block_name)
+        # [1019 new feature]: causal streaming generator, look-ahead frames of its first conv
+        g_kwargs = {'lookahead': self.stream_lookahead} if self.G_name == 'GeneratorStream' else {}
+        if self.G_name == 'GeneratorSlim':
+            g_kwargs = {'num_blocks': self.student_blocks, 'res_dim': self.student_res_dim, 'conv_dim': self.student_conv_dim}
+        self.generator = eval(self.G_name)(num_speakers=self.num_speakers, aff = self.drop_affine, res_block_name = self.res_block_name, **g_kwargs)
+        if self.grad_checkpoint:
+            # [1019 new feature]: recompute activations of these generator segments in backward
+            self.generator.set_checkpointing(self.grad_checkpoint)
+            print('activation checkpointing of generator segments {}'.format(','.join(self.grad_checkpoint)), flush=True)
         self.discriminator = eval(self.D_name)(num_speakers=self.num_speakers)
         self.sp_enc = eval(self.SPE_name)(num_speakers = self.num_speakers, spk_cls = self.spk_cls)
         
@@ -100,6 +144,132 @@ class Solver(object):
         self.sp_enc.to(self.device)
         self.generator_ema.to(self.device)
         self.sp_enc_ema.to(self.device)
+    def build_teacher(self):
+        """Load the frozen teacher generator and speaker encoder for distillation."""
+        suffix = '.ema' if self.teacher_ema else ''
+        g_path = os.path.join(self.teacher_dir, '{}-G.ckpt{}'.format(self.teacher_iters, suffix))
+        sp_path = os.path.join(self.teacher_dir, '{}-sp.ckpt{}'.format(self.teacher_iters, suffix))
+        print('Loading the teacher models from {} and {}...'.format(g_path, sp_path), flush=True)
+
+        self.teacher = eval(self.teacher_generator)(num_speakers=self.num_speakers, aff = self.drop_affine, res_block_name = self.teacher_res_block)
+        self.teacher.load_state_dict(torch.load(g_path, map_location=lambda storage, loc: storage))
+        # the student is conditioned on the teacher speaker encoder, it is saved with the student checkpoints
+        self.sp_enc.load_state_dict(torch.load(sp_path, map_location=lambda storage, loc: storage))
+        for model in [self.teacher, self.sp_enc]:
+            model.to(self.device)
+            model.eval()
+            for param in model.parameters():
+                param.requires_grad = False
+
+    def distill_report(self, step, test_mcs):
+        """Speedup of the student against MCD and speaker similarity loss to the teacher on the test mceps."""
+        trg_idx = torch.LongTensor([self.test_loader.spk_idx]).to(self.device)
+        src_idx = torch.LongTensor([self.test_loader.src_spk_idx]).to(self.device)
+        times = {'teacher': 0., 'student': 0.}
+        mcds, spk_losses = [], []
+        self.generator.eval()
+        with torch.no_grad():
+            trg_mc = torch.FloatTensor(test_mcs[0][1].T).unsqueeze_(0).unsqueeze_(1).to(self.device)
+            trg_conds = self.sp_enc(trg_mc, trg_idx)
+            for mc_src, _ in test_mcs:
+                # whole utterance, cropped to a multiple of 4 frames
+                mc_src = mc_src[: mc_src.shape[0] // 4 * 4]
+                src_mc = torch.FloatTensor(mc_src.T).unsqueeze_(0).unsqueeze_(1).to(self.device)
+                src_conds = self.sp_enc(src_mc, src_idx)
+                outs = {}
+                for name, model in [('teacher', self.teacher), ('student', self.generator)]:
+                    if self.device.type == 'cuda':
+                        torch.cuda.synchronize(self.device)
+                    start = time.perf_counter()
+                    outs[name] = model(src_mc, src_conds, trg_conds)
+                    if self.device.type == 'cuda':
+                        torch.cuda.synchronize(self.device)
+                    times[name] += time.perf_counter() - start
+                coded_sps = {name: np.squeeze(out.cpu().numpy()).T * self.test_loader.mcep_std_trg + self.test_loader.mcep_mean_trg
+                             for name, out in outs.items()}
+                mcds.append(mel_cepstral_distortion(coded_sps['student'], coded_sps['teacher']))
+                spk_student = self.sp_enc(outs['student'], trg_idx)
+                spk_teacher = self.sp_enc(outs['teacher'], trg_idx)
+                spk_losses.append(1. - F.cosine_similarity(spk_student, spk_teacher).mean().item())
+        self.generator.train()
+
+        report = {'step': step,
+                  'speedup': times['teacher'] / times['student'],
+                  'teacher_time': times['teacher'] / len(test_mcs),
+                  'student_time': times['student'] / len(test_mcs),
+                  'mcd': float(np.mean(mcds)),
+                  'spk_sim_loss': float(np.mean(spk_losses))}
+        print('distill report: step {step}, speedup {speedup:.2f}x, MCD to teacher {mcd:.4f} dB, '
+              'speaker similarity loss {spk_sim_loss:.4f}'.format(**report), flush=True)
+        with open(join(self.log_dir, 'distill_report.jsonl'), 'a') as f:
+            f.write(json.dumps(report) + '\n')
+        return report
+
+    def distill(self):
+        """Train the student generator on the outputs of a frozen teacher."""
+        self.build_teacher()
+        train_loader = self.train_loader
+        data_iter = iter(train_loader)
+        test_mcs = [(mc_src, mc_trg) for (_, mc_src, mc_trg) in self.test_loader.get_batch_test_data(batch_size=10)]
+
+        self.g_optimizer = torch.optim.Adam(self.generator.parameters(), self.g_lr, [self.beta1, self.beta2])
+        self.print_network(self.teacher, 'Teacher')
+
+        start_iters = 0
+        if self.resume_iters:
+            print("resuming step %d ..."% self.resume_iters, flush=True)
+            start_iters = self.resume_iters
+            self.generator.load_state_dict(torch.load(os.path.join(self.model_save_dir, '{}-G.ckpt'.format(self.resume_iters)), map_location=lambda storage, loc: storage))
+
+        print('Start distillation...', flush=True)
+        start_time = time.time()
+        for i in range(start_iters, self.num_iters):
+            try:
+                mc_src, spk_label_org, spk_c_org, mc_trg, spk_label_trg, spk_c_trg = next(data_iter)
+            except:
+                data_iter = iter(train_loader)
+                mc_src, spk_label_org, spk_c_org, mc_trg, spk_label_trg, spk_c_trg = next(data_iter)
+
+            mc_src = mc_src.unsqueeze(1).to(self.device)
+            mc_trg = mc_trg.unsqueeze(1).to(self.device)
+            spk_label_org = spk_label_org.to(self.device)
+            spk_label_trg = spk_label_trg.to(self.device)
+
+            with torch.no_grad():
+                spk_c_trg = self.sp_enc(mc_trg, spk_label_trg)
+                spk_c_org = self.sp_enc(mc_src, spk_label_org)
+                mc_teacher = self.teacher(mc_src, spk_c_org, spk_c_trg)
+
+            mc_student = self.generator(mc_src, spk_c_org, spk_c_trg)
+            loss_distill = torch.mean(torch.abs(mc_student - mc_teacher))
+            # speaker encoder embeddings of student and teacher outputs should agree too
+            loss_spk = torch.mean(torch.abs(self.sp_enc(mc_student, spk_label_trg) - self.sp_enc(mc_teacher, spk_label_trg)))
+            loss = loss_distill + self.lambda_distill_spk * loss_spk
+
+            self.g_optimizer.zero_grad()
+            loss.backward()
+            self.g_optimizer.step()
+            self.moving_average(self.generator, self.generator_ema)
+
+            self.accumulate_loss('S/loss_distill', loss_distill)
+            self.accumulate_loss('S/loss_spk', loss_spk)
+
+            if (i+1) % self.log_step == 0:
+                et = time.time() - start_time
+                et = str(datetime.timedelta(seconds=et))[:-7]
+                self.flush_loss(i+1, "Elapsed [{}], Iteration [{}/{}]".format(et, i+1, self.num_iters))
+
+            if (i+1) % self.model_save_step == 0:
+                # the teacher speaker encoder is saved as the student one, convert.py loads the pair as usual
+                torch.save(self.generator.state_dict(), os.path.join(self.model_save_dir, '{}-G.ckpt'.format(i+1)))
+                torch.save(self.generator_ema.state_dict(), os.path.join(self.model_save_dir, '{}-G.ckpt.ema'.format(i+1)))
+                torch.save(self.sp_enc.state_dict(), os.path.join(self.model_save_dir, '{}-sp.ckpt'.format(i+1)))
+                torch.save(self.sp_enc.state_dict(), os.path.join(self.model_save_dir, '{}-sp.ckpt.ema'.format(i+1)))
+                print('Saved student checkpoints into {}...'.format(self.model_save_dir), flush=True)
+                self.distill_report(i+1, test_mcs)
+
+        self.logger.close()
+
     def print_network(self, model, name):
         """Print out the network information."""
         num_params = 0
@@ -129,14 +299,101 @@ class Solver(object):
         self.sp_enc.load_state_dict(torch.load(sp_path, map_location=lambda storage, loc: storage))
         
         if exists(g_opt_path):
-            self.g_optimizer.load_state_dict(torch.load(g_opt_path, map_location = lambda storage, loc: storage))
+            try:
+                self.g_optimizer.load_state_dict(torch.load(g_opt_path, map_location = lambda storage, loc: storage))
+            except ValueError as e:
+                # optimizer ckpts saved before the speaker heads were merged into one tensor have one param per head
+                print(f'skip restoring g optimizer from {g_opt_path}: {e}', flush=True)
         if exists(d_opt_path):
             self.d_optimizer.load_state_dict(torch.load(d_opt_path, map_location = lambda storage, loc: storage))
 
     def build_tensorboard(self):
-        """Build a tensorboard logger."""
-        from logger import Logger
-        self.logger = Logger(self.log_dir)
+        """Build the asynchronous metric sink, it only prints to stdout if tensorboard is off."""
+        backend = self.metric_sink if self.use_tensorboard else 'none'
+        self.logger = MetricSink(self.log_dir, backend = backend)
+
+        # [1019 new feature]: losses are summed on device and only reduced at log steps
+        self.loss_sum = {}
+        self.loss_cnt = {}
+
+    def accumulate_loss(self, tag, value):
+        """Add a loss tensor to the running sums without a host/device sync."""
+        value = value.detach()
+        if tag in self.loss_sum:
+            self.loss_sum[tag] += value
+            self.loss_cnt[tag] += 1
+        else:
+            self.loss_sum[tag] = value.clone()
+            self.loss_cnt[tag] = 1
+
+    def flush_loss(self, step, prefix):
+        """Hand the mean losses since the last log step over to the metric sink."""
+        if len(self.loss_sum) == 0:
+            return
+        tags = list(self.loss_sum.keys())
+        values = torch.stack([self.loss_sum[tag] / self.loss_cnt[tag] for tag in tags])
+        self.logger.put(step, tags, values, prefix)
+        self.loss_sum = {}
+        self.loss_cnt = {}
+
+    def parse_crop_schedule(self, crop_schedule):
+        """Parse 'crop:until_step,...' e.g. '64:10000,128:30000', min_length crops are used after the last phase."""
+        if crop_schedule is None:
+            return None
+        phases = []
+        for phase in crop_schedule.split(','):
+            crop_length, until_step = phase.split(':')
+            crop_length, until_step = int(crop_length), int(until_step)
+            assert crop_length % 4 == 0, f'crop length {crop_length} should be a multiple of 4'
+            assert crop_length <= self.min_length, f'crop length {crop_length} larger than min_length {self.min_length}'
+            phases.append((crop_length, until_step))
+        assert all(a[1] < b[1] for a, b in zip(phases[:-1], phases[1:])), f'crop schedule steps not increasing {crop_schedule}'
+        return phases
+
+    def crop_phase(self, step):
+        """Return (crop_length, batch_size) at step, the batch grows so that frames per step stay about constant."""
+        crop_length = self.min_length
+        if self.crop_schedule is not None:
+            for phase_crop, until_step in self.crop_schedule:
+                if step < until_step:
+                    crop_length = phase_crop
+                    break
+        batch_size = self.batch_size * self.min_length // crop_length
+        if self.crop_max_batch is not None:
+            batch_size = min(batch_size, self.crop_max_batch)
+        return crop_length, batch_size
+
+    def build_train_loader(self, crop_length, batch_size):
+        """Rebuild the train loader for a crop phase, workers are forked with the new crop length."""
+        dataset = self.train_loader.dataset
+        dataset.set_crop_length(crop_length)
+        print(f'crop curriculum: crop length {crop_length} batch size {batch_size}', flush=True)
+        return data.DataLoader(dataset=dataset,
+                               batch_size=batch_size,
+                               shuffle=True,
+                               num_workers=self.train_loader.num_workers,
+                               worker_init_fn=self.train_loader.worker_init_fn,
+                               drop_last=True)
+
+    def report_crop_phase(self, crop_length, batch_size, steps, elapsed):
+        """Print crop length and throughput of a finished crop phase."""
+        if steps == 0:
+            return
+        frames = crop_length * batch_size * steps
+        print(f'crop phase done: crop length {crop_length} batch size {batch_size} steps {steps} '
+              f'time {elapsed:.1f}s {steps / elapsed:.2f} steps/s {frames / elapsed:.0f} frames/s', flush=True)
+
+    def build_profiler(self):
+        """Build the per-phase step profiler, a no-op one if profiling is off."""
+        if self.profile:
+            profile_path = self.profile_path if self.profile_path is not None else join(self.log_dir, 'profile.jsonl')
+            self.profiler = StepProfiler(profile_path, self.device,
+                                         window = self.profile_window,
+                                         sync = self.profile_sync,
+                                         trace_start = self.profile_trace_start,
+                                         trace_steps = self.profile_trace_steps)
+        else:
+            self.profiler = NullProfiler()
 
     def update_lr(self, g_lr, d_lr):
         """Decay learning rates of the generator and discriminator."""
@@ -214,10 +471,26 @@ class Solver(object):
             start_iters = self.resume_iters
             self.restore_model(self.resume_iters)
 
+        crop_length, batch_size = self.crop_phase(start_iters)
+        if self.crop_schedule is not None:
+            train_loader = self.build_train_loader(crop_length, batch_size)
+            data_iter = iter(train_loader)
+
         # Start training.
         print('Start training...', flush=True)
         start_time = time.time()
+        phase_start_time, phase_start_step = start_time, start_iters
+        log_time = start_time
+        prof = self.profiler
         for i in range(start_iters, self.num_iters):
+            if self.crop_schedule is not None and self.crop_phase(i) != (crop_length, batch_size):
+                self.report_crop_phase(crop_length, batch_size, i - phase_start_step, time.time() - phase_start_time)
+                crop_length, batch_size = self.crop_phase(i)
+                train_loader = self.build_train_loader(crop_length, batch_size)
+                data_iter = iter(train_loader)
+                phase_start_time, phase_start_step = time.time(), i
+
+            prof.step_begin(i)
             # =================================================================================== #
             #                             1. Preprocess input data                                #
             # =================================================================================== #
@@ -232,11 +505,12 @@ class Solver(object):
 
             '''
 
-            try:
-                mc_src, spk_label_org, spk_c_org, mc_trg, spk_label_trg, spk_c_trg = next(data_iter)
-            except:
-                data_iter = iter(train_loader)
-                mc_src, spk_label_org, spk_c_org, mc_trg, spk_label_trg, spk_c_trg = next(data_iter)
+            with prof.phase('data_wait'):
+                try:
+                    mc_src, spk_label_org, spk_c_org, mc_trg, spk_label_trg, spk_c_trg = next(data_iter)
+                except:
+                    data_iter = iter(train_loader)
+                    mc_src, spk_label_org, spk_c_org, mc_trg, spk_label_trg, spk_c_trg = next(data_iter)
             
             mc_src.unsqueeze_(1) # (B, D, T) -> (B, 1, D, T) for conv2d
             mc_trg.unsqueeze_(1) # (B, D, T) -> (B, 1, D, T) for conv2d
@@ -245,12 +519,13 @@ class Solver(object):
             # spk_label_trg: int,   spk_c_trg:one-hot representation
             #spk_label_trg, spk_c_trg = self.sample_spk_c(mc_real.size(0))
 
-            mc_src = mc_src.to(self.device)              # Input mc.
-            mc_trg = mc_trg.to(self.device)              # Input mc.
-            spk_label_org = spk_label_org.to(self.device)  # Original spk labels.
-            spk_c_org = spk_c_org.to(self.device)          # Original spk one-hot.
-            spk_label_trg = spk_label_trg.to(self.device)  # Target spk labels.
-            spk_c_trg = spk_c_trg.to(self.device)          # Target spk one-hot.
+            with prof.phase('h2d'):
+                mc_src = mc_src.to(self.device)              # Input mc.
+                mc_trg = mc_trg.to(self.device)              # Input mc.
+                spk_label_org = spk_label_org.to(self.device)  # Original spk labels.
+                spk_c_org = spk_c_org.to(self.device)          # Original spk one-hot.
+                spk_label_trg = spk_label_trg.to(self.device)  # Target spk labels.
+                spk_c_trg = spk_c_trg.to(self.device)          # Target spk one-hot.
 
             # =================================================================================== #
             #                             2. Train the Discriminator                              #
@@ -258,20 +533,24 @@ class Solver(object):
             pretrain_step = -1
             if i > pretrain_step:
                 # org and trg speaker cond
-                spk_c_trg = self.sp_enc(mc_trg, spk_label_trg)
-                spk_c_org = self.sp_enc(mc_src, spk_label_org)
+                with prof.phase('sp_enc_fwd'):
+                    spk_c_trg = self.sp_enc(mc_trg, spk_label_trg)
+                    spk_c_org = self.sp_enc(mc_src, spk_label_org)
 
 
                 # Compute loss with face mc feats.
-                mc_fake = self.generator(mc_src, spk_c_org, spk_c_trg)
-                d_out_fake = self.discriminator(mc_fake.detach(), spk_label_org, spk_label_trg)
-                #d_loss_fake =  torch.mean(d_out_fake)
-                d_loss_fake = torch.mean(d_out_fake ** 2)
+                # a generator forward, charged to G_fwd so that D_fwd only holds discriminator time
+                with prof.phase('G_fwd'):
+                    mc_fake = self.generator(mc_src, spk_c_org, spk_c_trg)
+                with prof.phase('D_fwd'):
+                    d_out_fake = self.discriminator(mc_fake.detach(), spk_label_org, spk_label_trg)
+                    #d_loss_fake =  torch.mean(d_out_fake)
+                    d_loss_fake = torch.mean(d_out_fake ** 2)
 
-                # Compute loss with real mc feats.
-                d_out_src = self.discriminator(mc_src, spk_label_trg, spk_label_org)
-                #d_loss_real = - torch.mean(d_out_src)
-                d_loss_real = torch.mean(  (1.0 - d_out_src)**2  )
+                    # Compute loss with real mc feats.
+                    d_out_src = self.discriminator(mc_src, spk_label_trg, spk_label_org)
+                    #d_loss_real = - torch.mean(d_out_src)
+                    d_loss_real = torch.mean(  (1.0 - d_out_src)**2  )
 
 
                 # Compute loss for gradient penalty.
@@ -288,16 +567,18 @@ class Solver(object):
                 # Backward and optimize.
                 #d_loss = d_loss_real + d_loss_fake + self.lambda_gp * d_loss_gp
                 d_loss = self.lambda_adv * (d_loss_real + d_loss_fake)
-                self.reset_grad()
-                d_loss.backward()
-                self.d_optimizer.step()
+                with prof.phase('D_bwd'):
+                    self.reset_grad()
+                    d_loss.backward()
+                with prof.phase('D_step'):
+                    self.d_optimizer.step()
 
                 # Logging.
-                loss = {}
-                loss['D/loss_real'] = d_loss_real.item()
-                loss['D/loss_fake'] = d_loss_fake.item()
-                #loss['D/loss_gp'] = d_loss_gp.item()
-                loss['D/loss'] = d_loss.item()
+                with prof.phase('logging'):
+                    self.accumulate_loss('D/loss_real', d_loss_real)
+                    self.accumulate_loss('D/loss_fake', d_loss_fake)
+                    #self.accumulate_loss('D/loss_gp', d_loss_gp)
+                    self.accumulate_loss('D/loss', d_loss)
 
             # =================================================================================== #
             #                               3. Train the generator                                #
@@ -306,34 +587,37 @@ class Solver(object):
                 
                 # org and trg speaker cond
                 
-                if self.spk_cls:
+                with prof.phase('sp_enc_fwd'):
+                    if self.spk_cls:
 
-                    spk_c_trg, cls_out_trg = self.sp_enc(mc_trg, spk_label_trg, cls_out = True)
-                    spk_c_org, cls_out_org = self.sp_enc(mc_src, spk_label_org, cls_out = True)
-                    
-                    cls_loss = self.classification_loss(cls_out_trg, spk_label_trg) + self.classification_loss(cls_out_org, spk_label_org)   
-                else:
-                    spk_c_trg = self.sp_enc(mc_trg, spk_label_trg)
-                    spk_c_org = self.sp_enc(mc_src, spk_label_org)
+                        spk_c_trg, cls_out_trg = self.sp_enc(mc_trg, spk_label_trg, cls_out = True)
+                        spk_c_org, cls_out_org = self.sp_enc(mc_src, spk_label_org, cls_out = True)
+                        
+                        cls_loss = self.classification_loss(cls_out_trg, spk_label_trg) + self.classification_loss(cls_out_org, spk_label_org)   
+                    else:
+                        spk_c_trg = self.sp_enc(mc_trg, spk_label_trg)
+                        spk_c_org = self.sp_enc(mc_src, spk_label_org)
 
                 
-                # Original-to-target domain.
-                mc_fake = self.generator(mc_src, spk_c_org,  spk_c_trg)
-                g_out_src = self.discriminator(mc_fake, spk_label_org, spk_label_trg)
-                #g_loss_fake = - torch.mean(g_out_src)
-                g_loss_fake = torch.mean((1.0 - g_out_src)**2)
-
-                # Target-to-original domain. Cycle-consistent.
-                mc_reconst = self.generator(mc_fake, spk_c_trg, spk_c_org)
-                g_loss_rec = torch.mean(torch.abs(mc_src - mc_reconst))
-
-                # Original-to-original, Id mapping loss. Mapping
-                mc_fake_id = self.generator(mc_src, spk_c_org, spk_c_org)
-                g_loss_id = torch.mean(torch.abs(mc_src - mc_fake_id))
+                with prof.phase('G_fwd'):
+                    # Original-to-target domain.
+                    mc_fake = self.generator(mc_src, spk_c_org,  spk_c_trg)
+                    g_out_src = self.discriminator(mc_fake, spk_label_org, spk_label_trg)
+                    #g_loss_fake = - torch.mean(g_out_src)
+                    g_loss_fake = torch.mean((1.0 - g_out_src)**2)
+
+                    # Target-to-original domain. Cycle-consistent.
+                    mc_reconst = self.generator(mc_fake, spk_c_trg, spk_c_org)
+                    g_loss_rec = torch.mean(torch.abs(mc_src - mc_reconst))
+
+                    # Original-to-original, Id mapping loss. Mapping
+                    mc_fake_id = self.generator(mc_src, spk_c_org, spk_c_org)
+                    g_loss_id = torch.mean(torch.abs(mc_src - mc_fake_id))
                 
                 # style encoder contrastive loss
 
-                mc_fake_style_c = self.sp_enc(mc_fake, spk_label_trg)
+                with prof.phase('sp_enc_fwd'):
+                    mc_fake_style_c = self.sp_enc(mc_fake, spk_label_trg)
                 #mc_src_style_c = self.sp_enc(mc_reconst, spk_label_trg)
                 g_loss_stid = torch.mean(torch.abs(mc_fake_style_c - spk_c_trg ))
                 
@@ -360,21 +644,25 @@ class Solver(object):
                 if self.spk_cls:
                     g_loss += self.lambda_cls * cls_loss
 
-                self.reset_grad()
-                g_loss.backward()
-                self.g_optimizer.step()
+                with prof.phase('G_bwd'):
+                    self.reset_grad()
+                    g_loss.backward()
+                with prof.phase('G_step'):
+                    self.g_optimizer.step()
                 # Logging.
-                loss['G/loss_fake'] = g_loss_fake.item()
-                loss['G/loss_rec'] = g_loss_rec.item()
-                #loss['G/loss_ms'] = g_loss_ms.item()
-                loss['G/loss_id'] = g_loss_id.item()
-                loss['G/loss_stid'] = g_loss_stid.item()
-                if self.spk_cls:
-                    loss['G/spk_cls'] = cls_loss.item()
+                with prof.phase('logging'):
+                    self.accumulate_loss('G/loss_fake', g_loss_fake)
+                    self.accumulate_loss('G/loss_rec', g_loss_rec)
+                    #self.accumulate_loss('G/loss_ms', g_loss_ms)
+                    self.accumulate_loss('G/loss_id', g_loss_id)
+                    self.accumulate_loss('G/loss_stid', g_loss_stid)
+                    if self.spk_cls:
+                        self.accumulate_loss('G/spk_cls', cls_loss)
                 
             # [0921 new feature]: add ema model ckpt for evaluation
-            self.moving_average(self.generator, self.generator_ema)
-            self.moving_average(self.sp_enc, self.sp_enc_ema)
+            with prof.phase('ema'):
+                self.moving_average(self.generator, self.generator_ema)
+                self.moving_average(self.sp_enc, self.sp_enc_ema)
 
             # =================================================================================== #
             #                                 4. Miscellaneous                                    #
@@ -382,38 +670,40 @@ class Solver(object):
 
             # Print out training information.
             if (i+1) % self.log_step == 0:
-                et = time.time() - start_time
-                et = str(datetime.timedelta(seconds=et))[:-7]
-                log = "Elapsed [{}], Iteration [{}/{}]".format(et, i+1, self.num_iters)
-                for tag, value in loss.items():
-                    log += ", {}: {:.4f}".format(tag, value)
-                print(log, flush=True)
-
-                if self.use_tensorboard:
-                    for tag, value in loss.items():
-                        self.logger.scalar_summary(tag, value, i+1)
+                with prof.phase('logging'):
+                    et = time.time() - start_time
+                    et = str(datetime.timedelta(seconds=et))[:-7]
+                    log = "Elapsed [{}], Iteration [{}/{}]".format(et, i+1, self.num_iters)
+                    if self.cpu_mode:
+                        # throughput of the last log interval with the chosen core split
+                        now = time.time()
+                        log += ", {:.2f} it/s, {:.0f} frames/s".format(self.log_step / (now - log_time), self.log_step * batch_size * crop_length / (now - log_time))
+                        log_time = now
+                    # printing and tensorboard writing happen in the metric sink thread
+                    self.flush_loss(i+1, log)
 
             # Save model checkpoints.
             if (i+1) % self.model_save_step == 0:
-                g_path = os.path.join(self.model_save_dir, '{}-G.ckpt'.format(i+1))
-                g_path_ema = os.path.join(self.model_save_dir, '{}-G.ckpt.ema'.format(i+1))
-                d_path = os.path.join(self.model_save_dir, '{}-D.ckpt'.format(i+1))
-                sp_path = os.path.join(self.model_save_dir, '{}-sp.ckpt'.format(i+1))
-                sp_path_ema = os.path.join(self.model_save_dir, '{}-sp.ckpt.ema'.format(i+1))
+                with prof.phase('checkpoint'):
+                    g_path = os.path.join(self.model_save_dir, '{}-G.ckpt'.format(i+1))
+                    g_path_ema = os.path.join(self.model_save_dir, '{}-G.ckpt.ema'.format(i+1))
+                    d_path = os.path.join(self.model_save_dir, '{}-D.ckpt'.format(i+1))
+                    sp_path = os.path.join(self.model_save_dir, '{}-sp.ckpt'.format(i+1))
+                    sp_path_ema = os.path.join(self.model_save_dir, '{}-sp.ckpt.ema'.format(i+1))
                 
 
-                # [0919 new feature]: save and restore optimizer
-                g_opt_path = os.path.join(self.model_save_dir, '{}-g_opt.ckpt'.format(i+1))
-                d_opt_path = os.path.join(self.model_save_dir, '{}-d_opt.ckpt'.format(i+1))
+                    # [0919 new feature]: save and restore optimizer
+                    g_opt_path = os.path.join(self.model_save_dir, '{}-g_opt.ckpt'.format(i+1))
+                    d_opt_path = os.path.join(self.model_save_dir, '{}-d_opt.ckpt'.format(i+1))
         
-                torch.save(self.generator.state_dict(), g_path)
-                torch.save(self.generator_ema.state_dict(), g_path_ema)
-                torch.save(self.discriminator.state_dict(), d_path)
-                torch.save(self.sp_enc.state_dict(), sp_path)
-                torch.save(self.sp_enc_ema.state_dict(), sp_path_ema)
-                torch.save(self.g_optimizer.state_dict(), g_opt_path)
-                torch.save(self.d_optimizer.state_dict(), d_opt_path)
-                print('Saved model checkpoints into {}...'.format(self.model_save_dir), flush=True)
+                    torch.save(self.generator.state_dict(), g_path)
+                    torch.save(self.generator_ema.state_dict(), g_path_ema)
+                    torch.save(self.discriminator.state_dict(), d_path)
+                    torch.save(self.sp_enc.state_dict(), sp_path)
+                    torch.save(self.sp_enc_ema.state_dict(), sp_path_ema)
+                    torch.save(self.g_optimizer.state_dict(), g_opt_path)
+                    torch.save(self.d_optimizer.state_dict(), d_opt_path)
+                    print('Saved model checkpoints into {}...'.format(self.model_save_dir), flush=True)
             
             
             
@@ -422,7 +712,7 @@ class Solver(object):
                 sampling_rate = self.sampling_rate
                 num_mcep = 36
                 frame_period = 5
-                with torch.no_grad():
+                with prof.phase('sample'), torch.no_grad():
                     for idx, (wav, mc_src, mc_trg) in tqdm(enumerate(test_wavs)):
                         wav_name = basename(test_wavfiles[idx][0])
                         # print(wav_name)
@@ -467,3 +757,12 @@ class Solver(object):
             #    d_lr -= (self.d_lr / float(self.num_iters_decay))
             #    self.update_lr(g_lr, d_lr)
             #    print('Decayed learning rates, g_lr: {}, d_lr: {}'.format(g_lr, d_lr), flush=True)
+
+            prof.step_end(i)
+            if (i+1) % self.log_step == 0:
+                prof.emit(i+1, crop_length = crop_length, batch_size = batch_size)
+
+        if self.crop_schedule is not None:
+            self.report_crop_phase(crop_length, batch_size, self.num_iters - phase_start_step, time.time() - phase_start_time)
+        prof.close()
+        self.logger.close()
@@ -0,0 +1,66 @@
+'''
+    [1019 new feature]: per speaker embedding table for conversion
+
+    The target condition of a speaker only depends on the speaker encoder and its reference mceps, so it is
+    computed once per checkpoint: the mean speaker encoder embedding of num_refs reference mceps of every speaker.
+    Tables are saved as {table_dir}/spk_table-{checkpoint hash}-refs{num_refs}.npz and reused by later runs
+    of the same speaker encoder checkpoint, whatever generator or backend converts with them.
+'''
+import hashlib
+import os
+from glob import glob
+
+import numpy as np
+import torch
+
+
+def checkpoint_hash(path, length = 16):
+    '''sha1 of the checkpoint file content'''
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()[:length]
+
+
+def reference_mcs(mc_dir, spk, num_refs = 1):
+    '''
+        reference mcep files of a speaker, num_refs = 1 keeps the single reference of TestDataset
+        (the second file), None / 0 takes all of them
+    '''
+    mc_files = sorted(glob(os.path.join(mc_dir, f'{spk}_*.npy')))
+    if len(mc_files) == 0:
+        raise Exception(f'no reference mcep of speaker {spk} in {mc_dir}')
+    if num_refs == 1:
+        return [mc_files[1] if len(mc_files) > 1 else mc_files[0]]
+    return mc_files[:num_refs] if num_refs else mc_files
+
+
+def build_speaker_table(sp_enc, speakers, mc_dir, num_refs = 1, device = torch.device('cpu')):
+    '''speaker -> mean embedding (128,) over the reference mceps'''
+    table = {}
+    with torch.no_grad():
+        for spk_idx, spk in enumerate(speakers):
+            label = torch.LongTensor([spk_idx]).to(device)
+            embs = []
+            for mc_file in reference_mcs(mc_dir, spk, num_refs):
+                mc = torch.FloatTensor(np.load(mc_file).T).unsqueeze_(0).unsqueeze_(1).to(device)
+                embs.append(sp_enc(mc, label).squeeze(0).cpu().numpy())
+            table[spk] = np.mean(embs, axis = 0)
+    return table
+
+
+def load_speaker_table(sp_enc, sp_path, speakers, mc_dir, table_dir, num_refs = 1, device = torch.device('cpu')):
+    '''table of the sp_path checkpoint, built and saved on the first call'''
+    path = os.path.join(table_dir, f'spk_table-{checkpoint_hash(sp_path)}-refs{num_refs or "all"}.npz')
+    if os.path.exists(path):
+        saved = np.load(path)
+        if all(spk in saved.files for spk in speakers):
+            print(f'load speaker embedding table {path}', flush=True)
+            return {spk: saved[spk] for spk in speakers}
+
+    table = build_speaker_table(sp_enc, speakers, mc_dir, num_refs, device)
+    os.makedirs(table_dir, exist_ok = True)
+    np.savez(path, **table)
+    print(f'save speaker embedding table of {len(table)} speakers to {path}', flush=True)
+    return table
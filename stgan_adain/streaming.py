@@ -0,0 +1,327 @@
+'''
+    [1019 new feature]: causal streaming generator for real-time conversion
+
+    GeneratorStream follows Generator (2D down sampling, 2304 <-> 256 conversion, 9 AdaIN residual blocks,
+    2D up sampling) with three changes that make it run on fixed size chunks of mcep frames:
+        - every conv is causal along time, only the first conv sees `lookahead` future frames
+        - transposed convs keep their overlap tail and add it to the next chunk
+        - InstanceNorm / AdaIN statistics are running statistics over frames [0, t] instead of global ones
+
+    Every layer has forward(x) for whole utterances (training with Solver) and step(x, state) for chunks,
+    both give the same output. Chunks must be a multiple of 4 frames (two stride 2 stages), the first chunk
+    also carries the `lookahead` frames. The algorithmic latency is (chunk_size + lookahead) * frame_period.
+'''
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from stgan_adain.model import GLU
+
+
+class CausalConv(nn.Module):
+    '''conv (1D or 2D, time is the last axis) padded on the left of the time axis, plus `lookahead` frames on the right'''
+
+    def __init__(self, in_channels, out_channels, kernel_size, stride = 1, padding = 0, lookahead = 0, bias = False, dim = 1):
+
+        super().__init__()
+        conv = nn.Conv1d if dim == 1 else nn.Conv2d
+        kernel_t = kernel_size if isinstance(kernel_size, int) else kernel_size[-1]
+        stride_t = stride if isinstance(stride, int) else stride[-1]
+        # non time axes keep their symmetric padding
+        padding = 0 if dim == 1 else (padding, 0)
+        self.conv = conv(in_channels, out_channels, kernel_size, stride = stride, padding = padding, bias = bias)
+
+        assert 0 <= lookahead <= kernel_t - stride_t, f'lookahead {lookahead} larger than the kernel context {kernel_t - stride_t}'
+        self.context = kernel_t - stride_t
+        self.left = self.context - lookahead
+        self.lookahead = lookahead
+
+    def forward(self, x):
+
+        return self.conv(F.pad(x, (self.left, self.lookahead)))
+
+    def step(self, x, state):
+        '''state: the last `context` input frames, None at the start of a stream (the first chunk carries the lookahead)'''
+        if state is None:
+            state = x.new_zeros(*x.size()[:-1], self.left)
+        x = torch.cat([state, x], dim = -1)
+        return self.conv(x), x[..., x.size(-1) - self.context:]
+
+
+class CausalConvTranspose2d(nn.Module):
+    '''stride 2 up sampling of the time axis, output frame t only depends on input frames <= t // 2'''
+
+    def __init__(self, in_channels, out_channels, kernel_size = 4, stride = 2, padding = 1):
+
+        super().__init__()
+        self.conv = nn.ConvTranspose2d(in_channels, out_channels, kernel_size, stride = stride, padding = (padding, 0), bias = False)
+        # bias is added after the overlap add, so the tail carried between chunks does not count it twice
+        self.bias = nn.Parameter(torch.zeros(out_channels))
+        self.stride = stride
+
+    def forward(self, x):
+
+        out = self.conv(x)[..., :self.stride * x.size(-1)]
+        return out + self.bias.view(1, -1, 1, 1)
+
+    def step(self, x, state):
+        '''state: overlap tail of the previous chunk'''
+        out = self.conv(x)
+        num_frames = self.stride * x.size(-1)
+        if state is not None:
+            out = torch.cat([out[..., :state.size(-1)] + state, out[..., state.size(-1):]], dim = -1)
+        return out[..., :num_frames] + self.bias.view(1, -1, 1, 1), out[..., num_frames:]
+
+
+class RunningNorm(nn.Module):
+    '''
+        causal instance norm, frame t is normalised with the statistics of frames [0, t] (over all non time axes).
+        `prior_frames` frames of zero mean and unit variance are mixed into the statistics, so that the first frames
+        of a stream are not normalised by a near zero variance.
+    '''
+
+    def __init__(self, num_features, affine = True, prior_frames = 8, eps = 1e-5):
+
+        super().__init__()
+        self.num_features = num_features
+        self.prior_frames = prior_frames
+        self.eps = eps
+        self.affine = affine
+        if affine:
+            self.weight = nn.Parameter(torch.ones(num_features))
+            self.bias = nn.Parameter(torch.zeros(num_features))
+
+    def forward(self, x):
+
+        return self.step(x, None)[0]
+
+    def step(self, x, state):
+        '''state: (sum, square sum, count) of the frames seen so far'''
+        reduce_dims = list(range(2, x.dim() - 1))
+        per_frame = 1
+        for d in reduce_dims:
+            per_frame *= x.size(d)
+        s1 = x.sum(dim = reduce_dims, keepdim = True) if reduce_dims else x
+        s2 = (x * x).sum(dim = reduce_dims, keepdim = True) if reduce_dims else x * x
+        cs1 = torch.cumsum(s1, dim = -1)
+        cs2 = torch.cumsum(s2, dim = -1)
+        count = per_frame * torch.arange(1, x.size(-1) + 1, device = x.device, dtype = x.dtype)
+        if state is not None:
+            cs1 = cs1 + state[0]
+            cs2 = cs2 + state[1]
+            count = count + state[2]
+
+        prior = self.prior_frames * per_frame
+        mean = cs1 / (count + prior)
+        var = ((cs2 + prior) / (count + prior) - mean * mean).clamp(min = 0)
+        out = (x - mean) * torch.rsqrt(var + self.eps)
+        if self.affine:
+            shape = [1, -1] + [1] * (x.dim() - 2)
+            out = out * self.weight.view(*shape) + self.bias.view(*shape)
+        return out, (cs1[..., -1:], cs2[..., -1:], count[-1])
+
+
+class RunningAdaptiveInstanceNormalisation(nn.Module):
+    '''AdaptiveInstanceNormalisation with running statistics'''
+
+    def __init__(self, dim_in, dim_c):
+
+        super().__init__()
+        self.dim_in = dim_in
+        self.gamma_t = nn.Linear(2*dim_c, dim_in)
+        self.beta_t = nn.Linear(2*dim_c, dim_in)
+        self.norm = RunningNorm(dim_in, affine = False)
+
+    def condition(self, c_src, c_trg):
+
+        c = torch.cat([c_src, c_trg], dim = -1)
+        gamma = self.gamma_t(c).view(-1, self.dim_in, 1)
+        beta = self.beta_t(c).view(-1, self.dim_in, 1)
+        return gamma, beta
+
+    def forward(self, x, c_src, c_trg):
+
+        return self.step(x, None, c_src, c_trg)[0]
+
+    def step(self, x, state, c_src, c_trg):
+        '''state: (norm state, gamma, beta), the conditioning is computed once per stream'''
+        if state is None:
+            norm_state, (gamma, beta) = None, self.condition(c_src, c_trg)
+        else:
+            norm_state, gamma, beta = state
+        h, norm_state = self.norm.step(x, norm_state)
+        return h * gamma + beta, (norm_state, gamma, beta)
+
+
+class StreamResidualBlock(nn.Module):
+    '''ResidualBlock with a causal conv and running AdaIN'''
+
+    def __init__(self, dim_in, dim_out):
+
+        super().__init__()
+        self.conv_1 = CausalConv(dim_in, dim_out, kernel_size = 3)
+        self.cin_1 = RunningAdaptiveInstanceNormalisation(dim_out, 128)
+        self.glu_1 = GLU()
+
+    def forward(self, x, c_src, c_trg):
+
+        x_ = self.conv_1(x)
+        x_ = self.cin_1(x_, c_src, c_trg)
+        x_ = self.glu_1(x_)
+        return x_
+
+    def step(self, x, state, c_src, c_trg):
+
+        conv_state, cin_state = (None, None) if state is None else state
+        x_, conv_state = self.conv_1.step(x, conv_state)
+        x_, cin_state = self.cin_1.step(x_, cin_state, c_src, c_trg)
+        x_ = self.glu_1(x_)
+        return x_, (conv_state, cin_state)
+
+
+class GeneratorStream(nn.Module):
+    """Causal generator network, runs on whole utterances or on chunks of frames."""
+
+    def __init__(self, num_speakers = 4, aff = True, res_block_name = 'StreamResidualBlock', lookahead = 0):
+
+        super().__init__()
+        if res_block_name != 'StreamResidualBlock':
+            raise Exception(f'GeneratorStream only supports StreamResidualBlock, got {res_block_name}')
+        self.res_block_name = res_block_name
+        self.lookahead = lookahead
+
+        # Down-sampling layers
+        self.down_sample_1 = CausalConv(1, 128, kernel_size = (3, 9), padding = 1, lookahead = lookahead, dim = 2)
+        self.down_sample_2 = CausalConv(128, 256, kernel_size = (4, 8), stride = (2, 2), padding = 1, dim = 2)
+        self.down_norm_2 = RunningNorm(256, affine = aff)
+        self.down_sample_3 = CausalConv(256, 256, kernel_size = (4, 8), stride = (2, 2), padding = 1, dim = 2)
+        self.down_norm_3 = RunningNorm(256, affine = aff)
+
+        # Down-conversion layers.
+        self.down_conversion = nn.Conv1d(in_channels = 2304, out_channels = 256, kernel_size = 1, bias = False)
+        self.down_conversion_norm = RunningNorm(256, affine = aff)
+
+        # Bottleneck layers.
+        self.residual_1 = eval(self.res_block_name)(dim_in=256, dim_out=256)
+        self.residual_2 = eval(self.res_block_name)(dim_in=256, dim_out=256)
+        self.residual_3 = eval(self.res_block_name)(dim_in=256, dim_out=256)
+        self.residual_4 = eval(self.res_block_name)(dim_in=256, dim_out=256)
+        self.residual_5 = eval(self.res_block_name)(dim_in=256, dim_out=256)
+        self.residual_6 = eval(self.res_block_name)(dim_in=256, dim_out=256)
+        self.residual_7 = eval(self.res_block_name)(dim_in=256, dim_out=256)
+        self.residual_8 = eval(self.res_block_name)(dim_in=256, dim_out=256)
+        self.residual_9 = eval(self.res_block_name)(dim_in=256, dim_out=256)
+
+        # Up-conversion layers.
+        self.up_conversion = nn.Conv1d(in_channels = 256, out_channels = 2304, kernel_size = 1, bias = False)
+
+        # Up-sampling layers.
+        self.up_sample_1 = CausalConvTranspose2d(256, 256)
+        self.up_in_1 = RunningNorm(256, affine = True)
+        self.up_sample_2 = CausalConvTranspose2d(256, 128)
+        self.up_in_2 = RunningNorm(128, affine = True)
+        self.relu = nn.LeakyReLU(0.2)
+
+        # Out.
+        self.out = CausalConv(128, 1, kernel_size = 7, padding = 3, dim = 2)
+
+    def _layer(self, name, x, states, *args):
+        layer = getattr(self, name)
+        if states is None:
+            return layer(x, *args)
+        x, states[name] = layer.step(x, states.get(name), *args)
+        return x
+
+    def _run(self, x, c_src, c_trg, states):
+
+        x = self.relu(self._layer('down_sample_1', x, states))
+        x = self.relu(self._layer('down_norm_2', self._layer('down_sample_2', x, states), states))
+        x = self.relu(self._layer('down_norm_3', self._layer('down_sample_3', x, states), states))
+
+        num_frames = x.size(3)
+        x = x.contiguous().view(-1, 2304, num_frames)
+        x = self._layer('down_conversion_norm', self.down_conversion(x), states)
+
+        for i in range(1, 10):
+            x = self._layer(f'residual_{i}', x, states, c_src, c_trg)
+
+        x = self.up_conversion(x)
+        x = x.view(-1, 256, 9, num_frames)
+
+        x = self.relu(self._layer('up_in_1', self._layer('up_sample_1', x, states), states))
+        x = self.relu(self._layer('up_in_2', self._layer('up_sample_2', x, states), states))
+
+        return self._layer('out', x, states)
+
+    def forward(self, x, c_src, c_trg):
+
+        return self._run(x, c_src, c_trg, None)
+
+    def stream_step(self, x, c_src, c_trg, state = None):
+        '''
+            convert one chunk, x: b 1 36 chunk_size (+ lookahead for the first chunk of a stream)
+            returns the converted chunk (b 1 36 chunk_size) and the state to pass with the next chunk
+        '''
+        state = {} if state is None else state
+        return self._run(x, c_src, c_trg, state), state
+
+    def algorithmic_latency(self, chunk_size, frame_period = 5):
+        '''latency in ms between a frame entering a stream and its converted frame coming out'''
+        return (chunk_size + self.lookahead) * frame_period
+
+
+class StreamingConverter(object):
+    '''
+        push mcep frames of any length into a GeneratorStream, converted frames come out in chunks of chunk_size.
+        flush() pads the end of the stream with zeros and returns the remaining frames, in total as many frames
+        come out as went in.
+    '''
+
+    def __init__(self, G, c_src, c_trg, chunk_size = 16):
+
+        if chunk_size % 4 != 0:
+            raise Exception(f'chunk size {chunk_size} is not a multiple of 4')
+        self.G = G
+        self.c_src = c_src
+        self.c_trg = c_trg
+        self.chunk_size = chunk_size
+        self.state = None
+        self.buffer = None
+        self.num_in = 0
+        self.num_out = 0
+
+    def push(self, mc):
+        '''mc: 1 1 36 n frames, returns the converted frames that are ready (possibly none)'''
+        self.buffer = mc if self.buffer is None else torch.cat([self.buffer, mc], dim = -1)
+        self.num_in += mc.size(-1)
+        outs = []
+        with torch.no_grad():
+            while True:
+                # the first chunk of the stream carries the look-ahead frames
+                need = self.chunk_size + (self.G.lookahead if self.state is None else 0)
+                if self.buffer.size(-1) < need:
+                    break
+                out, self.state = self.G.stream_step(self.buffer[..., :need], self.c_src, self.c_trg, self.state)
+                self.buffer = self.buffer[..., need:]
+                outs.append(out)
+        if len(outs) == 0:
+            return mc.new_zeros(*mc.size()[:-1], 0)
+        out = torch.cat(outs, dim = -1)
+        self.num_out += out.size(-1)
+        return out
+
+    def latency_frames(self):
+        '''frames pushed before a frame comes out, at most'''
+        return self.chunk_size + self.G.lookahead
+
+    def flush(self):
+        '''pad the end of the stream with zeros, return the converted frames not returned by push yet'''
+        if self.buffer is None:
+            return None
+        remaining = self.num_in - self.num_out
+        num_chunks = -(-remaining // self.chunk_size)
+        pad = num_chunks * self.chunk_size + (self.G.lookahead if self.state is None else 0) - self.buffer.size(-1)
+        out = self.push(self.buffer.new_zeros(*self.buffer.size()[:-1], pad))[..., :remaining]
+        self.num_in -= pad
+        self.num_out = self.num_in
+        return out
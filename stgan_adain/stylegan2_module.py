@@ -3,6 +3,7 @@ from torch import nn
 from torch.nn import functional as F
 from torch.autograd import Function
 import math
+import time
 
 
 
@@ -28,14 +29,108 @@ class EqualLinear(nn.Module):
         #out = self.relu(out)
         return out
 
+# [1019 new feature]: alternative modulated conv implementations with autotuned dispatch
+#   grouped: per sample modulated weights, one grouped conv with groups = batch_size (original)
+#   fused:   modulate the input activations, one shared conv, demodulate the output activations
+#   bmm:     per sample modulated weights applied to the unfolded input with a batched matmul
+MODCONV_IMPLS = ['grouped', 'fused', 'bmm']
+_modconv_impl = 'auto'
+_modconv_autotune = {}
+
+def set_modconv_impl(impl):
+    '''choose the modulated conv implementation of all Style2 blocks, auto picks the fastest per backend and shape'''
+    global _modconv_impl
+    assert impl == 'auto' or impl in MODCONV_IMPLS, f'unknown modulated conv implementation {impl}'
+    _modconv_impl = impl
+
+def get_modconv_impl():
+    return _modconv_impl
+
+def _modconv_key(block, x):
+    # bucket the time axis to the next power of 2, utterance lengths vary a lot at conversion time
+    shape = list(x.size())
+    shape[-1] = 1 << (shape[-1] - 1).bit_length()
+    return (type(block).__name__, x.device.type, x.dtype, tuple(shape), torch.is_grad_enabled())
+
+def _time_impl(block, impl, x, style, params, n_iters = 3):
+    def run():
+        out = getattr(block, f'forward_{impl}')(x, *style)
+        if len(params) > 0:
+            # torch.autograd.grad does not accumulate into .grad, the training state is untouched
+            torch.autograd.grad(out.sum(), params)
+    run()
+    if x.is_cuda:
+        torch.cuda.synchronize(x.device)
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        run()
+    if x.is_cuda:
+        torch.cuda.synchronize(x.device)
+    return (time.perf_counter() - start) / n_iters
+
+def _autotune(block, key, x, style):
+    grad = key[-1]
+    x = x.detach().requires_grad_(grad)
+    style = tuple(st.detach().requires_grad_(grad) for st in style)
+    # time the backward as well in training, w.r.t. the conv weight, the input and the styles
+    params = [block.weight, x] + list(style) if grad else []
+    with torch.no_grad():
+        ref = block.forward_grouped(x, *style)
+    timings = {}
+    for impl in MODCONV_IMPLS:
+        with torch.no_grad():
+            out = getattr(block, f'forward_{impl}')(x, *style)
+        if not torch.allclose(out, ref, rtol = 1e-3, atol = 1e-4):
+            print(f'modconv autotune: {impl} not equivalent for {key}, max diff {(out - ref).abs().max().item()}', flush=True)
+            continue
+        with torch.set_grad_enabled(grad):
+            timings[impl] = _time_impl(block, impl, x, style, params)
+    best = min(timings, key = timings.get)
+    print(f'modconv autotune: {key} -> {best}, ' + ', '.join(f'{k} {v*1000:.2f}ms' for k, v in timings.items()), flush=True)
+    return best
+
+def modconv_dispatch(block, x, style):
+    '''run the modulated conv of a Style2 block with the configured (or autotuned) implementation'''
+    impl = _modconv_impl
+    if impl == 'auto':
+        key = _modconv_key(block, x)
+        if key not in _modconv_autotune:
+            _modconv_autotune[key] = _autotune(block, key, x, style)
+        impl = _modconv_autotune[key]
+    return getattr(block, f'forward_{impl}')(x, *style)
+
+def _grouped_conv(x, weight, padding):
+    '''x: b in *spatial, weight: b out in *kernel'''
+    batch_size, dim_out = weight.size(0), weight.size(1)
+    weight = weight.reshape(batch_size * dim_out, *weight.size()[2:])
+    conv = F.conv1d if x.dim() == 3 else F.conv2d
+    out = conv(x.reshape(1, -1, *x.size()[2:]), weight, padding = padding, groups = batch_size)
+    return out.view(batch_size, dim_out, *out.size()[2:])
+
+def _bmm_conv(x, weight, padding):
+    '''x: b in *spatial, weight: b out in *kernel'''
+    batch_size, dim_out = weight.size(0), weight.size(1)
+    if x.dim() == 3:
+        cols = F.unfold(x.unsqueeze(2), (1, weight.size(3)), padding = (0, padding)) # b in*k t
+    else:
+        cols = F.unfold(x, weight.size()[3:], padding = padding) # b in*k*k h*w
+    out_size = tuple(s + 2 * padding - k + 1 for s, k in zip(x.size()[2:], weight.size()[3:]))
+    out = torch.bmm(weight.reshape(batch_size, dim_out, -1), cols)
+    return out.view(batch_size, dim_out, *out_size)
+
+def _box_sum1d(x, kernel_size, padding):
+    '''sum of a b 1 t signal over the conv window'''
+    ones = x.new_ones(1, 1, kernel_size)
+    return F.conv1d(x, ones, padding = padding)
+
 class Style2ResidualBlock1DSrc(nn.Module):
     '''a stylegan2 module'''
-    
+
     def __init__(self, dim_in, dim_out, kernel_size = 3):
-        
+
         super().__init__()
 
-        self.style_linear = EqualLinear( 2*128, dim_in, bias_init = 1) 
+        self.style_linear = EqualLinear( 2*128, dim_in, bias_init = 1)
         self.weight = nn.Parameter(torch.randn(1, dim_out, dim_in, kernel_size), requires_grad = True)
 
         fan_in = dim_in * kernel_size **2
@@ -46,41 +141,60 @@ class Style2ResidualBlock1DSrc(nn.Module):
         self.dim_in = dim_in
         self.kernel_size = kernel_size
 
-    def forward(self, x, c_src, c_trg):
-        
-        batch_size, in_channel, t = x.size()
-        
+    def modulation(self, c_src, c_trg):
+
         c = torch.cat([c_src, c_trg], dim = -1)
 
-        s = self.style_linear(c).view(batch_size, 1, in_channel, 1)
-        
+        s = self.style_linear(c)
+        return (s,)
+
+    def forward(self, x, c_src, c_trg):
+
+        return modconv_dispatch(self, x, self.modulation(c_src, c_trg))
+
+    def condition(self, c_src, c_trg):
+        '''modulated weight of one (src, trg) pair, shared by every utterance converted with it'''
+        return self.modulated_weight(*self.modulation(c_src, c_trg))[0]
+
+    def forward_conditioned(self, x, weight):
+
+        return F.conv1d(x, weight, padding = self.padding)
+
+    def modulated_weight(self, s):
+
+        batch_size = s.size(0)
         # scale weights
-        weight = self.scale * self.weight * s # b out in ks
+        weight = self.scale * self.weight * s.view(batch_size, 1, self.dim_in, 1) # b out in ks
 
         # demodulate
         demod = torch.rsqrt(weight.pow(2).sum([2,3]) + 1e-8)
         weight = weight * demod.view(batch_size, self.dim_out, 1,1)
+        return weight
 
-        weight = weight.view(batch_size * self.dim_out, self.dim_in, self.kernel_size)
+    def forward_grouped(self, x, s):
 
-        x = x.view(1, batch_size * in_channel, t)
+        return _grouped_conv(x, self.modulated_weight(s), self.padding)
 
-        out = F.conv1d(x, weight, padding = self.padding, groups = batch_size)
+    def forward_bmm(self, x, s):
 
-        _, _, new_t = out.size()
+        return _bmm_conv(x, self.modulated_weight(s), self.padding)
 
-        out = out.view(batch_size, self.dim_out, new_t)
+    def forward_fused(self, x, s):
+
+        weight = self.scale * self.weight[0] # out in ks
+        demod = torch.rsqrt(torch.mm(s.pow(2), weight.pow(2).sum(2).t()) + 1e-8) # b out
+        out = F.conv1d(x * s.unsqueeze(2), weight, padding = self.padding)
+        return out * demod.unsqueeze(2)
 
-        return out
 class Style2ResidualBlock1DBeta(nn.Module):
     '''a stylegan2 module'''
-    
+
     def __init__(self, dim_in, dim_out, kernel_size = 3):
-        
+
         super().__init__()
 
         self.dim_out = dim_out * 2
-        self.style_linear = EqualLinear( 128, dim_in, bias_init = 1) 
+        self.style_linear = EqualLinear( 128, dim_in, bias_init = 1)
         self.style_linear_beta = EqualLinear(128, dim_in, bias_init = 1)
         self.weight = nn.Parameter(torch.randn(1, self.dim_out, dim_in, kernel_size), requires_grad = True)
 
@@ -92,14 +206,37 @@ class Style2ResidualBlock1DBeta(nn.Module):
         self.kernel_size = kernel_size
         self.glu = nn.GLU(dim = 1)
         #self.relu = nn.LeakyReLU(0.2)
-    def forward(self, x, c_src, c_trg):
-        
-        batch_size, in_channel, t = x.size()
-        
+
+    def modulation(self, c_src, c_trg):
+
         #c = torch.cat([c_src, c_trg], dim = -1)
 
-        s = self.style_linear(c_trg).view(batch_size, 1, in_channel, 1)
-        beta = self.style_linear_beta(c_trg).view(batch_size, 1, in_channel, 1)
+        s = self.style_linear(c_trg)
+        beta = self.style_linear_beta(c_trg)
+        return (s, beta)
+
+    def forward(self, x, c_src, c_trg):
+
+        out = modconv_dispatch(self, x, self.modulation(c_src, c_trg))
+        out = self.glu(out)
+
+        #out = self.relu(out)
+        return out
+
+    def condition(self, c_src, c_trg):
+        '''modulated weight of one (src, trg) pair, shared by every utterance converted with it'''
+        return self.modulated_weight(*self.modulation(c_src, c_trg))[0]
+
+    def forward_conditioned(self, x, weight):
+
+        out = F.conv1d(x, weight, padding = self.padding)
+        return self.glu(out)
+
+    def modulated_weight(self, s, beta):
+
+        batch_size = s.size(0)
+        s = s.view(batch_size, 1, self.dim_in, 1)
+        beta = beta.view(batch_size, 1, self.dim_in, 1)
         # scale weights
         weight = self.scale * (self.weight * s + beta) # b out in ks
 
@@ -107,29 +244,43 @@ class Style2ResidualBlock1DBeta(nn.Module):
         demod = torch.rsqrt(weight.pow(2).sum([2,3]) + 1e-8)
         demod_mean = torch.mean(weight.view(batch_size, self.dim_out, -1), dim = 2)
         weight = (weight - demod_mean.view(batch_size, self.dim_out, 1,1) )  * demod.view(batch_size, self.dim_out, 1,1)
+        return weight
 
-        weight = weight.view(batch_size * self.dim_out, self.dim_in, self.kernel_size)
+    def forward_grouped(self, x, s, beta):
 
-        x = x.view(1, batch_size * in_channel, t)
+        return _grouped_conv(x, self.modulated_weight(s, beta), self.padding)
 
-        out = F.conv1d(x, weight, padding = self.padding, groups = batch_size)
+    def forward_bmm(self, x, s, beta):
 
-        _, _, new_t = out.size()
+        return _bmm_conv(x, self.modulated_weight(s, beta), self.padding)
+
+    def forward_fused(self, x, s, beta):
+
+        # weight[b,o,i,k] = scale * (W[o,i,k] * s[b,i] + beta[b,i]); its square sum and mean over (i,k) are expanded
+        # so no per sample weight is built, the beta and mean terms become box sums over the conv window
+        weight = self.weight[0] # out in ks
+        w_sq = weight.pow(2).sum(2) # out in
+        w_sum = weight.sum(2) # out in
+        ks = self.kernel_size
+        sq = torch.mm(s.pow(2), w_sq.t()) + 2 * torch.mm(s * beta, w_sum.t()) + ks * beta.pow(2).sum(1, keepdim = True)
+        demod = torch.rsqrt(self.scale ** 2 * sq + 1e-8) # b out
+        mean = self.scale * (torch.mm(s, w_sum.t()) + ks * beta.sum(1, keepdim = True)) / (self.dim_in * ks) # b out
+
+        out = F.conv1d(x * s.unsqueeze(2), weight, padding = self.padding)
+        beta_box = _box_sum1d(torch.sum(x * beta.unsqueeze(2), dim = 1, keepdim = True), ks, self.padding) # b 1 t
+        x_box = _box_sum1d(torch.sum(x, dim = 1, keepdim = True), ks, self.padding) # b 1 t
+        out = self.scale * (out + beta_box) - mean.unsqueeze(2) * x_box
+        return out * demod.unsqueeze(2)
 
-        out = out.view(batch_size, self.dim_out, new_t)
-        out = self.glu(out)
-        
-        #out = self.relu(out)
-        return out
 class Style2ResidualBlock1D(nn.Module):
     '''a stylegan2 module'''
     # [0917 new feature]: add GLU layer
     def __init__(self, dim_in, dim_out, kernel_size = 3):
-        
+
         super().__init__()
 
         self.dim_out =  dim_out * 2
-        self.style_linear = EqualLinear( 128, dim_in, bias_init = 1) 
+        self.style_linear = EqualLinear( 128, dim_in, bias_init = 1)
         self.weight = nn.Parameter(torch.randn(1, self.dim_out, dim_in, kernel_size), requires_grad = True)
 
         fan_in = dim_in * kernel_size **2
@@ -140,41 +291,64 @@ class Style2ResidualBlock1D(nn.Module):
         self.kernel_size = kernel_size
         self.glu = nn.GLU(dim = 1)
         #self.relu = nn.LeakyReLU(0.2)
-    def forward(self, x, c_src, c_trg):
-        
-        batch_size, in_channel, t = x.size()
-        
+
+    def modulation(self, c_src, c_trg):
+
         #c = torch.cat([c_src, c_trg], dim = -1)
 
-        s = self.style_linear(c_trg).view(batch_size, 1, in_channel, 1)
-        
+        s = self.style_linear(c_trg)
+        return (s,)
+
+    def forward(self, x, c_src, c_trg):
+
+        out = modconv_dispatch(self, x, self.modulation(c_src, c_trg))
+        out = self.glu(out)
+        #out = self.relu(out)
+        return out
+
+    def condition(self, c_src, c_trg):
+        '''modulated weight of one (src, trg) pair, shared by every utterance converted with it'''
+        return self.modulated_weight(*self.modulation(c_src, c_trg))[0]
+
+    def forward_conditioned(self, x, weight):
+
+        out = F.conv1d(x, weight, padding = self.padding)
+        return self.glu(out)
+
+    def modulated_weight(self, s):
+
+        batch_size = s.size(0)
         # scale weights
-        weight = self.scale * self.weight * s # b out in ks
+        weight = self.scale * self.weight * s.view(batch_size, 1, self.dim_in, 1) # b out in ks
 
         # demodulate
         demod = torch.rsqrt(weight.pow(2).sum([2,3]) + 1e-8)
         weight = weight * demod.view(batch_size, self.dim_out, 1,1)
+        return weight
 
-        weight = weight.view(batch_size * self.dim_out, self.dim_in, self.kernel_size)
+    def forward_grouped(self, x, s):
 
-        x = x.view(1, batch_size * in_channel, t)
+        return _grouped_conv(x, self.modulated_weight(s), self.padding)
 
-        out = F.conv1d(x, weight, padding = self.padding, groups = batch_size)
+    def forward_bmm(self, x, s):
 
-        _, _, new_t = out.size()
+        return _bmm_conv(x, self.modulated_weight(s), self.padding)
+
+    def forward_fused(self, x, s):
+
+        weight = self.scale * self.weight[0] # out in ks
+        demod = torch.rsqrt(torch.mm(s.pow(2), weight.pow(2).sum(2).t()) + 1e-8) # b out
+        out = F.conv1d(x * s.unsqueeze(2), weight, padding = self.padding)
+        return out * demod.unsqueeze(2)
 
-        out = out.view(batch_size, self.dim_out, new_t)
-        out = self.glu(out)
-        #out = self.relu(out)
-        return out
 class Style2ResidualBlock(nn.Module):
     '''a stylegan2 module'''
-    
+
     def __init__(self, dim_in, dim_out, kernel_size = 3):
-        
+
         super().__init__()
 
-        self.style_linear = EqualLinear(128, dim_in, bias_init = 1) 
+        self.style_linear = EqualLinear(128, dim_in, bias_init = 1)
         self.weight = nn.Parameter(torch.randn(1, dim_out, dim_in, kernel_size, kernel_size), requires_grad = True)
 
         fan_in = dim_in * kernel_size **2
@@ -185,29 +359,45 @@ class Style2ResidualBlock(nn.Module):
         self.dim_in = dim_in
         self.kernel_size = kernel_size
 
+    def modulation(self, c_src, c_trg):
+
+        s = self.style_linear(c_trg)
+        return (s,)
+
     def forward(self, x, c_src, c_trg):
-        
-        batch_size, in_channel, h,w = x.size()
 
-        s = self.style_linear(c_trg).view(batch_size, 1, in_channel, 1, 1 )
-        
+        return modconv_dispatch(self, x, self.modulation(c_src, c_trg))
+
+    def condition(self, c_src, c_trg):
+        '''modulated weight of one (src, trg) pair, shared by every utterance converted with it'''
+        return self.modulated_weight(*self.modulation(c_src, c_trg))[0]
+
+    def forward_conditioned(self, x, weight):
+
+        return F.conv2d(x, weight, padding = self.padding)
+
+    def modulated_weight(self, s):
+
+        batch_size = s.size(0)
         # scale weights
-        weight = self.scale * self.weight * s
+        weight = self.scale * self.weight * s.view(batch_size, 1, self.dim_in, 1, 1)
 
         # demodulate
         demod = torch.rsqrt(weight.pow(2).sum([2,3,4]) + 1e-8)
         weight = weight * demod.view(batch_size, self.dim_out, 1,1,1)
+        return weight
 
-        weight = weight.view(batch_size * self.dim_out, self.dim_in, self.kernel_size, self.kernel_size)
-
-        x = x.view(1, batch_size * in_channel, h, w)
+    def forward_grouped(self, x, s):
 
-        out = F.conv2d(x, weight, padding = self.padding, groups = batch_size)
+        return _grouped_conv(x, self.modulated_weight(s), self.padding)
 
-        _, _, new_h, new_w = out.size()
+    def forward_bmm(self, x, s):
 
-        out = out.view(batch_size, self.dim_out, new_h, new_w)
-
-        return out
+        return _bmm_conv(x, self.modulated_weight(s), self.padding)
 
+    def forward_fused(self, x, s):
 
+        weight = self.scale * self.weight[0] # out in ks ks
+        demod = torch.rsqrt(torch.mm(s.pow(2), weight.pow(2).sum([2,3]).t()) + 1e-8) # b out
+        out = F.conv2d(x * s.view(s.size(0), -1, 1, 1), weight, padding = self.padding)
+        return out * demod.view(demod.size(0), -1, 1, 1)
@@ -0,0 +1,171 @@
+'''
+    [1019 new feature]: streaming conversion of audio chunks from a wav file or stdin
+
+    Reads 16 bit mono PCM chunk by chunk, converts it with stgan_adain/audio_streaming.py and writes the converted
+    audio as soon as it is ready, to a wav file or to stdout (raw 16 bit PCM). The source utterance is not known
+    in advance, both speaker conditions come from the speaker embedding table. Latency statistics go to stderr.
+
+    arecord -f S16_LE -r 16000 -c 1 -t raw | python stream_convert.py --input - --output - --src_spk p225 --trg_spk p226 ... \
+        | aplay -f S16_LE -r 16000 -c 1 -t raw
+'''
+import argparse
+import contextlib
+import json
+import sys
+import time
+import wave
+from os.path import join
+
+import numpy as np
+import torch
+
+from convert import load_models
+from stgan_adain.audio_streaming import StreamingVoiceConverter, frame_converter
+from stgan_adain.speaker_table import load_speaker_table
+
+
+def log(*args):
+    # stdout may carry the converted audio
+    print(*args, file = sys.stderr, flush = True)
+
+
+def read_chunks(path, sample_rate, chunk_samples):
+    '''float32 chunks of a 16 bit wav file, or of raw 16 bit mono PCM on stdin if path is -'''
+    if path == '-':
+        stream = sys.stdin.buffer
+        while True:
+            data = stream.read(2 * chunk_samples)
+            if not data:
+                return
+            yield np.frombuffer(data[: len(data) // 2 * 2], dtype = '<i2').astype(np.float32) / 32768
+    else:
+        with wave.open(path, 'rb') as f:
+            if f.getframerate() != sample_rate or f.getsampwidth() != 2:
+                raise Exception(f'{path}: expected 16 bit pcm at {sample_rate} Hz, got {8 * f.getsampwidth()} bit at {f.getframerate()} Hz')
+            channels = f.getnchannels()
+            while True:
+                data = f.readframes(chunk_samples)
+                if not data:
+                    return
+                yield np.frombuffer(data, dtype = '<i2').reshape(-1, channels).mean(axis = 1).astype(np.float32) / 32768
+
+
+class AudioWriter(object):
+    '''16 bit mono PCM to a wav file, or raw to stdout if path is -'''
+
+    def __init__(self, path, sample_rate):
+        self.stdout = path == '-'
+        if self.stdout:
+            self.stream = sys.stdout.buffer
+        else:
+            self.stream = wave.open(path, 'wb')
+            self.stream.setnchannels(1)
+            self.stream.setsampwidth(2)
+            self.stream.setframerate(sample_rate)
+
+    def write(self, wav):
+        if len(wav) == 0:
+            return
+        data = (np.clip(wav, -1, 1) * 32767).astype('<i2').tobytes()
+        if self.stdout:
+            self.stream.write(data)
+            self.stream.flush()
+        else:
+            self.stream.writeframes(data)
+
+    def close(self):
+        if not self.stdout:
+            self.stream.close()
+
+
+def load_stats(train_data_dir, spk):
+    stats = np.load(join(train_data_dir, f'{spk}_stats.npz'))
+    return {key: stats[key] for key in ['log_f0s_mean', 'log_f0s_std', 'coded_sps_mean', 'coded_sps_std']}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    # Model configuration.
+    parser.add_argument('--num_speakers', type=int, default=10, help='dimension of speaker labels')
+    parser.add_argument('--sample_rate', type=int, default=16000, help='sample rate')
+    parser.add_argument('--resume_iters', type=int, default=None, help='step to resume for testing.')
+    parser.add_argument('--src_spk', type=str, required = True, help = 'source speaker.')
+    parser.add_argument('--trg_spk', type=str, required = True, help = 'target speaker.')
+    parser.add_argument('--generator', type=str, default='AdaGenSplit')
+    parser.add_argument('--res_block', type=str, default='ResidualBlockSplit')
+    parser.add_argument('--student_blocks', type = int, default = 3, help = 'residual blocks of a distilled AdaGenSlim')
+    parser.add_argument('--student_res_dim', type = int, default = 128, help = 'residual channels of a distilled AdaGenSlim')
+    parser.add_argument('--student_conv_dim', type = int, default = 64, help = 'down / up stack channels of a distilled AdaGenSlim')
+    parser.add_argument('--stream_lookahead', type = int, default = 0, help = 'look-ahead frames of AdaGenStream')
+    parser.add_argument('--spenc', type = str, default = 'SPEncoder')
+    parser.add_argument('--spk_cls', default = False, action = 'store_true')
+    parser.add_argument('--drop_affine', default = True, action = 'store_false')
+    parser.add_argument('--use_ema', default = False, action = 'store_true')
+    # Directories.
+    parser.add_argument('--train_data_dir', type=str, default='./data/mc/train', help = 'speaker statistics')
+    parser.add_argument('--test_data_dir', type=str, default='./data/mc/test', help = 'reference mceps of the speaker table')
+    parser.add_argument('--model_save_dir', type=str, default='./models')
+    parser.add_argument('--speaker_path', type = str, required = True)
+    parser.add_argument('--spk_table_dir', type = str, default = './spk_tables', help = 'dir of the saved speaker embedding tables')
+    # Streaming.
+    parser.add_argument('--input', type = str, required = True, help = 'wav file, or - for raw 16 bit mono pcm on stdin')
+    parser.add_argument('--output', type = str, required = True, help = 'wav file, or - for raw 16 bit mono pcm on stdout')
+    parser.add_argument('--chunk_ms', type = float, default = 20, help = 'input chunk size')
+    parser.add_argument('--realtime', default = False, action = 'store_true', help = 'read a wav file at real-time speed, as a live input')
+    parser.add_argument('--analysis_context_ms', type = float, default = 200, help = 'audio before the new frames of each WORLD analysis')
+    parser.add_argument('--analysis_lookahead_ms', type = float, default = 40, help = 'audio after a frame before it is analysed')
+    parser.add_argument('--analysis_step', type = int, default = 16, help = 'frames analysed at a time')
+    parser.add_argument('--stream_chunk', type = int, default = 16, help = 'frames emitted per generator window (multiple of 4)')
+    parser.add_argument('--window_context', type = int, default = 64, help = 'past frames of each generator window (multiple of 4)')
+    parser.add_argument('--window_overlap', type = int, default = 8, help = 'frames crossfaded between generator windows (multiple of 4)')
+    parser.add_argument('--window_lookahead', type = int, default = 8, help = 'future frames of each generator window (multiple of 4)')
+    parser.add_argument('--synthesis_overlap', type = int, default = 8, help = 'frames crossfaded between synthesis blocks')
+    parser.add_argument('--threads', type = int, default = None, help = 'torch intra-op threads')
+    config = parser.parse_args()
+
+    log(config)
+    if config.resume_iters is None:
+        raise RuntimeError("Please specify the step number for resuming.")
+    if config.threads is not None:
+        torch.set_num_threads(config.threads)
+
+    with open(config.speaker_path) as f:
+        speakers = json.load(f)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    frame_period = 5
+    # the loaders print their progress, keep it out of the audio on stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        G, sp_enc, sp_path = load_models(config, device, frame_period)
+        if sp_enc is None:
+            raise Exception(f'streaming conversion needs an AdaGen generator with a speaker encoder, got {config.generator}')
+        G.eval()
+        # the whole source utterance is never available, both conditions are speaker means
+        spk2emb = load_speaker_table(sp_enc, sp_path, speakers, config.test_data_dir, config.spk_table_dir, 0, device)
+    c_src = torch.FloatTensor(spk2emb[config.src_spk]).unsqueeze_(0).to(device)
+    c_trg = torch.FloatTensor(spk2emb[config.trg_spk]).unsqueeze_(0).to(device)
+
+    converter = frame_converter(G, c_src, c_trg, config.stream_chunk, config.window_context, config.window_overlap, config.window_lookahead)
+    stream = StreamingVoiceConverter(converter, load_stats(config.train_data_dir, config.src_spk), load_stats(config.train_data_dir, config.trg_spk),
+                                     config.sample_rate, frame_period = frame_period, analysis_context_ms = config.analysis_context_ms,
+                                     analysis_lookahead_ms = config.analysis_lookahead_ms, analysis_step = config.analysis_step,
+                                     synthesis_overlap = config.synthesis_overlap, device = device)
+    log(f'algorithmic latency bound {stream.latency_bound_ms():.0f} ms')
+
+    writer = AudioWriter(config.output, config.sample_rate)
+    chunk_samples = max(1, int(config.chunk_ms * config.sample_rate / 1000))
+    start = time.perf_counter()
+    for chunk in read_chunks(config.input, config.sample_rate, chunk_samples):
+        if config.realtime and config.input != '-':
+            # wait until the chunk would have been recorded
+            delay = (stream.num_in + len(chunk)) / config.sample_rate - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        writer.write(stream.push(chunk))
+    writer.write(stream.flush())
+    writer.close()
+
+    report = stream.report()
+    if report['buffered_ms_max'] > report['latency_bound_ms'] + config.chunk_ms:
+        log(f"buffered latency {report['buffered_ms_max']:.0f} ms exceeds the bound {report['latency_bound_ms']:.0f} ms + chunk")
+    log(json.dumps(report))
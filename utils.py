@@ -189,4 +189,10 @@ def sample_train_data(dataset_A, dataset_B, n_frames = 128):
     train_data_A = np.array(train_data_A)
     train_data_B = np.array(train_data_B)
 
-    return train_data_A, train_data_B
\ No newline at end of file
+    return train_data_A, train_data_B
+def mel_cepstral_distortion(coded_sp_1, coded_sp_2):
+    '''
+        frame averaged MCD in dB between two time aligned mceps of shape (T, D), c0 (energy) excluded
+    '''
+    diff = coded_sp_1[:, 1:] - coded_sp_2[:, 1:]
+    return np.mean(10.0 / np.log(10.0) * np.sqrt(2.0 * np.sum(diff ** 2, axis = 1)))